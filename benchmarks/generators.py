@@ -0,0 +1,210 @@
+"""Synthetic explorer datasets generated from real contract ABIs.
+
+The logs and transactions are encoded with eth_abi from random arguments, so that they can be decoded by the
+collection pipeline exactly like the explorer's ones, and follow the explorer's format (hex fields for getLogs,
+decimal strings for txlist).
+"""
+import json
+import os
+import random
+
+from eth_abi import encode_abi, encode_single
+from eth_utils import event_abi_to_log_topic, function_abi_to_4byte_selector, to_checksum_address
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+PAYLOADS_PER_ABI_ENTRY = 256
+
+
+def load_abi(name: str = "ricochet_exchange_abi") -> list:
+    """Load a contract ABI from the fixtures directory."""
+    return json.load(open(os.path.join(FIXTURES_DIR, f"{name}.json")))
+
+
+def random_value(abi_type: str, rng: random.Random, addresses: list):
+    """Generate a random value for an ABI type, addresses being drawn from a fixed population of users."""
+
+    if abi_type == "address":
+        return rng.choice(addresses)
+    if abi_type == "bool":
+        return rng.random() < 0.5
+    if abi_type.startswith("uint"):
+        return rng.getrandbits(min(int(abi_type[4:] or 256), 96))
+    if abi_type.startswith("int"):
+        return rng.getrandbits(min(int(abi_type[3:] or 256), 64) - 1) * rng.choice([-1, 1])
+    if abi_type == "string":
+        return "x" * rng.randint(0, 64)
+    if abi_type == "bytes":
+        return rng.getrandbits(8 * 64).to_bytes(64, "big")[: rng.randint(0, 64)]
+    if abi_type.startswith("bytes"):
+        return rng.getrandbits(8 * int(abi_type[5:])).to_bytes(int(abi_type[5:]), "big")
+    raise ValueError(f"Unsupported ABI type {abi_type}")
+
+
+def generate_addresses(n_addresses: int, rng: random.Random) -> list:
+    return [to_checksum_address(rng.getrandbits(160).to_bytes(20, "big")) for _ in range(n_addresses)]
+
+
+def generate_logs(abi: list, address: str, n_logs: int, start_block: int = 1, logs_per_block: int = 3, n_users: int = 1_000, seed: int = 0):
+    """Generate getLogs formatted event logs of a contract, the events being drawn uniformly from its ABI.
+
+    ABI encoding being slow, a pool of encoded payloads is generated for each event and then sampled.
+
+    Yields:
+        dict: The event logs, by ascending block number and log index.
+    """
+
+    rng = random.Random(seed)
+    users = generate_addresses(n_users, rng)
+    payloads = list()
+
+    for event in [e for e in abi if e["type"] == "event"]:
+        topic = "0x" + event_abi_to_log_topic(event).hex()
+        indexed = [x["type"] for x in event["inputs"] if x["indexed"]]
+        not_indexed = [x["type"] for x in event["inputs"] if not x["indexed"]]
+
+        for _ in range(PAYLOADS_PER_ABI_ENTRY):
+            topics = [topic] + ["0x" + encode_single(t, random_value(t, rng, users)).hex() for t in indexed]
+            data = "0x" + encode_abi(not_indexed, [random_value(t, rng, users) for t in not_indexed]).hex()
+            payloads.append((topics, data))
+
+    block_number, log_index = start_block, 0
+    for i in range(n_logs):
+        topics, data = rng.choice(payloads)
+
+        yield {
+            "address": address.lower(),
+            "topics": list(topics),
+            "data": data,
+            "blockNumber": hex(block_number),
+            "timeStamp": hex(1_600_000_000 + 2 * block_number),
+            "gasPrice": hex(rng.randint(10**9, 10**11)),
+            "gasUsed": hex(rng.randint(21_000, 10**6)),
+            "logIndex": hex(log_index),
+            "transactionHash": "0x%064x" % rng.getrandbits(256),
+            "transactionIndex": hex(rng.randint(0, 200)),
+        }
+
+        log_index += 1
+        if (i + 1) % logs_per_block == 0:
+            block_number, log_index = block_number + rng.randint(1, 5), 0
+
+
+def generate_transactions(abi: list, address: str, n_transactions: int, start_block: int = 1, n_users: int = 1_000, seed: int = 0):
+    """Generate txlist formatted transactions calling the non view functions of a contract ABI.
+
+    As for the logs, a pool of encoded inputs is generated for each function and then sampled.
+
+    Yields:
+        dict: The transactions, by ascending block number.
+    """
+
+    rng = random.Random(seed)
+    users = generate_addresses(n_users, rng)
+    inputs = list()
+
+    for function in [f for f in abi if f["type"] == "function" and f.get("stateMutability") not in ("view", "pure")]:
+        types = [x["type"] for x in function["inputs"]]
+        for _ in range(PAYLOADS_PER_ABI_ENTRY):
+            call_data = function_abi_to_4byte_selector(function) + encode_abi(types, [random_value(t, rng, users) for t in types])
+            inputs.append("0x" + call_data.hex())
+
+    block_number = start_block
+    for i in range(n_transactions):
+
+        yield {
+            "blockNumber": str(block_number),
+            "timeStamp": str(1_600_000_000 + 2 * block_number),
+            "hash": "0x%064x" % rng.getrandbits(256),
+            "nonce": str(rng.randint(0, 10_000)),
+            "blockHash": "0x%064x" % rng.getrandbits(256),
+            "transactionIndex": str(rng.randint(0, 200)),
+            "from": rng.choice(users).lower(),
+            "to": address.lower(),
+            "value": "0",
+            "gas": str(rng.randint(21_000, 10**6)),
+            "gasPrice": str(rng.randint(10**9, 10**11)),
+            "isError": "0",
+            "txreceipt_status": "1",
+            "input": rng.choice(inputs),
+            "contractAddress": "",
+            "cumulativeGasUsed": str(rng.randint(21_000, 10**7)),
+            "gasUsed": str(rng.randint(21_000, 10**6)),
+            "confirmations": str(10**6),
+        }
+
+        block_number += rng.randint(1, 5)
+
+
+def generate_transfers(action: str, address: str, n_transfers: int, start_block: int = 1, transfers_per_block: int = 3, n_users: int = 1_000, seed: int = 0):
+    """Generate txlistinternal, tokentx or tokennfttx formatted transfers from and to a contract.
+
+    Yields:
+        dict: The transfers, by ascending block number.
+    """
+
+    rng = random.Random(seed)
+    users = [user.lower() for user in generate_addresses(n_users, rng)]
+    tokens = [(token.lower(), f"Token {i}", f"TK{i}", str(rng.choice([6, 8, 18]))) for i, token in enumerate(generate_addresses(20, rng))]
+
+    block_number = start_block
+    for i in range(n_transfers):
+        sender, recipient = (address.lower(), rng.choice(users)) if rng.random() < 0.5 else (rng.choice(users), address.lower())
+        row = {
+            "blockNumber": str(block_number),
+            "timeStamp": str(1_600_000_000 + 2 * block_number),
+            "hash": "0x%064x" % rng.getrandbits(256),
+            "from": sender,
+            "to": recipient,
+            "gas": str(rng.randint(21_000, 10**6)),
+            "gasUsed": str(rng.randint(21_000, 10**6)),
+        }
+
+        if action == "txlistinternal":
+            row.update(value=str(rng.getrandbits(64)), contractAddress="", input="", type="call", traceId=f"0_{i % 4}", isError="0", errCode="")
+        else:
+            contract, name, symbol, decimals = rng.choice(tokens)
+            row.update(
+                nonce=str(rng.randint(0, 10_000)),
+                blockHash="0x%064x" % rng.getrandbits(256),
+                contractAddress=contract,
+                tokenName=name,
+                tokenSymbol=symbol,
+                transactionIndex=str(rng.randint(0, 200)),
+                gasPrice=str(rng.randint(10**9, 10**11)),
+                cumulativeGasUsed=str(rng.randint(21_000, 10**7)),
+                input="deprecated",
+                confirmations=str(10**6),
+            )
+            if action == "tokentx":
+                row.update(value=str(rng.getrandbits(96)), tokenDecimal=decimals)
+            else:
+                row.update(tokenID=str(rng.getrandbits(32)), tokenDecimal="0")
+
+        yield row
+
+        if (i + 1) % transfers_per_block == 0:
+            block_number += rng.randint(1, 5)
+
+
+def generate_stream_logs(n_logs: int, n_streams: int = 20, n_users: int = 10_000, distribution_rate: float = 0.1, start_block: int = 1, logs_per_block: int = 3, seed: int = 0):
+    """Generate formatted UpdatedStream and Distribution logs of Ricochet exchanges, as the stream state engine reads them.
+
+    One update in ten stops the stream of its user, the other ones setting a new rate.
+
+    Yields:
+        dict: The logs, by ascending block number and log index, their timestamps being in seconds.
+    """
+
+    rng = random.Random(seed)
+    streams = [stream.lower() for stream in generate_addresses(n_streams, rng)]
+    users = [user.lower() for user in generate_addresses(n_users, rng)]
+
+    for i in range(n_logs):
+        block_number = start_block + i // logs_per_block
+        row = {"address": rng.choice(streams), "blockNumber": block_number, "logIndex": i % logs_per_block, "timeStamp": 1_600_000_000 + 2 * block_number}
+        if rng.random() < distribution_rate:
+            row.update({"event_name": "Distribution", "decoded_data.totalAmount": str(rng.getrandbits(80))})
+        else:
+            rate = 0 if rng.random() < 0.1 else rng.randint(10**9, 10**12)
+            row.update({"event_name": "UpdatedStream", "decoded_data.from": rng.choice(users), "decoded_data.newRate": rate})
+        yield row
@@ -0,0 +1,347 @@
+"""Local mock servers emulating an Etherscan-style explorer API and EVM / Solana JSON-RPC nodes.
+
+The servers run in background threads on an ephemeral port, count the requests they serve, and can inject
+latency, faults and rate limits so that the pagination, retry and failover logic can be exercised offline.
+"""
+import bisect
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from eth_abi import decode_abi, encode_abi
+from eth_utils import keccak
+
+
+class MockServer:
+    """Base class of the mock servers, serving the requests in a background thread.
+
+    Args:
+        latency (float): Delay (in seconds) added to every request.
+        error_rate (float): Share of the requests answered with a 503 error.
+        rate_limit (float): Maximum number of requests per second, None for no limit.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, rate_limit: float = None, seed: int = 0):
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.requests = Counter()
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self._buckets = dict()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self, b"")
+
+            def do_POST(self):
+                server.handle(self, self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_port}/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def rate_limited(self, key: str = "", rate: float = None) -> bool:
+        """Consume a token of a token bucket, returning whether the request exceeds the rate limit.
+
+        The requests are limited by the server's bucket, unless the bucket of a key (an API key) and its rate are given.
+        """
+
+        rate = rate or self.rate_limit
+        if not rate:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated_at = self._buckets.get(key, (rate, now))
+            tokens = min(rate, tokens + (now - updated_at) * rate)
+            self._buckets[key] = (tokens - 1 if tokens >= 1 else tokens, now)
+            return tokens < 1
+
+    def handle(self, handler: BaseHTTPRequestHandler, body: bytes):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            failed = self.rng.random() < self.error_rate
+
+        if failed:
+            status, payload = 503, {"error": "injected fault"}
+        else:
+            status, payload = self.respond(handler.path, body)
+
+        content = json.dumps(payload).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def respond(self, path: str, body: bytes) -> tuple:
+        raise NotImplementedError
+
+
+class MockExplorer(MockServer):
+    """An Etherscan-style explorer API serving getabi, getLogs and the account datasets from in-memory datasets.
+
+    Results are returned by ascending block number and paginated by the requested page and offset, the explorers'
+    default page sizes being applied otherwise (10,000 transactions and transfers, 1,000 logs). Rate limited
+    requests get the explorers' "Max rate limit reached" answer, the requests being limited per API key as well
+    with key_rate_limit.
+    """
+
+    default_offsets = {"txlist": 10_000, "txlistinternal": 10_000, "tokentx": 10_000, "tokennfttx": 10_000, "getLogs": 1_000}
+
+    def __init__(self, abis: dict = None, transactions: dict = None, logs: dict = None, key_rate_limit: float = None, **kwargs):
+
+        super().__init__(**kwargs)
+        self.key_rate_limit = key_rate_limit
+        self.abis = {k.lower(): v for k, v in (abis or dict()).items()}
+        self.datasets = {action: dict() for action in self.default_offsets}
+
+        for address, rows in (transactions or dict()).items():
+            self.add_dataset("txlist", address, rows, lambda x: int(x["blockNumber"]))
+        for address, rows in (logs or dict()).items():
+            self.add_dataset("getLogs", address, rows, lambda x: int(x["blockNumber"], 16))
+
+    def add_dataset(self, action: str, address: str, rows: list, block_of):
+        rows = sorted(rows, key=block_of)
+        self.datasets[action][address.lower()] = (rows, [block_of(x) for x in rows])
+
+    def respond(self, path: str, body: bytes) -> tuple:
+        params = dict(parse_qsl(urlparse(path).query))
+        action = params.get("action")
+        self.requests[action] += 1
+
+        if self.rate_limited() or (self.key_rate_limit and self.rate_limited(f"apikey-{params.get('apikey')}", self.key_rate_limit)):
+            return 200, {"status": "0", "message": "NOTOK", "result": "Max rate limit reached"}
+
+        if action == "getabi":
+            abi = self.abis.get(params.get("address", "").lower())
+            if abi is None:
+                return 200, {"status": "0", "message": "NOTOK", "result": "Contract source code not verified"}
+            return 200, {"status": "1", "message": "OK", "result": json.dumps(abi)}
+
+        if action in self.datasets:
+            start, end = ("fromBlock", "toBlock") if action == "getLogs" else ("startblock", "endblock")
+            rows, blocks = self.datasets[action].get(params.get("address", "").lower(), (list(), list()))
+            offset = int(params.get("offset") or self.default_offsets[action])
+            first = bisect.bisect_left(blocks, int(params.get(start, 0)))
+            last = bisect.bisect_right(blocks, int(params.get(end, 2**63)))
+            topic0 = params.get("topic0")
+            result = [r for r in rows[first:last] if r["topics"][0] == topic0] if topic0 else rows[first:last]
+            page = int(params.get("page") or 1)
+            result = result[(page - 1) * offset : page * offset]
+            if not result:
+                return 200, {"status": "0", "message": "No records found", "result": []}
+            return 200, {"status": "1", "message": "OK", "result": result}
+
+        return 200, {"status": "0", "message": "NOTOK", "result": f"Unsupported action {action}"}
+
+
+class MockJsonRpcNode(MockServer):
+    """A JSON-RPC node answering single and batched requests with configurable method handlers.
+
+    The default handlers emulate an EVM node with a fixed head block, synthetic block headers and a storage (and
+    eth_call results) empty unless set with set_storage, and are completed or overridden with the handlers
+    argument (for Solana methods, for instance). A node with a state_depth is pruned: it answers the state
+    requests (eth_call, eth_getStorageAt) of the blocks older than state_depth blocks with a missing trie node error.
+    """
+
+    # The Multicall3 contract, whose aggregate3 calls are executed against the mocked eth_call results
+    multicall_address = "0xca11bde05977b3631167028862be2a173976ca11"
+
+    def __init__(self, handlers: dict = None, head_block: int = 30_000_000, multicall_limit: int = None, state_depth: int = None, **kwargs):
+
+        super().__init__(**kwargs)
+        self.head_block = head_block
+        self.multicall_limit = multicall_limit
+        self.state_depth = state_depth
+        self.storage = defaultdict(list)
+        self.handlers = {
+            "web3_clientVersion": lambda params: "mock/v1.0.0",
+            "net_version": lambda params: "1",
+            "eth_chainId": lambda params: "0x1",
+            "eth_blockNumber": lambda params: hex(self.head_block),
+            "eth_getStorageAt": lambda params: self.storage_at((params[0].lower(), params[1]), params[2] if len(params) > 2 else "latest"),
+            "eth_call": self.eth_call,
+            "eth_getBlockByNumber": self.block_header,
+            "eth_getLogs": lambda params: list(),
+        }
+        self.handlers.update(handlers or dict())
+
+    def set_storage(self, key: tuple, from_block: int, value: str):
+        """Set the value of an (address, slot) storage slot, or of an (address, calldata) eth_call, from a given block."""
+
+        self.storage[(key[0].lower(), key[1])].append((from_block, "0x" + value[2:].rjust(64, "0")))
+        self.storage[(key[0].lower(), key[1])].sort()
+
+    def storage_at(self, key: tuple, block: str) -> str:
+        number = self.head_block if block == "latest" else int(block, 16)
+        if self.state_depth is not None and number < self.head_block - self.state_depth:
+            raise ValueError(f"missing trie node {number:x} (path )")
+        values = [value for from_block, value in self.storage.get(key, list()) if from_block <= number]
+        return values[-1] if values else "0x" + "00" * 32
+
+    def eth_call(self, params: list):
+        block = params[1] if len(params) > 1 else "latest"
+        if params[0]["to"].lower() != self.multicall_address:
+            return self.storage_at((params[0]["to"].lower(), params[0]["data"]), block)
+        self.storage_at((self.multicall_address, "0x"), block)  # the state of the block must be available
+
+        # aggregate3 calls, the calls without a mocked result reverting, and too many calls running out of gas
+        calls = decode_abi(["(address,bool,bytes)[]"], bytes.fromhex(params[0]["data"][10:]))[0]
+        if self.multicall_limit and len(calls) > self.multicall_limit:
+            raise ValueError("out of gas")
+        results = list()
+        for target, _, data in calls:
+            key = (target.lower(), "0x" + data.hex())
+            results.append((True, bytes.fromhex(self.storage_at(key, block)[2:])) if key in self.storage else (False, b""))
+        return "0x" + encode_abi(["(bool,bytes)[]"], [results]).hex()
+
+    def block_header(self, params: list) -> dict:
+        number = self.head_block if params[0] == "latest" else int(params[0], 16)
+        return {
+            "number": hex(number),
+            "hash": "0x%064x" % number,
+            "parentHash": "0x%064x" % (number - 1),
+            "timestamp": hex(1_600_000_000 + 2 * number),
+            "logsBloom": "0x" + "00" * 256,
+            "transactions": list(),
+        }
+
+    def call(self, request: dict) -> dict:
+        method = request.get("method")
+        self.requests[method] += 1
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+
+        if method not in self.handlers:
+            response["error"] = {"code": -32601, "message": f"Method {method} not found"}
+        elif self.rate_limited():
+            response["error"] = {"code": -32005, "message": "Rate limit exceeded"}
+        else:
+            try:
+                response["result"] = self.handlers[method](request.get("params") or list())
+            except ValueError as e:
+                response["error"] = {"code": -32000, "message": str(e)}
+        return response
+
+    def respond(self, path: str, body: bytes) -> tuple:
+        request = json.loads(body)
+        if isinstance(request, list):
+            return 200, [self.call(r) for r in request]
+        return 200, self.call(request)
+
+
+class MockChain(MockJsonRpcNode):
+    """An EVM node whose blocks are mined, and reorganized, on demand, serving the logs attached to them.
+
+    Block hashes embed the branch they were mined on, so that a reorg replaces the hashes (and the logs) of the
+    last blocks, like a node switching to a heavier branch does. The headers logs blooms are computed from the
+    addresses and topics of the logs of the blocks, bloom_noise random bits emulating the logs of other contracts.
+    """
+
+    def __init__(self, head_block: int = 1_000, bloom_noise: int = 0, **kwargs):
+
+        super().__init__(head_block=head_block, **kwargs)
+        self.bloom_noise = bloom_noise
+        self.branch = 0
+        self.hashes, self.timestamps, self.logs, self.blooms = dict(), dict(), dict(), dict()
+        self.handlers.update(eth_getLogs=self.get_logs)
+
+    def logs_bloom(self, logs: list) -> str:
+        """Compute the 2048 bits bloom of the addresses and topics of a list of logs."""
+
+        bloom = 0
+        for _ in range(self.bloom_noise):
+            bloom |= 1 << self.rng.randrange(2048)
+        for value in {v for log in logs for v in [log["address"]] + log["topics"]}:
+            digest = keccak(hexstr=value)
+            for i in (0, 2, 4):
+                bloom |= 1 << (int.from_bytes(digest[i : i + 2], "big") & 2047)
+        return "0x" + bloom.to_bytes(256, "big").hex()
+
+    def block_hash(self, number: int) -> str:
+        return self.hashes.get(number, "0x%064x" % number)
+
+    def block_header(self, params: list) -> dict:
+        with self.lock:
+            number = self.head_block if params[0] == "latest" else int(params[0], 16)
+            if number > self.head_block:
+                return None
+            return {
+                "number": hex(number),
+                "hash": self.block_hash(number),
+                "parentHash": self.block_hash(number - 1),
+                "timestamp": hex(self.timestamps.get(number, 1_600_000_000 + 2 * number)),
+                "logsBloom": self.blooms.get(number, "0x" + "00" * 256),
+                "transactions": list(),
+            }
+
+    def get_logs(self, params: list) -> list:
+        query = params[0]
+        with self.lock:
+            start = int(query.get("fromBlock", hex(self.head_block)), 16)
+            end = min(int(query.get("toBlock", hex(self.head_block)), 16), self.head_block)
+            address = (query.get("address") or "").lower()
+            logs = [log for block in range(start, end + 1) for log in self.logs.get(block, list())]
+        # the topics filter of the first position, the ones of the other positions being ignored
+        topics = (query.get("topics") or [None])[0]
+        topics = [topics] if isinstance(topics, str) else topics
+        return [log for log in logs if (not address or log["address"] == address) and (not topics or log["topics"][0] in topics)]
+
+    def mine(self, blocks_logs: list):
+        """Mine new blocks, given the list of the logs (explorer formatted) of each of them."""
+
+        with self.lock:
+            for logs in blocks_logs:
+                self.head_block += 1
+                number = self.head_block
+                self.hashes[number] = "0x%032x%032x" % (self.branch, number)
+                self.timestamps[number] = int(time.time())
+                self.logs[number] = [
+                    {
+                        "address": log["address"],
+                        "topics": log["topics"],
+                        "data": log["data"],
+                        "blockNumber": hex(number),
+                        "blockHash": self.hashes[number],
+                        "logIndex": hex(i),
+                        "transactionHash": log["transactionHash"],
+                        "transactionIndex": log["transactionIndex"],
+                        "removed": False,
+                    }
+                    for i, log in enumerate(logs)
+                ]
+                self.blooms[number] = self.logs_bloom(logs)
+
+    def reorg(self, depth: int, blocks_logs: list):
+        """Replace the last depth blocks by a new branch of blocks, given the logs of each of them."""
+
+        with self.lock:
+            self.branch += 1
+            for number in range(self.head_block - depth + 1, self.head_block + 1):
+                self.hashes.pop(number, None)
+                self.logs.pop(number, None)
+                self.blooms.pop(number, None)
+            self.head_block -= depth
+        self.mine(blocks_logs)
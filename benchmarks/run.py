@@ -0,0 +1,736 @@
+"""Benchmark the collection pipeline stages against local mock explorer and node servers.
+
+Each stage is timed, then run a second time under tracemalloc to measure its peak memory, and the requests it
+sent to the mock servers are counted. Results can be saved as a baseline and compared against a previous one.
+
+Usage:
+    python benchmarks/run.py --logs 1000000 --transactions 1000000 --save-baseline benchmarks/baseline.json
+    python benchmarks/run.py --baseline benchmarks/baseline.json --stages fetch_logs decode_logs format_logs
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import yaml
+from eth_abi import encode_abi
+from eth_utils import event_abi_to_log_topic
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(dir_path, os.pardir))
+sys.path.insert(0, os.path.join(dir_path, os.pardir, "evm-compatible"))
+sys.path.insert(0, os.path.join(dir_path, os.pardir, "evm-compatible", "ricochet"))
+sys.path.insert(0, os.path.join(dir_path, os.pardir, "solana-network", "solana-staking"))
+
+from common.block_times import BlockTimeIndex
+from common.columnar import loads, page_to_frame
+from common.metrics import metrics
+from common.response_cache import ResponseCache
+from bloom_filter import BloomPrefilter
+from data_collection import ContractEventLogs, ContractInternalTransactions, ContractNFTTransfers, ContractTokenTransfers, ContractTransactions
+from data_modelling import Web3GraphModelling
+from generators import generate_addresses, generate_logs, generate_stream_logs, generate_transactions, generate_transfers, load_abi
+from log_follower import LogFollower, ParquetLogSink
+from mock_servers import MockChain, MockExplorer, MockJsonRpcNode
+from proxy_history import BEACON_IMPLEMENTATION_SELECTOR, PROXY_SLOTS
+from stake_accounts import generate_stake_accounts
+from staking_extraction import SolanaAPI
+from stream_state import StreamStateEngine, distribution_events, flow_updates
+
+CONTRACT_ADDRESS = "0xA0eC9E1542485700110688b3e6FbebBDf23cd901"
+PROXY_ADDRESS = "0x5C6B0f7Bf3E7ce046039Bd8FABdfD3f9F5021678"
+TOKEN_ADDRESS = "0x2791Bca1f2de4661ED88A30C99A7a9449Aa84174"
+ERC20_EVENTS_ABI = [
+    {
+        "type": "event",
+        "name": name,
+        "anonymous": False,
+        "inputs": [{"name": a, "type": "address", "indexed": True}, {"name": b, "type": "address", "indexed": True}, {"name": "value", "type": "uint256", "indexed": False}],
+    }
+    for name, a, b in [("Transfer", "from", "to"), ("Approval", "owner", "spender")]
+]
+# The events of the collect_logs_events stage, 2 of the 5 events of the contract ABI
+EVENTS_FILTER = ["UpdatedStream", "Distribution"]
+TRANSACTION_INTEGERS = ["blockNumber", "timeStamp", "nonce", "value", "gas", "gasPrice", "gasUsed", "cumulativeGasUsed", "confirmations", "transactionIndex", "isError"]
+BALANCE_OF_ABI = [
+    {
+        "type": "function",
+        "name": "balanceOf",
+        "stateMutability": "view",
+        "inputs": [{"name": "account", "type": "address"}],
+        "outputs": [{"name": "balance", "type": "uint256"}],
+    }
+]
+
+
+class RecordingSession:
+    """Stand-in for a Neo4j session, recording the Cypher statements instead of running them."""
+
+    def __init__(self):
+        self.statements = 0
+
+    def run(self, statement: str, params: dict = None):
+        self.statements += 1
+
+
+class Benchmark:
+    """Set up the mock servers and datasets, and run the pipeline stages against them."""
+
+    def __init__(self, args: argparse.Namespace, workdir: str):
+
+        self.args = args
+        self.abi = load_abi()
+        self.raw_logs = list(generate_logs(self.abi, CONTRACT_ADDRESS, args.logs))
+        self.token_logs = list(generate_logs(ERC20_EVENTS_ABI, TOKEN_ADDRESS, args.logs))
+        self.raw_transactions = list(generate_transactions(self.abi, CONTRACT_ADDRESS, args.transactions))
+        self.stake_accounts, _ = generate_stake_accounts(args.stake_accounts)
+
+        # The explorer payloads of the parsing stages, as 1,000 logs getLogs pages and 10,000 transactions txlist pages
+        self.log_pages = [json.dumps({"status": "1", "message": "OK", "result": self.raw_logs[i : i + 1_000]}).encode() for i in range(0, len(self.raw_logs), 1_000)]
+        self.transaction_pages = [
+            json.dumps({"status": "1", "message": "OK", "result": self.raw_transactions[i : i + 10_000]}).encode() for i in range(0, len(self.raw_transactions), 10_000)
+        ]
+        # The Ricochet streams events, the checkpoint of the stream_state_incremental stage covering all but the last 1%
+        self.stream_logs = pd.DataFrame(generate_stream_logs(args.stream_logs)).assign(timeStamp=lambda df: pd.to_datetime(df["timeStamp"], unit="s"))
+        self.stream_split = int(0.99 * len(self.stream_logs))
+        self.transfers = {action: list(generate_transfers(action, CONTRACT_ADDRESS, args.transfers, seed=i)) for i, action in enumerate(["txlistinternal", "tokentx", "tokennfttx"])}
+
+        self.explorer = MockExplorer(
+            abis={CONTRACT_ADDRESS: self.abi},
+            transactions={CONTRACT_ADDRESS: self.raw_transactions},
+            logs={CONTRACT_ADDRESS: self.raw_logs},
+            latency=args.latency,
+            rate_limit=args.rate_limit,
+        )
+        for action, rows in self.transfers.items():
+            self.explorer.add_dataset(action, CONTRACT_ADDRESS, rows, lambda x: int(x["blockNumber"]))
+        # An explorer limiting the requests of each API key, as the public explorers do
+        self.keyed_explorer = MockExplorer(logs={CONTRACT_ADDRESS: self.raw_logs}, latency=args.latency, key_rate_limit=args.key_rate_limit)
+        self.node = MockJsonRpcNode(latency=args.latency, multicall_limit=1_000)
+        # The failing and slow nodes of the failover network, serving the same storage as the main node
+        self.faulty_node = MockJsonRpcNode(error_rate=1.0, multicall_limit=1_000)
+        self.slow_node = MockJsonRpcNode(latency=args.slow_latency, multicall_limit=1_000)
+        self.faulty_node.storage = self.slow_node.storage = self.node.storage
+        # An archive node slower than its pruned fallback, which doesn't have the state of the blocks older than 128 blocks
+        self.archive_node = MockJsonRpcNode(latency=0.05, multicall_limit=1_000)
+        self.pruned_node = MockJsonRpcNode(multicall_limit=1_000, state_depth=128)
+        self.archive_node.storage = self.pruned_node.storage = self.node.storage
+        self.solana_node = MockJsonRpcNode(
+            handlers={
+                "getEpochInfo": lambda params: {"epoch": 350, "absoluteSlot": 151_200_000},
+                "getProgramAccounts": lambda params: self.stake_accounts,
+            },
+            latency=args.latency,
+        )
+        self.chain = MockChain()
+
+        # Contracts emitting logs in a few blocks only, on a chain whose headers have the logs blooms
+        rng = random.Random(1)
+        self.sparse_chain = MockChain(head_block=0, bloom_noise=args.bloom_noise)
+        self.sparse_contracts = generate_addresses(args.sparse_contracts, rng)
+        self.sparse_logs_count = 0
+        sparse_logs = {address.lower(): list() for address in self.sparse_contracts}
+        blocks = list()
+        for number in range(1, args.sparse_blocks + 1):
+            emitters = [address for address in self.sparse_contracts if rng.random() < args.sparse_rate]
+            logs = [dict(rng.choice(self.raw_logs[:1000]), address=address.lower(), blockNumber=hex(number)) for address in emitters]
+            for log in logs:
+                sparse_logs[log["address"]].append(log)
+            blocks.append(logs)
+            self.sparse_logs_count += len(logs)
+        self.sparse_chain.mine(blocks)
+        for address, logs in sparse_logs.items():
+            self.explorer.abis[address] = self.abi
+            self.explorer.add_dataset("getLogs", address, logs, lambda x: int(x["blockNumber"], 16))
+
+        # A proxy upgraded twice, the last time to a beacon, each implementation emitting its own events
+        # (the logs of an implementation span up to 5 blocks per log)
+        self.proxy_ranges = [(1, "eip1967"), (2 * args.proxy_logs + 1, "eip1967"), (4 * args.proxy_logs + 1, "beacon")]
+        self.proxy_logs = list()
+        events = [e for e in self.abi if e["type"] == "event"]
+        implementations = generate_addresses(len(self.proxy_ranges) + 1, rng)
+        beacon = implementations.pop()
+        for i, (from_block, standard) in enumerate(self.proxy_ranges):
+            abi = [e for e in self.abi if e["type"] != "event"] + events[2 * i : 2 * i + 2]
+            self.explorer.abis[implementations[i].lower()] = abi
+            self.proxy_logs += list(generate_logs(abi, PROXY_ADDRESS, args.proxy_logs // 3, start_block=from_block, logs_per_block=1, seed=i))
+            if standard == "beacon":
+                self.node.set_storage((PROXY_ADDRESS, PROXY_SLOTS["eip1967"]), from_block, "0x0")
+                self.node.set_storage((PROXY_ADDRESS, PROXY_SLOTS["beacon"]), from_block, beacon)
+                self.node.set_storage((beacon, BEACON_IMPLEMENTATION_SELECTOR), from_block, implementations[i])
+            else:
+                self.node.set_storage((PROXY_ADDRESS, PROXY_SLOTS[standard]), from_block, implementations[i])
+        self.explorer.abis[PROXY_ADDRESS.lower()] = list()
+        self.explorer.add_dataset("getLogs", PROXY_ADDRESS, self.proxy_logs, lambda x: int(x["blockNumber"], 16))
+
+        # The token balances of holders, 1 in 20 of them being a contract reverting the call
+        self.holders = generate_addresses(args.snapshot_calls, rng)
+        for i, holder in enumerate(self.holders):
+            if i % 20:
+                calldata = "0x70a08231" + encode_abi(["address"], [holder]).hex()
+                self.node.set_storage((TOKEN_ADDRESS, calldata), 1, hex(i * 10**18))
+
+        self.servers = [self.explorer, self.keyed_explorer, self.node, self.faulty_node, self.slow_node, self.archive_node, self.pruned_node, self.solana_node, self.chain, self.sparse_chain]
+        for server in self.servers:
+            server.__enter__()
+
+        evm_config = os.path.join(workdir, "evm.yaml")
+        yaml.safe_dump(
+            {
+                "mock": {"NODE_URL": self.node.url, "API_URL": self.explorer.url + "api?", "FINALITY_DEPTH": 64, "MULTICALL": {"GAS_PER_CALL": 25_000}},
+                # the faulty node is ranked first, then the slow one, the requests failing over and being hedged to the main node
+                "failover": {
+                    "NODE_URL": self.faulty_node.url,
+                    "API_URL": self.explorer.url + "api?",
+                    "FINALITY_DEPTH": 64,
+                    "FALLBACK_NODE_URLS": [self.slow_node.url, self.node.url],
+                    "HEDGE_AFTER": args.hedge_after,
+                    "MULTICALL": {"GAS_PER_CALL": 25_000},
+                },
+                # the pruned node as the fallback of the archive node, and as the first node, failing over to the main node
+                "pruned_fallback": {
+                    "NODE_URL": self.archive_node.url,
+                    "API_URL": self.explorer.url + "api?",
+                    "FINALITY_DEPTH": 64,
+                    "FALLBACK_NODE_URLS": [self.pruned_node.url],
+                    "MULTICALL": {"GAS_PER_CALL": 25_000},
+                },
+                "pruned_first": {
+                    "NODE_URL": self.pruned_node.url,
+                    "API_URL": self.explorer.url + "api?",
+                    "FINALITY_DEPTH": 64,
+                    "FALLBACK_NODE_URLS": [self.node.url],
+                    "MULTICALL": {"GAS_PER_CALL": 25_000},
+                },
+                "sharded": {"NODE_URL": self.node.url, "API_URL": self.explorer.url + "api?", "FINALITY_DEPTH": 64, "PAGINATION_SHARDS": 4},
+                "mockchain": {"NODE_URL": self.chain.url, "API_URL": self.explorer.url + "api?", "FINALITY_DEPTH": 64},
+                "sparse": {"NODE_URL": self.sparse_chain.url, "API_URL": self.explorer.url + "api?", "FINALITY_DEPTH": 64},
+                # the clients stay slightly below the explorer's rate limit per key
+                **{
+                    f"keys{n}": {"NODE_URL": self.node.url, "API_URL": self.keyed_explorer.url + "api?", "RATE_LIMIT": 0.9 * args.key_rate_limit, "PAGINATION_SHARDS": 4}
+                    for n in (1, 4)
+                },
+            },
+            open(evm_config, "w"),
+        )
+        solana_config = os.path.join(workdir, "solana.yaml")
+        yaml.safe_dump({"rpc_endpoints": [self.solana_node.url], "solscan_url": self.explorer.url}, open(solana_config, "w"))
+
+        os.environ.update(MOCK_API_KEY="mock", ALCHEMY_MOCK_NODE_KEY="mock", MOCKCHAIN_API_KEY="mock", ALCHEMY_MOCKCHAIN_NODE_KEY="mock")
+        os.environ.update(SHARDED_API_KEY="mock", ALCHEMY_SHARDED_NODE_KEY="mock", FAILOVER_API_KEY="mock", ALCHEMY_FAILOVER_NODE_KEY="mock")
+        os.environ.update(REPLAY_API_KEY="mock", ALCHEMY_REPLAY_NODE_KEY="mock")
+        os.environ.update(PRUNED_FALLBACK_API_KEY="mock", ALCHEMY_PRUNED_FALLBACK_NODE_KEY="mock", PRUNED_FIRST_API_KEY="mock", ALCHEMY_PRUNED_FIRST_NODE_KEY="mock")
+        os.environ.update(KEYS1_API_KEY="one-0", ALCHEMY_KEYS1_NODE_KEY="mock", KEYS4_API_KEY="four-0,four-1,four-2,four-3", ALCHEMY_KEYS4_NODE_KEY="mock")
+        os.environ.update(SPARSE_API_KEY="mock", ALCHEMY_SPARSE_NODE_KEY="mock", WEB3_RESPONSE_CACHE="off", SOLANA_CACHE_DIR=workdir)
+        os.environ.update(WEB3_BLOCK_TIMES_DIR=workdir, WEB3_ADDRESS_DICTIONARY_DIR=workdir)
+        self.workdir = workdir
+        history = self.stream_logs.iloc[: self.stream_split]
+        engine = StreamStateEngine()
+        engine.apply(flow_updates(history), distribution_events(history))
+        engine.save(os.path.join(workdir, "stream_state"))
+        self.logs_client_config = evm_config
+        self.logs_client = ContractEventLogs("mock", config_path=evm_config)
+        self.transactions_client = ContractTransactions("mock", config_path=evm_config)
+        self.solana_client = SolanaAPI(config_path=solana_config)
+        self.follow_client = ContractEventLogs("mockchain", config_path=evm_config)
+        self.sparse_client = ContractEventLogs("sparse", config_path=evm_config)
+        self.internal_transactions_client = ContractInternalTransactions("mock", config_path=evm_config)
+        self.token_transfers_client = ContractTokenTransfers("mock", config_path=evm_config)
+        self.nft_transfers_client = ContractNFTTransfers("mock", config_path=evm_config)
+        self.sharded_transfers_client = ContractTokenTransfers("sharded", config_path=evm_config)
+        self.key_clients = {n: ContractEventLogs(f"keys{n}", config_path=evm_config) for n in (1, 4)}
+
+        self.abi_events = self.logs_client.create_contract_abi_events(self.abi)
+        self.contract_instance = self.transactions_client.w3.eth.contract(address=CONTRACT_ADDRESS, abi=self.abi)
+
+    def close(self):
+        for server in self.servers:
+            server.__exit__()
+
+    def request_count(self) -> int:
+        return sum(sum(server.requests.values()) for server in self.servers)
+
+    def explorer_request_count(self) -> int:
+        return sum(self.explorer.requests.values()) + sum(self.keyed_explorer.requests.values())
+
+    # The stages return the number of rows they processed
+
+    def parse_pages(self, pages: list, integers: list, base: int, columnar: bool) -> int:
+        """Parse explorer payloads into frames, by columns with the fast JSON parser, or from dicts like the collectors used to."""
+
+        rows = 0
+        for content in pages:
+            if columnar:
+                df = page_to_frame(loads(content)["result"], integers, base)
+            else:
+                df = pd.DataFrame(json.loads(content)["result"])
+                df[integers] = df[integers].apply(lambda serie: serie.map(lambda x: int(x, base)))
+            rows += len(df)
+        return rows
+
+    def parse_log_pages(self) -> int:
+        return self.parse_pages(self.log_pages, ["blockNumber", "timeStamp", "gasPrice", "gasUsed", "logIndex", "transactionIndex"], 16, columnar=True)
+
+    def parse_log_pages_dicts(self) -> int:
+        return self.parse_pages(self.log_pages, ["blockNumber", "timeStamp", "gasPrice", "gasUsed", "logIndex", "transactionIndex"], 16, columnar=False)
+
+    def parse_transaction_pages(self) -> int:
+        return self.parse_pages(self.transaction_pages, TRANSACTION_INTEGERS, 10, columnar=True)
+
+    def parse_transaction_pages_dicts(self) -> int:
+        return self.parse_pages(self.transaction_pages, TRANSACTION_INTEGERS, 10, columnar=False)
+
+    def fetch_logs(self) -> int:
+        return len(self.logs_client.request_contract_logs(CONTRACT_ADDRESS, 1, self.node.head_block))
+
+    def fetch_transactions(self) -> int:
+        return len(self.transactions_client.request_contract_transactions(CONTRACT_ADDRESS, 1, self.node.head_block))
+
+    def internal_transactions(self) -> int:
+        return len(self.internal_transactions_client.fetch_account_data(CONTRACT_ADDRESS, 1, self.node.head_block))
+
+    def token_transfers(self) -> int:
+        return len(self.token_transfers_client.fetch_account_data(CONTRACT_ADDRESS, 1, self.node.head_block))
+
+    def nft_transfers(self) -> int:
+        return len(self.nft_transfers_client.fetch_account_data(CONTRACT_ADDRESS, 1, self.node.head_block))
+
+    def token_transfers_sharded(self) -> int:
+        """Collect the token transfers with their block span split into shards paginated concurrently."""
+
+        end_block = int(self.transfers["tokentx"][-1]["blockNumber"])
+        return len(self.sharded_transfers_client.fetch_account_data(CONTRACT_ADDRESS, 1, end_block))
+
+    def fetch_logs_keys(self, n: int) -> int:
+        """Collect the logs with sharded pagination against an explorer limiting the requests per API key."""
+
+        end_block = int(self.raw_logs[-1]["blockNumber"], 16)
+        logs = self.key_clients[n].request_contract_logs(CONTRACT_ADDRESS, 1, end_block)
+        assert not self.key_clients[n].key_pool.report()["rate_limited"].any()
+        positions = [(int(log["blockNumber"], 16), int(log["logIndex"][2:] or "0", 16)) for log in logs]
+        assert positions == sorted(positions), "the logs of the shards aren't in the order of the chain"
+        return len(logs)
+
+    def fetch_logs_one_key(self) -> int:
+        return self.fetch_logs_keys(1)
+
+    def fetch_logs_four_keys(self) -> int:
+        return self.fetch_logs_keys(4)
+
+    def collect_logs(self) -> int:
+        """Collect, decode and format all the logs of the contract, to be compared with collect_logs_events."""
+
+        return len(self.logs_client.fetch_contract_logs(CONTRACT_ADDRESS, 1, self.node.head_block))
+
+    def collect_logs_events(self) -> int:
+        """Collect, decode and format the logs of two events only, filtered by the explorer on their topic0."""
+
+        data = self.logs_client.fetch_contract_logs(CONTRACT_ADDRESS, 1, self.node.head_block, events=EVENTS_FILTER)
+        topics = {"0x" + event_abi_to_log_topic(e).hex() for e in self.abi if e["type"] == "event" and e["name"] in EVENTS_FILTER}
+        assert len(data) == sum(log["topics"][0] in topics for log in self.raw_logs) and set(data["event_name"]) == set(EVENTS_FILTER)
+        return len(data)
+
+    def stream_state(self) -> int:
+        """Rebuild the states of the Ricochet streams users from all their events, by whole columns."""
+
+        engine = StreamStateEngine()
+        updates, distributions = engine.apply(flow_updates(self.stream_logs), distribution_events(self.stream_logs))
+        self.stream_states = engine.users
+        return len(updates) + len(distributions)
+
+    def stream_state_loop(self) -> int:
+        """Replay the Ricochet streams events row by row, like the modelling notebooks do, checking the states of stream_state."""
+
+        users, streams = dict(), dict()
+        for _, row in self.stream_logs.iterrows():
+            stream = streams.setdefault(row["address"], [0.0, 0.0])  # total rate, distribution index
+            if row["event_name"] == "Distribution":
+                stream[1] += float(row["decoded_data.totalAmount"]) / stream[0] if stream[0] > 0 else 0.0
+                continue
+            key = (row["address"], row["decoded_data.from"])
+            rate, timestamp, index, streamed, distributed = users.get(key, (0.0, row["timeStamp"], 0.0, 0.0, 0.0))
+            new_rate = float(row["decoded_data.newRate"])
+            users[key] = (new_rate, row["timeStamp"], stream[1], streamed + rate * (row["timeStamp"] - timestamp).total_seconds(), distributed + rate * (stream[1] - index))
+            stream[0] += new_rate - rate
+
+        if getattr(self, "stream_states", None) is not None:
+            expected = pd.DataFrame([(s, u, *state) for (s, u), state in users.items()], columns=["stream", "user", "rate", "time", "index", "streamed", "distributed"])
+            states = self.stream_states.merge(expected, on=["stream", "user"], suffixes=("", "_loop"))
+            assert len(states) == len(expected) == len(self.stream_states)
+            for column in ["rate", "streamed", "distributed"]:
+                assert np.allclose(states[column], states[f"{column}_loop"], rtol=1e-9), column
+        return len(self.stream_logs)
+
+    def stream_state_incremental(self) -> int:
+        """Apply the last 1% of the Ricochet streams events on top of the checkpoint of the first 99%."""
+
+        engine = StreamStateEngine.load(os.path.join(self.workdir, "stream_state"))
+        logs = self.stream_logs.iloc[self.stream_split :]
+        updates, distributions = engine.apply(flow_updates(logs), distribution_events(logs))
+        return len(updates) + len(distributions)
+
+    def record_replay(self) -> int:
+        """Record a collection against dedicated mock servers, then replay it offline once the servers are stopped.
+
+        The span ends at the head of the node, hence the pages of its last blocks aren't final: they are only stored
+        because the collection is recorded, the pages of the finalized blocks being flagged immutable.
+        """
+
+        logs = self.raw_logs[: self.args.replay_logs]
+        head = int(logs[-1]["blockNumber"], 16)
+        transactions = [tx for tx in self.raw_transactions if int(tx["blockNumber"]) <= head]
+        explorer = MockExplorer(abis={CONTRACT_ADDRESS: self.abi}, transactions={CONTRACT_ADDRESS: transactions}, logs={CONTRACT_ADDRESS: logs})
+        node = MockJsonRpcNode(head_block=head)
+        workdir = tempfile.mkdtemp(dir=self.workdir)
+        cache_path, config_path = os.path.join(workdir, "responses.sqlite"), os.path.join(workdir, "evm.yaml")
+
+        with explorer, node:
+            with open(config_path, "w") as file:
+                yaml.safe_dump({"replay": {"NODE_URL": node.url, "API_URL": explorer.url + "api?", "FINALITY_DEPTH": 64}}, file)
+            # the clients connect to the node when created, hence the replaying ones are created before stopping it
+            clients = dict()
+            for mode in ("record", "replay"):
+                clients[mode] = ContractEventLogs("replay", config_path=config_path), ContractTransactions("replay", config_path=config_path)
+                for client in clients[mode]:
+                    client.response_cache = ResponseCache(cache_path, mode=mode)
+            recorded_logs = clients["record"][0].fetch_contract_logs(CONTRACT_ADDRESS, 1, head)
+            recorded_transactions = clients["record"][1].fetch_contract_transactions(CONTRACT_ADDRESS, 1, head)
+            requests = sum(explorer.requests.values())
+
+        replayed_logs = clients["replay"][0].fetch_contract_logs(CONTRACT_ADDRESS, 1, head)
+        replayed_transactions = clients["replay"][1].fetch_contract_transactions(CONTRACT_ADDRESS, 1, head)
+        pd.testing.assert_frame_equal(replayed_logs, recorded_logs)
+        pd.testing.assert_frame_equal(replayed_transactions, recorded_transactions)
+        assert sum(explorer.requests.values()) == requests, "the replay sent requests to the explorer"
+
+        # the pages of the span are only immutable up to the last finalized block
+        store = clients["replay"][0].response_cache.connection
+        flags = dict(store.execute("SELECT immutable, COUNT(*) FROM responses WHERE method = 'logs.getLogs' GROUP BY immutable").fetchall())
+        assert flags.get(0) and flags.get(1), f"expected finalized and unfinalized logs pages, got {flags}"
+        try:
+            clients["replay"][0].request_contract_logs(CONTRACT_ADDRESS, head + 1, head + 1_000)
+            raise AssertionError("a response missing from the store was replayed")
+        except LookupError:
+            pass
+        return len(replayed_logs) + len(replayed_transactions)
+
+    def decode_logs(self) -> int:
+        logs = [dict(log, topics=list(log["topics"])) for log in self.raw_logs]
+        self.decoded_logs = self.logs_client.decode_contract_logs_data(logs, self.abi_events)
+        return len(self.decoded_logs)
+
+    def format_logs(self) -> int:
+        return len(self.logs_client.format_contract_logs_data(self.decoded_logs))
+
+    def token_logs_decoding(self) -> int:
+        """Decode and format ERC-20 Transfer and Approval logs, which are decoded by whole columns without their ABI."""
+
+        logs = [dict(log, topics=list(log["topics"])) for log in self.token_logs]
+        return len(self.logs_client.format_contract_logs_data(self.logs_client.decode_contract_logs_data(logs, dict())))
+
+    def decode_transactions(self) -> int:
+        transactions = [dict(tx) for tx in self.raw_transactions]
+        self.decoded_transactions = self.transactions_client.decode_contract_transactions_input(transactions, self.contract_instance)
+        return len(self.decoded_transactions)
+
+    def format_transactions(self) -> int:
+        self.formatted_transactions = self.transactions_client.format_contract_transactions_input(self.decoded_transactions)
+        return len(self.formatted_transactions)
+
+    def frame_memory_strings(self) -> int:
+        """Convert the categorical columns of the formatted transactions back to strings, the peak memory being the size of the frame.
+
+        Each value gets its own string object, like in the frames built from the parsed payloads.
+        """
+
+        categories = self.formatted_transactions.select_dtypes("category").columns
+        self.string_transactions = self.formatted_transactions.astype({column: str for column in categories})
+        return len(self.string_transactions)
+
+    def frame_memory_categorical(self) -> int:
+        return len(self.formatted_transactions.copy(deep=True))
+
+    def groupby_strings(self) -> int:
+        return len(self.string_transactions.groupby(["from", "function_called"]).size())
+
+    def groupby_categorical(self) -> int:
+        return len(self.formatted_transactions.groupby(["from", "function_called"], observed=True).size())
+
+    def groupby_address_ids(self) -> int:
+        """Group the transactions by the int32 ids of their senders in the network address dictionary."""
+
+        ids = self.transactions_client.address_ids(self.formatted_transactions["from"])
+        return len(self.formatted_transactions.groupby([ids, self.formatted_transactions["function_called"].cat.codes]).size())
+
+    def neo4j_loaders(self) -> int:
+        model = Web3GraphModelling.TransactionBasedModelling()
+        model.session = RecordingSession()
+        transactions = self.formatted_transactions.rename(columns={"from": "from_", "to": "to_"})
+        model.create_blocks(transactions)
+        model.create_addresses(transactions)
+        model.create_transactions(transactions)
+        model.create_relationships(transactions)
+        return len(transactions)
+
+    def follow_logs(self) -> int:
+        """Follow the logs of blocks mined by batches on the mock chain, the last blocks of every other batch being reorganized."""
+
+        sink = ParquetLogSink(tempfile.mkdtemp(dir=self.workdir))
+        start_block = self.chain.head_block + 1
+        follower = LogFollower(self.follow_client, CONTRACT_ADDRESS, sink, start_block=start_block)
+        logs = self.raw_logs[: self.args.follow_blocks * 10]
+        blocks = [logs[i : i + 10] for i in range(0, len(logs), 10)]
+
+        for i in range(0, len(blocks), 20):
+            self.chain.mine(blocks[i : i + 20])
+            while follower.step() or follower.cursor <= follower.head:
+                pass
+            if i % 40 == 0:
+                # the last 5 blocks are replaced by 5 blocks of different logs
+                self.chain.reorg(5, blocks[i + 10 : i + 15])
+
+        while follower.step() or follower.cursor <= follower.head:
+            pass
+        canonical = sum(len(self.chain.logs.get(b, list())) for b in range(start_block, follower.head + 1))
+        rows = len(sink.read())
+        assert rows == canonical, f"{rows} logs followed for {canonical} canonical logs"
+        return rows
+
+    def sparse_chunks(self) -> list:
+        head = self.sparse_chain.head_block
+        return [(start, min(start + 999, head)) for start in range(1, head + 1, 1_000)]
+
+    def sparse_logs(self) -> int:
+        """Request the logs of the sparse contracts by spans of 1,000 blocks, like the runner units do."""
+
+        rows = 0
+        for start, end in self.sparse_chunks():
+            rows += sum(len(self.sparse_client.request_contract_logs(address, start, end) or list()) for address in self.sparse_contracts)
+        return rows
+
+    def sparse_logs_prefiltered(self) -> int:
+        """Request the logs of the sparse contracts by spans of 1,000 blocks, over their bloom candidate blocks only."""
+
+        rows, reports = 0, list()
+        for start, end in self.sparse_chunks():
+            prefilter = BloomPrefilter(self.sparse_client, self.sparse_contracts)
+            prefilter.scan(start, end)
+            rows += sum(len(prefilter.request_contract_logs(address, merge_gap=1_000)) for address in self.sparse_contracts)
+            reports.append(prefilter.report())
+
+        assert rows == self.sparse_logs_count, f"{rows} logs collected for {self.sparse_logs_count} emitted logs"
+        report = pd.concat(reports)
+        print(f"Bloom prefilter: {report['candidate_blocks'].sum()} candidate blocks, false positive rate {1 - report['blocks_with_logs'].sum() / report['candidate_blocks'].sum():.2%}")
+        return rows
+
+    def proxy_logs_history(self) -> int:
+        """Fetch and decode the logs of a proxy upgraded twice, with the ABI of its implementation at each log's block."""
+
+        client = ContractEventLogs("mock", config_path=self.logs_client_config)
+        data = client.fetch_contract_logs(PROXY_ADDRESS, 1, self.node.head_block)
+        history = client.request_implementation_history(PROXY_ADDRESS, 1, self.node.head_block)
+        undecoded = (data["event_name"] == "None").sum()
+        assert len(history) == len(self.proxy_ranges) and undecoded == 0, f"{len(history)} implementations resolved, {undecoded} logs undecoded"
+        return len(data)
+
+    def multicall_snapshot(self) -> int:
+        """Read the token balances of the holders at a final block, in a few aggregate3 calls."""
+
+        calls = [(TOKEN_ADDRESS, "balanceOf", (holder,)) for holder in self.holders]
+        snapshot = self.logs_client.request_state_snapshot(calls, block=self.node.head_block - 100, abi=BALANCE_OF_ABI)
+        expected = [i * 10**18 if i % 20 else None for i in range(len(self.holders))]
+        assert snapshot["result.balance"].tolist() == expected, "the decoded balances don't match the holders balances"
+        return len(snapshot)
+
+    def multicall_snapshot_failover(self) -> int:
+        """Read the balances snapshot through a pool whose best ranked node fails every request and next one is slow.
+
+        The pool is created with the client, hence its first requests fail over from the faulty node, and are hedged
+        from the slow node to the main one, the faulty node being then benched and the slow one ranked last.
+        """
+
+        client = ContractEventLogs("failover", config_path=self.logs_client_config)
+        calls = [(TOKEN_ADDRESS, "balanceOf", (holder,)) for holder in self.holders]
+        snapshot = client.request_state_snapshot(calls, block=self.node.head_block - 100, abi=BALANCE_OF_ABI)
+        expected = [i * 10**18 if i % 20 else None for i in range(len(self.holders))]
+        assert snapshot["result.balance"].tolist() == expected, "the decoded balances don't match the holders balances"
+
+        report = client.node_pool.report().set_index("endpoint")
+        faulty, main = [url.split("//")[-1].split("/")[0] for url in (self.faulty_node.url, self.node.url)]
+        assert report.loc[faulty, "failovers"] > 0 and report.loc[faulty, "benched"], "the faulty node wasn't failed over"
+        assert report.loc[main, "hedges"] > 0, "the requests to the slow node weren't hedged"
+        return len(snapshot)
+
+    def multicall_snapshot_pruned(self) -> int:
+        """Read the balances snapshot of a final block through pools having a pruned node, missing its state.
+
+        The pruned node, although faster, is only the fallback of the archive node, hence it isn't sent any state
+        request. When it comes first, its missing trie node errors are failed over to the main node, and it is benched.
+        """
+
+        calls = [(TOKEN_ADDRESS, "balanceOf", (holder,)) for holder in self.holders]
+        expected = [i * 10**18 if i % 20 else None for i in range(len(self.holders))]
+        pruned = self.pruned_node.url.split("//")[-1].split("/")[0]
+
+        pruned_calls = self.pruned_node.requests["eth_call"]
+        client = ContractEventLogs("pruned_fallback", config_path=self.logs_client_config)
+        snapshot = client.request_state_snapshot(calls, block=self.node.head_block - 1_000, abi=BALANCE_OF_ABI)
+        assert snapshot["result.balance"].tolist() == expected, "the decoded balances don't match the holders balances"
+        assert self.pruned_node.requests["eth_call"] == pruned_calls, "state requests were sent to the pruned fallback"
+
+        client = ContractEventLogs("pruned_first", config_path=self.logs_client_config)
+        snapshot = client.request_state_snapshot(calls, block=self.node.head_block - 1_000, abi=BALANCE_OF_ABI)
+        assert snapshot["result.balance"].tolist() == expected, "the decoded balances don't match the holders balances"
+        report = client.node_pool.report().set_index("endpoint")
+        assert report.loc[pruned, "failovers"] > 0 and report.loc[pruned, "benched"], "the state errors of the pruned node weren't failed over"
+        return 2 * len(snapshot)
+
+    def block_times(self) -> int:
+        """Index the timestamps of the sparse chain blocks, then look them up for a column of a million block numbers."""
+
+        index = BlockTimeIndex("sparse", tempfile.mkdtemp(dir=self.workdir))
+        head = self.sparse_chain.head_block
+        index.fill(self.sparse_client.node_pool, index.missing(1, head), final_block=head)
+        blocks = pd.Series(np.random.default_rng(1).integers(1, head + 1, 1_000_000))
+        timestamps = index.to_datetime(blocks)
+        assert timestamps.notna().all() and index.get(head) == self.sparse_chain.timestamps[head]
+        return head + len(blocks)
+
+    def solana_stake_snapshot(self) -> int:
+        return len(self.solana_client.get_delegators_snapshot(encoding="base64"))
+
+    stages = [
+        "parse_log_pages",
+        "parse_log_pages_dicts",
+        "parse_transaction_pages",
+        "parse_transaction_pages_dicts",
+        "fetch_logs",
+        "fetch_transactions",
+        "internal_transactions",
+        "token_transfers",
+        "nft_transfers",
+        "token_transfers_sharded",
+        "fetch_logs_one_key",
+        "fetch_logs_four_keys",
+        "collect_logs",
+        "collect_logs_events",
+        "record_replay",
+        "decode_logs",
+        "format_logs",
+        "token_logs_decoding",
+        "decode_transactions",
+        "format_transactions",
+        "frame_memory_strings",
+        "frame_memory_categorical",
+        "groupby_strings",
+        "groupby_categorical",
+        "groupby_address_ids",
+        "neo4j_loaders",
+        "follow_logs",
+        "sparse_logs",
+        "sparse_logs_prefiltered",
+        "proxy_logs_history",
+        "multicall_snapshot",
+        "multicall_snapshot_failover",
+        "multicall_snapshot_pruned",
+        "stream_state",
+        "stream_state_loop",
+        "stream_state_incremental",
+        "block_times",
+        "solana_stake_snapshot",
+    ]
+
+    def run_stage(self, name: str) -> dict:
+        """Run a stage twice, once for timing it and once under tracemalloc for measuring its peak memory."""
+
+        stage = getattr(self, name)
+        requests_before, explorer_requests_before = self.request_count(), self.explorer_request_count()
+        start = time.perf_counter()
+        rows = stage()
+        elapsed = time.perf_counter() - start
+        requests = self.request_count() - requests_before
+        explorer_requests = self.explorer_request_count() - explorer_requests_before
+
+        tracemalloc.start()
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return dict(stage=name, rows=rows, seconds=elapsed, rows_per_sec=rows / elapsed, peak_mib=peak / 2**20, requests=requests, explorer_requests=explorer_requests)
+
+
+def compare(results: pd.DataFrame, baseline: dict, tolerance: float) -> pd.DataFrame:
+    """Compare the results against a baseline, flagging the throughput and memory regressions."""
+
+    baseline = pd.DataFrame.from_dict(baseline, orient="index")
+    results = results.join(baseline[["rows_per_sec", "peak_mib"]], on="stage", rsuffix="_baseline")
+    results["throughput_change"] = results["rows_per_sec"] / results["rows_per_sec_baseline"] - 1
+    results["memory_change"] = results["peak_mib"] / results["peak_mib_baseline"] - 1
+    results["regression"] = (results["throughput_change"] < -tolerance) | (results["memory_change"] > tolerance)
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="+", default=Benchmark.stages, choices=Benchmark.stages)
+    parser.add_argument("--logs", type=int, default=100_000)
+    parser.add_argument("--transactions", type=int, default=100_000)
+    parser.add_argument("--transfers", type=int, default=100_000, help="number of rows of each explorer transfers dataset")
+    parser.add_argument("--stake-accounts", type=int, default=100_000)
+    parser.add_argument("--follow-blocks", type=int, default=500, help="number of blocks of 10 logs mined for the follow_logs stage")
+    parser.add_argument("--sparse-contracts", type=int, default=20, help="number of contracts of the sparse_logs stages")
+    parser.add_argument("--sparse-blocks", type=int, default=20_000, help="number of blocks of the sparse_logs stages")
+    parser.add_argument("--sparse-rate", type=float, default=0.0005, help="probability that a sparse contract emits a log in a block")
+    parser.add_argument("--bloom-noise", type=int, default=150, help="number of random bits set in the sparse chain blooms")
+    parser.add_argument("--proxy-logs", type=int, default=30_000, help="number of logs of the proxy_logs_history stage")
+    parser.add_argument("--replay-logs", type=int, default=10_000, help="number of logs of the record_replay stage")
+    parser.add_argument("--stream-logs", type=int, default=500_000, help="number of Ricochet streams events of the stream_state stages")
+    parser.add_argument("--snapshot-calls", type=int, default=20_000, help="number of balanceOf calls of the multicall_snapshot stage")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency (in seconds) added by the mock servers")
+    parser.add_argument("--slow-latency", type=float, default=0.5, help="latency (in seconds) of the slow node of the multicall_snapshot_failover stage")
+    parser.add_argument("--hedge-after", type=float, default=0.05, help="delay (in seconds) after which the reads of the failover network are hedged")
+    parser.add_argument("--rate-limit", type=float, default=None, help="explorer rate limit (requests per second)")
+    parser.add_argument("--key-rate-limit", type=float, default=10, help="explorer rate limit per API key of the fetch_logs_keys stages")
+    parser.add_argument("--baseline", help="baseline results to compare against")
+    parser.add_argument("--save-baseline", help="path where to save the results as a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--metrics", help="path where to write the collected metrics, in the Prometheus text format")
+    args = parser.parse_args()
+
+    # Stages depend on the outputs of their predecessors
+    stages = [s for s in Benchmark.stages if s in args.stages]
+    dependencies = {"format_logs": "decode_logs", "format_transactions": "decode_transactions", "neo4j_loaders": "format_transactions"}
+    dependencies.update({stage: "format_transactions" for stage in ["frame_memory_strings", "frame_memory_categorical", "groupby_categorical", "groupby_address_ids"]})
+    dependencies["groupby_strings"] = "frame_memory_strings"
+    dependencies["stream_state_loop"] = "stream_state"
+    while any(dependencies.get(s) and dependencies[s] not in stages for s in stages):
+        stages = sorted(set(stages) | {dependencies[s] for s in stages if s in dependencies}, key=Benchmark.stages.index)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        benchmark = Benchmark(args, workdir)
+        try:
+            results = pd.DataFrame([benchmark.run_stage(stage) for stage in stages])
+        finally:
+            benchmark.close()
+
+    if args.baseline:
+        results = compare(results, json.load(open(args.baseline)), args.tolerance)
+
+    with pd.option_context("display.width", 200, "display.max_columns", 20, "display.float_format", "{:,.2f}".format):
+        print(results.to_string(index=False))
+
+    if args.metrics:
+        metrics.write_prometheus(args.metrics)
+
+    if args.save_baseline:
+        json.dump(results.set_index("stage")[["rows", "rows_per_sec", "peak_mib", "requests", "explorer_requests"]].to_dict(orient="index"), open(args.save_baseline, "w"), indent=2)
+
+    if args.baseline and results["regression"].any():
+        sys.exit(1)
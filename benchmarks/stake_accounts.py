@@ -0,0 +1,100 @@
+"""Benchmark the parsing of getProgramAccounts stake accounts, jsonParsed vs base64 encodings.
+
+Usage: python benchmarks/stake_accounts.py --accounts 200000
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(dir_path, os.pardir, "solana-network", "solana-staking"))
+
+from staking_extraction import STAKE_ACCOUNT_DTYPE, STAKE_STATE_DELEGATED, U64_MAX, decode_stake_accounts, encode_pubkeys, parse_stake_accounts
+
+
+def generate_stake_accounts(n_accounts: int, n_validators: int = 2_000, seed: int = 0) -> tuple:
+    """Generate the same synthetic stake accounts in both the base64 and jsonParsed encodings."""
+
+    rng = np.random.default_rng(seed)
+    records = np.zeros(n_accounts, dtype=STAKE_ACCOUNT_DTYPE)
+    validators = rng.integers(0, 256, size=(n_validators, 32), dtype=np.uint8)
+
+    records["state"] = STAKE_STATE_DELEGATED
+    records["rentExemptReserve"] = 2_282_880
+    records["staker"] = rng.integers(0, 256, size=(n_accounts, 32), dtype=np.uint8).view("V32").ravel()
+    records["withdrawer"] = records["staker"]
+    records["custodian"] = np.zeros((n_accounts, 32), dtype=np.uint8).view("V32").ravel()
+    records["voter"] = validators[rng.integers(0, n_validators, size=n_accounts)].view("V32").ravel()
+    records["stake"] = rng.integers(10**9, 10**15, size=n_accounts, dtype=np.uint64)
+    records["activationEpoch"] = rng.integers(0, 350, size=n_accounts, dtype=np.uint64)
+    records["deactivationEpoch"] = np.where(rng.random(n_accounts) < 0.9, U64_MAX, np.uint64(350))
+    records["warmupCooldownRate"] = 0.25
+    records["creditsObserved"] = rng.integers(0, 10**8, size=n_accounts, dtype=np.uint64)
+
+    raw = records.tobytes()
+    pubkeys = encode_pubkeys(records["staker"])
+    base64_accounts, json_accounts = list(), list()
+
+    for i, record in enumerate(records):
+        account = {"lamports": int(record["stake"]) + 2_282_880, "rentEpoch": 350, "executable": False, "owner": "Stake11111111111111111111111111111111111111"}
+        data = base64.b64encode(raw[i * STAKE_ACCOUNT_DTYPE.itemsize : (i + 1) * STAKE_ACCOUNT_DTYPE.itemsize]).decode()
+        base64_accounts.append({"pubkey": pubkeys[i], "account": dict(account, data=[data, "base64"])})
+
+        parsed = {
+            "meta": {
+                "authorized": {"staker": pubkeys[i], "withdrawer": pubkeys[i]},
+                "lockup": {"custodian": "11111111111111111111111111111111", "epoch": 0, "unixTimestamp": 0},
+                "rentExemptReserve": "2282880",
+            },
+            "stake": {
+                "creditsObserved": int(record["creditsObserved"]),
+                "delegation": {
+                    "activationEpoch": str(record["activationEpoch"]),
+                    "deactivationEpoch": str(record["deactivationEpoch"]),
+                    "stake": str(record["stake"]),
+                    "voter": pubkeys[i],
+                    "warmupCooldownRate": 0.25,
+                },
+            },
+        }
+        json_accounts.append({"pubkey": pubkeys[i], "account": dict(account, data={"program": "stake", "parsed": {"info": parsed, "type": "delegated"}})})
+
+    return base64_accounts, json_accounts
+
+
+def measure(function, accounts: list, repeat: int) -> tuple:
+    """Return the best wall time of a parsing function over a number of runs.
+
+    The accounts are serialized as a getProgramAccounts response body beforehand, so that the timings include
+    the JSON decoding of the payload, which is much larger with the jsonParsed encoding.
+    """
+
+    body = json.dumps({"jsonrpc": "2.0", "result": accounts, "id": 1})
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(json.loads(body).get("result"))
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(body)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    base64_accounts, json_accounts = generate_stake_accounts(args.accounts)
+
+    for name, function, accounts in [
+        ("jsonParsed", parse_stake_accounts, json_accounts),
+        ("base64", decode_stake_accounts, base64_accounts),
+    ]:
+        elapsed, size = measure(function, accounts, args.repeat)
+        print(f"{name:>10}: {elapsed:8.3f}s  {args.accounts / elapsed:12,.0f} accounts/s  {size / 2**20:8.1f} MiB payload")
@@ -0,0 +1,126 @@
+import fcntl
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+# The addresses are stored as fixed width lines, so that the id of an address is the offset of its line
+LINE_BYTES = 43
+
+
+def is_address_serie(serie: pd.Series, sample: int = 64) -> bool:
+    """Whether a column holds 0x prefixed 20 bytes addresses, from a sample of its values."""
+
+    values = serie.head(sample).dropna()
+    return len(values) > 0 and all(isinstance(v, str) and len(v) == 42 and v[:2] == "0x" for v in values)
+
+
+class AddressDictionary:
+    """A dictionary interning the addresses of a network into int32 ids, shared by its pipelines.
+
+    The ids are assigned in the order the addresses are first seen, and stored as fixed width lines in an append
+    only file, so that they are stable across runs and processes: the addresses appended by other processes are
+    loaded before new ones are appended, under a file lock. The address columns of the collected frames are
+    encoded as categoricals whose categories are ordered by id, and can be mapped to their ids by their
+    categories only, for joining and grouping them as integers.
+
+    Args:
+        network (str): The network of the addresses.
+        directory (str): The directory of the dictionary files, defaults to the WEB3_ADDRESS_DICTIONARY_DIR
+            environment variable or ~/.cache/web3/addresses.
+    """
+
+    _dictionaries, _dictionaries_lock = dict(), threading.Lock()
+
+    def __init__(self, network: str, directory: str = None):
+
+        self.network = network
+        directory = directory or os.environ.get("WEB3_ADDRESS_DICTIONARY_DIR", os.path.expanduser("~/.cache/web3/addresses"))
+        self.path = os.path.join(directory, f"{network}.addresses")
+        self.ids = dict()
+        self.addresses = list()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, network: str) -> "AddressDictionary":
+        """Get the dictionary of a network, creating it on first use."""
+
+        with cls._dictionaries_lock:
+            if network not in cls._dictionaries:
+                cls._dictionaries[network] = cls(network)
+            return cls._dictionaries[network]
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def load(self):
+        """Load the addresses appended to the file since the last load."""
+
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(len(self.addresses) * LINE_BYTES)
+            content = f.read()
+        lines = content[: len(content) - len(content) % LINE_BYTES].decode("ascii").splitlines()
+        self.ids.update(zip(lines, range(len(self.addresses), len(self.addresses) + len(lines))))
+        self.addresses += lines
+
+    def intern(self, addresses) -> np.ndarray:
+        """Get the ids of distinct addresses, the addresses seen for the first time being appended to the dictionary.
+
+        Args:
+            addresses (list(str)): Distinct addresses, whatever their case.
+
+        Returns:
+            np.ndarray: The int32 ids of the addresses, -1 for the values which aren't addresses.
+        """
+
+        addresses = [str(address).lower() for address in addresses]
+        with self.lock:
+            missing = [address for address in addresses if address not in self.ids and len(address) == 42 and address[:2] == "0x"]
+            if missing:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                with open(self.path + ".lock", "w") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    self.load()
+                    missing = [address for address in missing if address not in self.ids]
+                    with open(self.path, "ab") as f:
+                        f.write("".join(f"{address}\n" for address in missing).encode("ascii"))
+                self.ids.update(zip(missing, range(len(self.addresses), len(self.addresses) + len(missing))))
+                self.addresses += missing
+            return np.array([self.ids.get(address, -1) for address in addresses], dtype=np.int32)
+
+    def encode(self, serie: pd.Series) -> np.ndarray:
+        """Get the ids of a column of addresses, whatever their case, -1 standing for the missing values.
+
+        Only the distinct values are interned, hence categorical columns are mapped by their categories only.
+        """
+
+        codes, uniques = pd.factorize(serie)
+        ids = self.intern(uniques)
+        return np.where(codes >= 0, ids[codes], -1).astype(np.int32)
+
+    def decode(self, ids) -> np.ndarray:
+        """Get the lowercase addresses of an array of ids."""
+
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) and ids.max() >= len(self.addresses):
+            with self.lock:
+                self.load()
+        return np.asarray(self.addresses, dtype=object)[ids]
+
+    def categorical(self, serie: pd.Series) -> pd.Series:
+        """Encode a column of addresses as a categorical, whose categories are ordered by their ids.
+
+        The values which aren't addresses (empty strings) are kept as categories, after the addresses.
+        """
+
+        codes, uniques = pd.factorize(serie)
+        ids = self.intern(uniques).astype(np.int64)
+        order = np.argsort(np.where(ids >= 0, ids, np.iinfo(np.int64).max), kind="stable")
+        positions = np.empty(len(order), dtype=np.int64)
+        positions[order] = np.arange(len(order))
+        codes = np.where(codes >= 0, positions[codes], -1)
+        categorical = pd.Categorical.from_codes(codes, categories=pd.Index(np.asarray(uniques, dtype=object)[order], dtype=object))
+        return pd.Series(categorical, index=serie.index, name=serie.name)
@@ -0,0 +1,148 @@
+import fcntl
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from common.columnar import response_json
+from common.metrics import metrics
+
+
+class BlockTimeIndex:
+    """A block number to timestamp index of a network, stored as a dense memory-mapped uint32 array.
+
+    The timestamp of a block is stored at the offset of its number, 0 standing for an unknown block, so that
+    lookups are O(1) and whole block number columns are looked up at once. The file is mapped read-only by the
+    readers, the processes of a host sharing its pages, and grows by chunks as blocks are written. Only the
+    final blocks must be written, the timestamps of the blocks which can still be reorganized being able to change.
+
+    Args:
+        network (str): The network of the blocks.
+        directory (str): The directory of the index files, defaults to the WEB3_BLOCK_TIMES_DIR environment
+            variable or ~/.cache/web3/block_times.
+    """
+
+    # The file grows by chunks of 1M blocks (4 MiB), to avoid remapping it at every write
+    chunk_blocks = 1_000_000
+
+    def __init__(self, network: str, directory: str = None):
+
+        self.network = network
+        directory = directory or os.environ.get("WEB3_BLOCK_TIMES_DIR", os.path.expanduser("~/.cache/web3/block_times"))
+        self.path = os.path.join(directory, f"{network}.uint32")
+        self.lock = threading.Lock()
+        self._array = None
+
+    @property
+    def array(self) -> np.ndarray:
+        """The read-only mapping of the index file, which is remapped when another writer made it grow."""
+
+        size = os.path.getsize(self.path) // 4 if os.path.exists(self.path) else 0
+        if self._array is None or len(self._array) != size:
+            self._array = np.memmap(self.path, dtype=np.uint32, mode="r") if size else np.zeros(0, dtype=np.uint32)
+        return self._array
+
+    def __len__(self) -> int:
+        return len(self.array)
+
+    def get(self, block: int) -> int:
+        """Get the timestamp of a block, or None when it isn't indexed."""
+
+        array = self._array
+        if array is None or block >= len(array):
+            array = self.array
+        timestamp = int(array[block]) if block < len(array) else 0
+        return timestamp or None
+
+    def lookup(self, blocks) -> np.ndarray:
+        """Get the timestamps of an array of block numbers, 0 for the blocks which aren't indexed."""
+
+        blocks = np.asarray(blocks, dtype=np.int64)
+        array = self.array
+        timestamps = np.zeros(len(blocks), dtype=np.uint32)
+        indexed = blocks < len(array)
+        timestamps[indexed] = array[blocks[indexed]]
+        return timestamps
+
+    def to_datetime(self, blocks) -> pd.Series:
+        """Get the timestamps of a column of block numbers as datetimes, NaT for the blocks which aren't indexed."""
+
+        timestamps = pd.Series(self.lookup(blocks), index=blocks.index if isinstance(blocks, pd.Series) else None)
+        return pd.to_datetime(timestamps.where(timestamps > 0), unit="s")
+
+    def grow(self, size: int):
+        """Grow the index file to hold at least size blocks, under a file lock shared with the other processes."""
+
+        size = -(-size // self.chunk_blocks) * self.chunk_blocks
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.path, "ab") as f:
+                if f.tell() < size * 4:
+                    f.truncate(size * 4)
+
+    def write(self, blocks, timestamps):
+        """Store the timestamps of a list of blocks, which must be final."""
+
+        blocks, timestamps = np.asarray(blocks, dtype=np.int64), np.asarray(timestamps, dtype=np.uint32)
+        if not len(blocks):
+            return
+        first, last = int(blocks.min()), int(blocks.max())
+        with self.lock:
+            if last >= len(self.array):
+                self.grow(last + 1)
+        span = np.memmap(self.path, dtype=np.uint32, mode="r+", offset=first * 4, shape=(last - first + 1,))
+        span[blocks - first] = timestamps
+        span.flush()
+        del span
+
+    def request_headers(self, node_pool, blocks: list) -> tuple:
+        """Request the timestamps of a batch of blocks to a node pool, returning the blocks and their timestamps."""
+
+        batch = [{"jsonrpc": "2.0", "id": i, "method": "eth_getBlockByNumber", "params": [hex(int(block)), False]} for i, block in enumerate(blocks)]
+        responses = sorted(response_json(node_pool.post(json=batch)), key=lambda r: r["id"])
+        errors = [r["error"] for r in responses if "error" in r]
+        if errors:
+            raise ConnectionError(f"The node failed answering {len(errors)} header requests. ERROR: {errors[0]}")
+        missing = [blocks[r["id"]] for r in responses if r.get("result") is None]
+        if missing:
+            raise ConnectionError(f"The node doesn't have the blocks {missing[:5]} yet.")
+        return np.asarray(blocks, dtype=np.int64), np.array([int(r["result"]["timestamp"], 16) for r in responses], dtype=np.uint32)
+
+    def fill(self, node_pool, blocks, final_block: int, batch_size: int = 500, max_workers: int = 4) -> tuple:
+        """Request the timestamps of blocks by batches of headers, storing the ones of the final blocks.
+
+        Args:
+            node_pool (EndpointPool): The pool of nodes of the network.
+            blocks (list): The block numbers to request.
+            final_block (int): The last final block, the blocks after it being requested but not stored.
+            batch_size (int): The number of headers requested per batch.
+            max_workers (int): The number of batches requested concurrently.
+
+        Returns:
+            tuple(np.ndarray): The requested blocks and their timestamps.
+        """
+
+        blocks = np.asarray(blocks, dtype=np.int64)
+        if not len(blocks):
+            return blocks, np.zeros(0, dtype=np.uint32)
+
+        def fill_batch(batch: np.ndarray) -> tuple:
+            batch, timestamps = self.request_headers(node_pool, batch)
+            final = batch <= final_block
+            self.write(batch[final], timestamps[final])
+            return batch, timestamps
+
+        with metrics.span("fetch", network=self.network, dataset="block_times"):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(fill_batch, [blocks[i : i + batch_size] for i in range(0, len(blocks), batch_size)]))
+        metrics.inc("rows_total", len(blocks), stage="fetch", network=self.network, dataset="block_times")
+        return np.concatenate([batch for batch, _ in results]), np.concatenate([timestamps for _, timestamps in results])
+
+    def missing(self, start_block: int, end_block: int) -> np.ndarray:
+        """The blocks of a span which aren't indexed yet."""
+
+        blocks = np.arange(start_block, end_block + 1, dtype=np.int64)
+        return blocks[self.lookup(blocks) == 0]
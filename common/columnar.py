@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the payloads are then parsed by the standard library
+    orjson = None
+
+
+def loads(content):
+    """Parse a JSON payload, with orjson when it is installed."""
+
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+
+def response_json(response):
+    """Parse the JSON payload of an HTTP response, once per response.
+
+    The payload is kept on the response, since the pools parse the responses for detecting the errors returned
+    with a 200 status, before their callers parse them again.
+    """
+
+    payload = getattr(response, "_payload", None)
+    if payload is None:
+        payload = response._payload = loads(response.content)
+    return payload
+
+
+def parse_integers(values, base: int = 10) -> np.ndarray:
+    """Parse decimal, or 0x prefixed hex, strings into an array of integers.
+
+    The decimal strings are cast at once by NumPy, and the hex strings parsed in a single comprehension, both
+    being several times faster than mapping a Python function over a pandas Serie. The arrays holding values
+    which don't fit 64 bits integers (uint256 amounts) or empty values are parsed one by one instead.
+
+    Args:
+        values (list | np.ndarray | pd.Series): The strings.
+        base (int): 10 for decimal strings, 16 for hex strings.
+
+    Returns:
+        np.ndarray: The values as 64 bits integers, or as Python integers (None for the empty values) when they
+            can't all be parsed into 64 bits integers.
+    """
+
+    values = np.asarray(values, dtype=object)
+    try:
+        if base == 10:
+            return values.astype(np.int64)
+        return np.array([int(value, base) for value in values], dtype=np.int64)
+    except (ValueError, TypeError, OverflowError):
+        return np.array([int(value, base) if value not in (None, "", "0x") else None for value in values], dtype=object)
+
+
+def page_to_frame(rows: list, integers: list = (), base: int = 10) -> pd.DataFrame:
+    """Build a frame from the rows of explorer pages by whole columns, its integer fields being parsed at once.
+
+    Args:
+        rows (list(dict)): The rows.
+        integers (list(str)): The fields holding integers, which are parsed with parse_integers.
+        base (int): The base of the integer fields.
+
+    Returns:
+        pd.DataFrame: The rows, their integer fields being 64 bits integers or objects (see parse_integers).
+    """
+
+    columns = dict()
+    for field in dict.fromkeys(field for row in rows for field in row):
+        values = [row.get(field) for row in rows]
+        columns[field] = parse_integers(values, base) if field in integers else values
+    return pd.DataFrame(columns)
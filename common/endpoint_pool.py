@@ -0,0 +1,259 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import requests
+
+from common.columnar import response_json
+from common.metrics import metrics
+
+logger = logging.getLogger()
+
+# Upper bounds (in seconds) of the buckets of the per endpoint latency histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+# JSON-RPC error codes returned by providers when a request is rate limited or times out on their side. The generic
+# internal error (-32603) isn't one of them: it is mostly deterministic (reverts, oversized responses), and is
+# returned to the caller with the node message rather than failed over.
+RETRYABLE_RPC_ERRORS = {-32005, 429}
+
+# Messages of the errors returned by the nodes which don't have the state of a block (pruned nodes, or nodes behind
+# the head), the request having to be sent to another node of the pool
+STATE_ERROR_MESSAGES = ("missing trie node", "header not found", "state is not available", "pruned")
+
+# Error rate above which an endpoint is ranked behind the healthy ones
+UNHEALTHY_ERROR_RATE = 0.5
+
+
+class EndpointError(Exception):
+    """A request to an endpoint failed and can be retried against another endpoint."""
+
+
+def is_retryable_response(response: requests.Response) -> bool:
+    """Whether an HTTP response is an endpoint side failure (rate limit or server error)."""
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def is_state_error(error: dict) -> bool:
+    """Whether a JSON-RPC error tells that the node doesn't have the state of the requested block."""
+
+    return any(message in str(error.get("message")).lower() for message in STATE_ERROR_MESSAGES)
+
+
+def is_retryable_rpc_response(response: requests.Response) -> bool:
+    """Whether a JSON-RPC response is an endpoint side failure, including errors returned with a 200 status.
+
+    The errors of the nodes missing the state of a block are failures of the endpoint as well, another node of the
+    pool (an archive node) being able to answer.
+    """
+
+    if is_retryable_response(response):
+        return True
+    try:
+        payload = response_json(response)
+    except ValueError:
+        return True
+    payloads = payload if isinstance(payload, list) else [payload]
+    errors = [p["error"] for p in payloads if isinstance(p, dict) and p.get("error")]
+    return any(error.get("code") in RETRYABLE_RPC_ERRORS or is_state_error(error) for error in errors)
+
+
+class Endpoint:
+    """An endpoint of a pool, with its health statistics.
+
+    The latency and error rate are tracked as exponentially weighted moving averages, so that the endpoint
+    score quickly reflects a degradation. Failing endpoints are benched for an exponentially increasing period.
+    The requests failed over from the endpoint, and the ones hedged to it, are counted as well.
+    """
+
+    def __init__(self, url: str, name: str = None):
+
+        self.url = url
+        self.name = name or url.split("//")[-1].split("/")[0]
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests, self.errors, self.consecutive_errors = 0, 0, 0
+        self.failovers, self.hedges = 0, 0
+        self.benched_until = 0.0
+        self.histogram = np.zeros(len(LATENCY_BUCKETS), dtype=np.int64)
+        self._session = None
+
+    @property
+    def session(self) -> requests.Session:
+        """The HTTP session of the endpoint, created on first use."""
+
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+
+    @property
+    def healthy(self) -> bool:
+        """Whether the endpoint isn't benched, and fails less than UNHEALTHY_ERROR_RATE of its requests."""
+
+        return time.time() >= self.benched_until and self.error_rate < UNHEALTHY_ERROR_RATE
+
+    @property
+    def score(self) -> float:
+        """The lower the better: the latency penalized by the error rate, benched endpoints coming last."""
+
+        if time.time() < self.benched_until:
+            return float("inf")
+        return (self.latency or 0.0) * (1 + 10 * self.error_rate)
+
+    def record(self, latency: float, success: bool, alpha: float = 0.2, cooldown: float = 5.0):
+        self.requests += 1
+        self.histogram[np.searchsorted(LATENCY_BUCKETS, latency)] += 1
+        self.latency = latency if self.latency is None else (1 - alpha) * self.latency + alpha * latency
+        self.error_rate = (1 - alpha) * self.error_rate + alpha * (0.0 if success else 1.0)
+
+        if success:
+            self.consecutive_errors = 0
+        else:
+            self.errors += 1
+            self.consecutive_errors += 1
+            self.benched_until = time.time() + min(cooldown * 2 ** (self.consecutive_errors - 1), 300)
+
+    def quantile(self, q: float) -> float:
+        """Approximate a latency quantile with the upper bound of the histogram bucket it falls in."""
+
+        if not self.requests:
+            return None
+        return LATENCY_BUCKETS[int(np.searchsorted(np.cumsum(self.histogram), q * self.requests))]
+
+
+class EndpointPool:
+    """A pool of equivalent HTTP endpoints (RPC nodes of a same network, for instance), with automatic failover.
+
+    The requests are sent to the endpoints in their configured order, failing over to the next ones on connection
+    errors, timeouts, rate limits or server errors, so that the fallbacks (public nodes, which may be pruned) are
+    only used when the first ones fail. The failing endpoints are benched, and ranked behind the healthy ones by
+    their health score. Idempotent requests can also be hedged: if the first endpoint hasn't answered after
+    hedge_after seconds, the request is also sent to the next one and the first successful answer wins.
+    """
+
+    def __init__(self, urls: list, name: str = "pool", timeout: float = 30, hedge_after: float = None, is_retryable=is_retryable_response):
+
+        self.name = name
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.is_retryable = is_retryable
+        self.lock = threading.Lock()
+        self._executor = None
+
+        if not self.endpoints:
+            raise AssertionError(f"The endpoint pool {name} needs at least one endpoint.")
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=2 * len(self.endpoints), thread_name_prefix=self.name)
+        return self._executor
+
+    def ranked(self) -> list:
+        """List the healthy endpoints in their configured order, then the unhealthy ones by their health score."""
+
+        with self.lock:
+            return sorted(self.endpoints, key=lambda e: (0.0, self.endpoints.index(e)) if e.healthy else (1.0, e.score))
+
+    def send(self, endpoint: Endpoint, **kwargs) -> requests.Response:
+        """Send a POST request to a given endpoint and record its outcome."""
+
+        start, response = time.perf_counter(), None
+        try:
+            response = endpoint.session.post(endpoint.url, timeout=self.timeout, **kwargs)
+            if self.is_retryable(response):
+                raise EndpointError(f"{endpoint.name} answered with status {response.status_code}: {response.text[:200]}")
+        except (requests.RequestException, EndpointError) as e:
+            with self.lock:
+                endpoint.record(time.perf_counter() - start, success=False)
+            status = response.status_code if response is not None else type(e).__name__
+            metrics.inc("http_requests_total", pool=self.name, endpoint=endpoint.name, status=status)
+            logger.warning(f"Request to {endpoint.name} failed, failing over. ERROR: {e}")
+            raise EndpointError(str(e)) from e
+
+        latency = time.perf_counter() - start
+        with self.lock:
+            endpoint.record(latency, success=True)
+        metrics.inc("http_requests_total", pool=self.name, endpoint=endpoint.name, status=response.status_code)
+        metrics.inc("http_response_bytes_total", len(response.content), pool=self.name, endpoint=endpoint.name)
+        metrics.observe("http_request_duration_seconds", latency, pool=self.name, endpoint=endpoint.name)
+        return response
+
+    def post(self, idempotent: bool = True, **kwargs) -> requests.Response:
+        """Send a POST request to the pool, the keyword arguments being passed to requests.
+
+        Raises:
+            ConnectionError: All the endpoints of the pool failed, with the error of the last one.
+        """
+
+        endpoints = self.ranked()
+        if idempotent and self.hedge_after is not None and len(endpoints) > 1:
+            return self.hedged_post(endpoints, **kwargs)
+
+        error = None
+        for endpoint in endpoints:
+            try:
+                return self.send(endpoint, **kwargs)
+            except EndpointError as e:
+                error = e
+                self.failed_over(endpoint)
+        raise ConnectionError(f"All the endpoints of the {self.name} pool failed. Last ERROR: {error}") from error
+
+    def hedged_post(self, endpoints: list, **kwargs) -> requests.Response:
+        """Send a request to the best endpoint, hedging it to the next ones when it is slow or fails."""
+
+        pending, remaining, error = dict(), list(endpoints), None
+        while remaining or pending:
+            if remaining:
+                endpoint = remaining.pop(0)
+                if pending:
+                    # the requests already sent are still running, this one is a hedge rather than a failover
+                    with self.lock:
+                        endpoint.hedges += 1
+                    metrics.inc("endpoint_hedges_total", pool=self.name)
+                pending[self.executor.submit(self.send, endpoint, **kwargs)] = endpoint
+            done, _ = wait(pending, timeout=self.hedge_after if remaining else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                endpoint = pending.pop(future)
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+                self.failed_over(endpoint)
+        raise ConnectionError(f"All the endpoints of the {self.name} pool failed. Last ERROR: {error}") from error
+
+    def failed_over(self, endpoint: Endpoint):
+        """Count a request failed over from an endpoint."""
+
+        with self.lock:
+            endpoint.failovers += 1
+        metrics.inc("endpoint_failovers_total", pool=self.name)
+
+    def report(self) -> pd.DataFrame:
+        """Report the health statistics and latency histogram of each endpoint of the pool."""
+
+        with self.lock:
+            data = pd.DataFrame(
+                [
+                    dict(
+                        pool=self.name,
+                        endpoint=e.name,
+                        requests=e.requests,
+                        errors=e.errors,
+                        failovers=e.failovers,
+                        hedges=e.hedges,
+                        error_rate=e.error_rate,
+                        latency_ewma=e.latency,
+                        latency_p50=e.quantile(0.5),
+                        latency_p90=e.quantile(0.9),
+                        latency_p99=e.quantile(0.99),
+                        benched=time.time() < e.benched_until,
+                        **{f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS, np.cumsum(e.histogram))},
+                    )
+                    for e in self.endpoints
+                ]
+            )
+        return data
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+
+import pandas as pd
+
+from common.metrics import metrics
+from common.rate_limit import TokenBucket
+
+logger = logging.getLogger()
+
+# Bench (in seconds) of a key the explorer reports as invalid, which won't be usable again before a while
+INVALID_KEY_BENCH = 3600
+
+
+def classify_explorer_payload(payload: dict) -> str:
+    """Classify an explorer answer as "ok", "rate_limited" (Max rate limit reached) or "invalid" (Invalid API Key)."""
+
+    if payload.get("status") != "0":
+        return "ok"
+    result = str(payload.get("result")).lower()
+    if "rate limit" in result:
+        return "rate_limited"
+    if "invalid api key" in result or "invalid api-key" in result:
+        return "invalid"
+    return "ok"
+
+
+class ApiKey:
+    """An API key of a pool, with its own rate budget and usage statistics.
+
+    The key is only exposed as its name (the network and its index) in the metrics and reports. Keys throttled
+    by the explorer are benched for an exponentially increasing period, and invalid keys for an hour.
+    """
+
+    def __init__(self, value: str, name: str, bucket=None):
+
+        self.value = value
+        self.name = name
+        self.bucket = bucket
+        self.requests, self.rate_limited, self.invalid, self.consecutive_errors = 0, 0, 0, 0
+        self.benched_until = 0.0
+
+    def record(self, status: str, cooldown: float = 5.0):
+        if status == "rate_limited":
+            self.rate_limited += 1
+            self.consecutive_errors += 1
+            self.benched_until = time.time() + min(cooldown * 2 ** (self.consecutive_errors - 1), 300)
+        elif status == "invalid":
+            self.invalid += 1
+            self.benched_until = time.time() + INVALID_KEY_BENCH
+        else:
+            self.consecutive_errors = 0
+
+
+class ApiKeyPool:
+    """A pool of the API keys of an explorer, each drawing from its own rate budget.
+
+    The explorers limit the requests per key, hence the throughput of a network grows with its number of keys.
+    Each request takes the least used of the keys having a token left, waiting for the first token to be
+    refilled when they are all exhausted, and the keys the explorer throttles or rejects are benched. The pools
+    are shared by name within a process, like the token buckets.
+
+    Args:
+        keys (list(str)): The API keys.
+        name (str): The name of the pool, the buckets of its keys being named <name>-<index>.
+        rate (float): The maximum number of requests per second of each key, None for no limit.
+        cooldown (float): The initial bench (in seconds) of a throttled key.
+    """
+
+    _pools, _pools_lock = dict(), threading.Lock()
+
+    def __init__(self, keys: list, name: str = "explorer", rate: float = None, cooldown: float = 5.0):
+
+        if not keys:
+            raise AssertionError(f"The key pool {name} needs at least one key.")
+
+        self.name = name
+        self.rate = rate
+        self.cooldown = cooldown
+        self.keys = [ApiKey(key, f"{name}-{i}", TokenBucket.shared(f"{name}-{i}", rate) if rate else None) for i, key in enumerate(keys)]
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, name: str, keys: list, rate: float = None) -> "ApiKeyPool":
+        """Get the pool of a given name, creating it on first use."""
+
+        with cls._pools_lock:
+            if name not in cls._pools:
+                cls._pools[name] = cls(keys, name, rate)
+            return cls._pools[name]
+
+    def use_buckets(self, factory):
+        """Replace the buckets of the keys, given a function building a bucket from its name and rate."""
+
+        if self.rate:
+            for key in self.keys:
+                key.bucket = factory(key.name, self.rate)
+
+    def acquire(self) -> ApiKey:
+        """Wait until a key which isn't benched has a token left, and consume it. Returns the key."""
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                available = sorted((k for k in self.keys if k.benched_until <= now), key=lambda k: k.requests)
+                delays = list()
+                for key in available:
+                    delay = key.bucket.try_acquire() if key.bucket is not None else 0.0
+                    if not delay:
+                        key.requests += 1
+                        break
+                    delays.append(delay)
+                else:
+                    key = None
+                    delay = min(delays) if delays else min(k.benched_until for k in self.keys) - now
+
+            if key is not None:
+                break
+            time.sleep(max(delay, 0.001))
+            waited += max(delay, 0.001)
+
+        if waited:
+            metrics.inc("rate_limit_wait_seconds_total", waited, bucket=self.name)
+        return key
+
+    def record(self, key: ApiKey, payload: dict) -> bool:
+        """Record the explorer answer to a request sent with a key. Returns whether the key was accepted."""
+
+        status = classify_explorer_payload(payload)
+        with self.lock:
+            key.record(status, self.cooldown)
+        metrics.inc("explorer_key_requests_total", pool=self.name, key=key.name, status=status)
+        if status != "ok":
+            logger.warning(f"The explorer answered {payload.get('result')} to the key {key.name}, benching it.")
+        return status == "ok"
+
+    def report(self) -> pd.DataFrame:
+        """Report the usage of each key of the pool."""
+
+        with self.lock:
+            data = pd.DataFrame(
+                [
+                    dict(
+                        pool=self.name,
+                        key=k.name,
+                        requests=k.requests,
+                        rate_limited=k.rate_limited,
+                        invalid=k.invalid,
+                        benched=time.time() < k.benched_until,
+                    )
+                    for k in self.keys
+                ]
+            )
+        return data
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    from opentelemetry import trace
+except ImportError:  # OpenTelemetry is optional, spans are then only recorded as histograms
+    trace = None
+
+# Upper bounds (in seconds) of the duration histograms buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, float("inf"))
+
+
+class MetricsRegistry:
+    """A registry of counters and histograms describing the collection pipelines activity.
+
+    Metrics are identified by a name and a set of labels (endpoint, status, stage...), and are cheap enough to be
+    recorded at the request, page or stage granularity in production. They can be exported in the Prometheus text
+    format, while the stages spans are also forwarded to OpenTelemetry when it is installed and WEB3_OTEL is set.
+    Setting WEB3_METRICS to "off" disables the recording altogether.
+    """
+
+    def __init__(self, prefix: str = "web3"):
+
+        self.prefix = prefix
+        self.enabled = os.environ.get("WEB3_METRICS", "on") != "off"
+        self.tracer = trace.get_tracer(__name__) if trace and os.environ.get("WEB3_OTEL") else None
+        self.counters = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment a counter."""
+
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Record an observation (a duration, in seconds) in a histogram."""
+
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [np.zeros(len(DURATION_BUCKETS), dtype=np.int64), 0.0, 0]
+            histogram = self.histograms[key]
+            histogram[0][np.searchsorted(DURATION_BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """Time a pipeline stage (fetch, decode, format, sink...), recording its duration and failures."""
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        otel_span = self.tracer.start_as_current_span(stage, attributes={k: str(v) for k, v in labels.items()}) if self.tracer else None
+        try:
+            if otel_span is not None:
+                with otel_span:
+                    yield
+            else:
+                yield
+        except Exception:
+            self.inc("stage_errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe("stage_duration_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    def snapshot(self) -> pd.DataFrame:
+        """Summarize the counters and histograms, one row per metric and set of labels."""
+
+        with self.lock:
+            rows = [dict(metric=name, value=value, **dict(labels)) for (name, labels), value in self.counters.items()]
+            rows += [dict(metric=name, value=total, count=count, **dict(labels)) for (name, labels), (_, total, count) in self.histograms.items()]
+        return pd.DataFrame(rows)
+
+    def to_prometheus(self) -> str:
+        """Export the metrics in the Prometheus text exposition format."""
+
+        def format_labels(labels: tuple, **extra) -> str:
+            labels = list(labels) + list(extra.items())
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+        lines = list()
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                lines += [f"{self.prefix}_{name}{format_labels(labels)} {value}" for (n, labels), value in self.counters.items() if n == name]
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {self.prefix}_{name} histogram")
+                for (n, labels), (buckets, total, count) in self.histograms.items():
+                    if n != name:
+                        continue
+                    for bound, cumulated in zip(DURATION_BUCKETS, np.cumsum(buckets)):
+                        lines.append(f"{self.prefix}_{name}_bucket{format_labels(labels, le='+Inf' if bound == float('inf') else bound)} {cumulated}")
+                    lines.append(f"{self.prefix}_{name}_sum{format_labels(labels)} {total}")
+                    lines.append(f"{self.prefix}_{name}_count{format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Write the metrics to a file, to be picked up by the node exporter textfile collector for instance."""
+
+        with open(path + ".tmp", "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(path + ".tmp", path)
+
+
+# The registry shared by all the collection modules
+metrics = MetricsRegistry()
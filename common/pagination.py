@@ -0,0 +1,125 @@
+import logging
+import queue
+import threading
+import time
+
+from common.metrics import metrics
+
+logger = logging.getLogger()
+
+
+class BlockPaginator:
+    """Paginate an explorer dataset over a block span, streaming its pages as they are received.
+
+    The explorers return the rows of a block span by ascending block number, truncated to the page size. The
+    next request starts at the last block of a full page, whose rows may have been truncated, hence the rows of
+    this last block are only kept from the next page, so that no row is collected twice. A block having more
+    rows than a page is paginated on its own with page numbers.
+
+    The span can be split into shards paginated concurrently, their pages being streamed as they arrive, so
+    that they can be processed while the next ones are requested.
+
+    Args:
+        request_page (callable): Requests a page, given its start block, end block and page number, and returns
+            the explorer payload.
+        page_size (int): The number of rows of a full page.
+        block_of (callable): Gets the block number of a row.
+        shards (int): The number of shards the span is split into.
+        retry_wait (float): The delay (in seconds) before requesting a page again, when the explorer answered an
+            error instead of a page (rate limit, timeout).
+        labels (dict): The labels of the metrics of the dataset.
+    """
+
+    def __init__(self, request_page, page_size: int, block_of, shards: int = 1, retry_wait: float = 3, labels: dict = None):
+
+        self.request_page = request_page
+        self.page_size = page_size
+        self.block_of = block_of
+        self.shards = shards
+        self.retry_wait = retry_wait
+        self.labels = labels or dict()
+
+    def request(self, start_block: int, end_block: int, page: int = 1) -> list:
+        """Request a page, until the explorer answers with rows (or an empty result)."""
+
+        while True:
+            payload = self.request_page(start_block, end_block, page)
+            result = payload.get("result")
+            if isinstance(result, list):
+                return result
+            logger.error(f"Failed request with ERROR: {result}. Trying again.")
+            metrics.inc("retry_wait_seconds_total", self.retry_wait, **self.labels)
+            time.sleep(self.retry_wait)
+
+    def paginate(self, start_block: int, end_block: int):
+        """Paginate a span of blocks.
+
+        Yields:
+            list(dict): The rows of each page, the rows of the truncated last block of a page being deferred.
+        """
+
+        while start_block <= end_block:
+            rows = self.request(start_block, end_block)
+            if len(rows) < self.page_size:
+                if rows:
+                    yield rows
+                return
+
+            blocks = [self.block_of(row) for row in rows]
+            last = max(blocks)
+            if min(blocks) == last:
+                # a block having more rows than a page is paginated with page numbers
+                yield rows
+                page = 1
+                while len(rows) >= self.page_size:
+                    page += 1
+                    rows = self.request(last, last, page)
+                    if rows:
+                        yield rows
+                start_block = last + 1
+            else:
+                yield [row for row, block in zip(rows, blocks) if block < last]
+                start_block = last
+
+    def spans(self, start_block: int, end_block: int) -> list:
+        """Split a span of blocks into the spans of the shards."""
+
+        size = max((end_block - start_block + 1) // self.shards, 1)
+        bounds = list(range(start_block, end_block + 1, size))[: self.shards]
+        return [(bound, next_bound - 1) for bound, next_bound in zip(bounds, bounds[1:] + [end_block + 1])]
+
+    def pages(self, start_block: int, end_block: int):
+        """Paginate a span of blocks, its shards being paginated concurrently.
+
+        Yields:
+            list(dict): The rows of each page, as soon as they are received. The pages of a shard are yielded in
+                order, but the pages of the shards are interleaved.
+        """
+
+        spans = self.spans(start_block, end_block)
+        if len(spans) == 1:
+            yield from self.paginate(start_block, end_block)
+            return
+
+        pages, done = queue.Queue(), object()
+
+        def paginate_shard(start: int, end: int):
+            try:
+                for page in self.paginate(start, end):
+                    pages.put(page)
+                pages.put(done)
+            except Exception as e:
+                pages.put(e)
+
+        for start, end in spans:
+            threading.Thread(target=paginate_shard, args=(start, end), daemon=True).start()
+
+        remaining = len(spans)
+        while remaining:
+            page = pages.get()
+            if page is done:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
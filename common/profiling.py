@@ -0,0 +1,178 @@
+import atexit
+import cProfile
+import datetime
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger()
+
+# The collectors enabled by a given profiling mode
+PROFILING_MODES = {
+    "cprofile": {"cprofile"},
+    "sample": {"sample"},
+    "memory": {"memory"},
+    "all": {"cprofile", "sample", "memory"},
+}
+
+
+class Profiler:
+    """Opt-in profiling of the decoding and formatting hot paths of the collectors.
+
+    The functions decorated with `profiled` are only profiled once profiling is enabled, either by the WEB3_PROFILE
+    environment variable or by `enable()`, the mode being a comma separated list of collectors (cprofile, sample,
+    memory) or "all" (also selected by "1"). When disabled, the decorated functions are called directly.
+
+    The profile artifacts of a run are written in WEB3_PROFILE_DIR (defaults to ~/.cache/web3/profiles) at exit:
+    - profile.pstats: the cProfile statistics of the profiled calls, to be read with pstats or snakeviz.
+    - stacks.collapsed: the stacks sampled during the profiled calls, in the collapsed format of flamegraph.pl.
+    - allocations.txt: the lines holding the most memory since profiling was enabled, from tracemalloc.
+    - timings.json: the number of calls and the cumulated wall time of each profiled function.
+    """
+
+    def __init__(self, mode: str = None, output_dir: str = None, interval: float = 0.005):
+
+        self.collectors = set()
+        self.output_dir = output_dir or os.environ.get("WEB3_PROFILE_DIR", os.path.expanduser("~/.cache/web3/profiles"))
+        self.interval = interval
+        self.run_id = f"{datetime.datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+
+        self.timings = dict()
+        self.stacks = Counter()
+        self.active_threads = dict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profile, self.profiled_thread = None, None
+        self.sampler, self.stopped = None, threading.Event()
+        self.registered = False
+
+        mode = mode or os.environ.get("WEB3_PROFILE")
+        if mode and mode not in ("0", "off"):
+            self.enable(mode)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.collectors)
+
+    def enable(self, mode: str = "all"):
+        """Enable the given collectors, the profile artifacts being written at exit."""
+
+        mode = "all" if mode in ("1", True) else mode
+        for name in str(mode).split(","):
+            if name not in PROFILING_MODES:
+                raise ValueError(f"Unknown profiling mode {name}, expected one of {list(PROFILING_MODES)}.")
+            self.collectors |= PROFILING_MODES[name]
+
+        if "cprofile" in self.collectors and self.profile is None:
+            self.profile = cProfile.Profile()
+        if "sample" in self.collectors and self.sampler is None:
+            self.sampler = threading.Thread(target=self.sample, name="profiler-sampler", daemon=True)
+            self.sampler.start()
+        if "memory" in self.collectors and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if not self.registered:
+            atexit.register(self.dump)
+            self.registered = True
+
+    def sample(self):
+        """Sample the stacks of the threads currently running a profiled function."""
+
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                threads = dict(self.active_threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            for thread_id in threads:
+                frame, stack = frames.get(thread_id), list()
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def __call__(self, func):
+        """Decorate a function so that its calls are profiled when profiling is enabled."""
+
+        name = func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.collectors:
+                return func(*args, **kwargs)
+
+            # Nested profiled calls are accounted for by the outermost one
+            depth = getattr(self.local, "depth", 0)
+            self.local.depth = depth + 1
+            outermost = depth == 0
+            thread_id = threading.get_ident()
+            profiling = False
+
+            if outermost:
+                with self.lock:
+                    self.active_threads[thread_id] = name
+                    # cProfile only profiles the thread enabling it, a single thread being profiled at a time
+                    if self.profile is not None and self.profiled_thread is None:
+                        self.profiled_thread, profiling = thread_id, True
+                if profiling:
+                    self.profile.enable()
+
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.local.depth = depth
+                if outermost:
+                    if profiling:
+                        self.profile.disable()
+                    with self.lock:
+                        self.active_threads.pop(thread_id, None)
+                        if profiling:
+                            self.profiled_thread = None
+                with self.lock:
+                    calls, total = self.timings.get(name, (0, 0.0))
+                    self.timings[name] = (calls + 1, total + elapsed)
+
+        return wrapper
+
+    def dump(self) -> str:
+        """Write the profile artifacts of the run, and return the directory they were written to."""
+
+        if not self.collectors or not self.timings:
+            return None
+        self.stopped.set()
+
+        path = os.path.join(self.output_dir, self.run_id)
+        os.makedirs(path, exist_ok=True)
+
+        with self.lock:
+            timings = {name: dict(calls=calls, seconds=total) for name, (calls, total) in self.timings.items()}
+        json.dump(timings, open(os.path.join(path, "timings.json"), "w"), indent=2)
+
+        if self.profile is not None:
+            self.profile.dump_stats(os.path.join(path, "profile.pstats"))
+
+        if self.stacks:
+            with open(os.path.join(path, "stacks.collapsed"), "w") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+        if "memory" in self.collectors and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            current, peak = tracemalloc.get_traced_memory()
+            with open(os.path.join(path, "allocations.txt"), "w") as f:
+                f.write(f"current: {current / 2**20:.2f} MiB, peak: {peak / 2**20:.2f} MiB\n\n")
+                f.writelines(f"{stat}\n" for stat in snapshot.statistics("lineno")[:50])
+
+        logger.info(f"Profile artifacts written to {path}")
+        return path
+
+
+# The profiler shared by the collection modules, to be used as a decorator
+profiled = Profiler()
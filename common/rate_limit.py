@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+import time
+
+from common.metrics import metrics
+
+
+class TokenBucket:
+    """A thread-safe token bucket limiting the rate of the requests sent to an API.
+
+    Tokens are refilled continuously at `rate` per second, up to `capacity`, each request consuming one. The
+    buckets are shared by name within a process, so that all the clients of a network draw from the same budget.
+    """
+
+    _buckets = dict()
+    _buckets_lock = threading.Lock()
+
+    def __init__(self, rate: float, capacity: float = None, name: str = None):
+
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, name: str, rate: float, capacity: float = None) -> "TokenBucket":
+        """Get the bucket of a given name, creating it on first use."""
+
+        with cls._buckets_lock:
+            if name not in cls._buckets:
+                cls._buckets[name] = cls(rate, capacity, name)
+            return cls._buckets[name]
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Consume the tokens if they are available, without waiting.
+
+        Returns:
+            float: 0 when the tokens were consumed, otherwise the delay (in seconds) until they are available.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Wait until the tokens are available and consume them. Returns the time spent waiting."""
+
+        waited = 0.0
+        delay = self.try_acquire(tokens)
+        while delay:
+            time.sleep(delay)
+            waited += delay
+            delay = self.try_acquire(tokens)
+
+        if waited:
+            metrics.inc("rate_limit_wait_seconds_total", waited, bucket=self.name)
+        return waited
+
+
+class SQLiteTokenBucket:
+    """A token bucket stored in SQLite, so that processes sharing the database share a global rate budget.
+
+    It has the same interface as TokenBucket, and is used by the work queue workers so that the explorer rate
+    limit holds whatever the number of workers.
+    """
+
+    def __init__(self, path: str, name: str, rate: float, capacity: float = None):
+
+        self.path = path
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The connection to the SQLite store, which is created on first use."""
+
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS rate_budgets (name TEXT PRIMARY KEY, tokens REAL, updated_at REAL)")
+        return self._connection
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Consume the tokens if they are available, without waiting.
+
+        Returns:
+            float: 0 when the tokens were consumed, otherwise the delay (in seconds) until they are available.
+        """
+
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self.connection.execute("SELECT tokens, updated_at FROM rate_budgets WHERE name = ?", (self.name,)).fetchone()
+                available = min(self.capacity, row[0] + (now - row[1]) * self.rate) if row else self.capacity
+                acquired = available >= tokens
+                self.connection.execute("INSERT OR REPLACE INTO rate_budgets VALUES (?, ?, ?)", (self.name, available - tokens if acquired else available, now))
+            finally:
+                self.connection.execute("COMMIT")
+        return 0.0 if acquired else (tokens - available) / self.rate
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Wait until the tokens are available and consume them. Returns the time spent waiting."""
+
+        waited = 0.0
+        delay = self.try_acquire(tokens)
+        while delay:
+            time.sleep(delay)
+            waited += delay
+            delay = self.try_acquire(tokens)
+
+        if waited:
+            metrics.inc("rate_limit_wait_seconds_total", waited, bucket=self.name)
+        return waited
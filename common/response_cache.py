@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from common.metrics import metrics
+
+
+class ResponseCache:
+    """A local on-disk cache of explorer and RPC responses, keyed on (endpoint, method, params).
+
+    The responses are stored compressed in a SQLite database. Depending on the mode, which defaults to the
+    WEB3_RESPONSE_CACHE environment variable:
+    - off: the cache is bypassed.
+    - cache: only the responses flagged as immutable (finalized blocks, closed epochs) are stored and served.
+    - record: every response is stored, so that a run can be replayed offline, and immutable ones are served.
+    - replay: responses are only served from the store, a missing response raising a LookupError.
+
+    The params must not contain credentials, since they are stored as is to ease the inspection of the store.
+    """
+
+    modes = ("off", "cache", "record", "replay")
+
+    def __init__(self, path: str = None, mode: str = None):
+
+        self.mode = mode or os.environ.get("WEB3_RESPONSE_CACHE", "off")
+        self.path = path or os.environ.get("WEB3_RESPONSE_CACHE_PATH", os.path.expanduser("~/.cache/web3/responses.sqlite"))
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        self._connection = None
+
+        if self.mode not in self.modes:
+            raise ValueError(f"Unknown response cache mode {self.mode}, expected one of {self.modes}.")
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The connection to the SQLite store, which is created on first use."""
+
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, endpoint TEXT, method TEXT, params TEXT, payload BLOB, immutable INTEGER, created_at REAL)"
+            )
+        return self._connection
+
+    def key(self, endpoint: str, method: str, params) -> str:
+        return hashlib.sha256(json.dumps([endpoint, method, params], sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, endpoint: str, method: str, params):
+        """Get a stored response, only immutable ones being served unless replaying. Returns None on a miss."""
+
+        query = "SELECT payload FROM responses WHERE key = ?" + ("" if self.mode == "replay" else " AND immutable = 1")
+        with self.lock:
+            row = self.connection.execute(query, (self.key(endpoint, method, params),)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def put(self, endpoint: str, method: str, params, payload, immutable: bool):
+        row = (
+            self.key(endpoint, method, params),
+            endpoint,
+            method,
+            json.dumps(params, sort_keys=True, default=str),
+            zlib.compress(json.dumps(payload).encode()),
+            int(immutable),
+            time.time(),
+        )
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            self.connection.commit()
+
+    def fetch(self, endpoint: str, method: str, params, request, immutable=False):
+        """Serve a response from the cache, or request and store it according to the cache mode.
+
+        Args:
+            endpoint (str): The endpoint the request is sent to, without credentials.
+            method (str): The API or RPC method.
+            params (any): The JSON serializable request parameters, without credentials.
+            request (callable): The function sending the request and returning its JSON payload.
+            immutable (bool | callable): Whether the response can never change, or a function deciding it from the payload.
+
+        Raises:
+            LookupError: The response hasn't been recorded and the cache is in replay mode.
+
+        Returns:
+            any: The JSON payload of the response.
+        """
+
+        if self.mode == "off":
+            return request()
+
+        payload = self.get(endpoint, method, params)
+        if payload is not None:
+            self.hits += 1
+            metrics.inc("response_cache_requests_total", endpoint=endpoint, result="hit")
+            return payload
+
+        self.misses += 1
+        metrics.inc("response_cache_requests_total", endpoint=endpoint, result="miss")
+        if self.mode == "replay":
+            raise LookupError(f"No recorded response for {method} on {endpoint} with params {params}.")
+
+        payload = request()
+        is_immutable = immutable(payload) if callable(immutable) else immutable
+        if is_immutable or self.mode == "record":
+            self.put(endpoint, method, params, payload, is_immutable)
+
+        return payload
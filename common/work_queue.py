@@ -0,0 +1,108 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+
+class WorkQueue:
+    """A durable queue of tasks stored in SQLite, shared by worker processes leasing its tasks.
+
+    A leased task belongs to its worker until its lease expires, the worker extending it with heartbeats while
+    the task runs. The tasks whose lease expired (crashed or stalled worker) and the failed ones are leased again,
+    up to max_attempts times. Enqueuing is idempotent, the tasks being identified by their id.
+
+    The workers share the queue through SQLite file locks, hence they must run on the host storing it: SQLite
+    locking isn't reliable on network filesystems, which rules out sharing a queue between hosts.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 5):
+
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """The connection to the SQLite store, which is created on first use."""
+
+        if self._connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "id TEXT PRIMARY KEY, payload TEXT, status TEXT, worker TEXT, lease_expires REAL, "
+                "attempts INTEGER, rows INTEGER, error TEXT, updated_at REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)")
+        return self._connection
+
+    def put(self, tasks: list) -> int:
+        """Enqueue tasks, given as dictionaries with an id, the already enqueued ones being ignored.
+
+        Returns:
+            int: The number of tasks enqueued.
+        """
+
+        now = time.time()
+        rows = [(task["id"], json.dumps(task), "pending", None, None, 0, None, None, now) for task in tasks]
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany("INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("COMMIT")
+            return self.connection.total_changes - before
+
+    def lease(self, worker: str, lease_seconds: float = 300) -> dict:
+        """Lease the next available task for a worker. Returns None when no task is available."""
+
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT id, payload, attempts FROM tasks "
+                    "WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?) OR status = 'failed') AND attempts < ? "
+                    "ORDER BY rowid LIMIT 1",
+                    (now, self.max_attempts),
+                ).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                        (worker, now + lease_seconds, now, row[0]),
+                    )
+            finally:
+                self.connection.execute("COMMIT")
+
+        return dict(json.loads(row[1]), attempts=row[2] + 1) if row else None
+
+    def heartbeat(self, task_id: str, worker: str, lease_seconds: float = 300) -> bool:
+        """Extend the lease of a task. Returns False when the worker lost the lease to another worker."""
+
+        return self.update(task_id, worker, lease_expires=time.time() + lease_seconds)
+
+    def complete(self, task_id: str, worker: str, rows: int = None) -> bool:
+        return self.update(task_id, worker, status="done", rows=rows, error=None)
+
+    def fail(self, task_id: str, worker: str, error: str) -> bool:
+        return self.update(task_id, worker, status="failed", error=error)
+
+    def update(self, task_id: str, worker: str, **fields) -> bool:
+        """Update a task leased by a worker, returning whether the worker still held its lease."""
+
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.lock:
+            cursor = self.connection.execute(
+                f"UPDATE tasks SET {assignments}, updated_at = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (*fields.values(), time.time(), task_id, worker),
+            )
+        return cursor.rowcount == 1
+
+    def stats(self) -> pd.DataFrame:
+        """Count the tasks and the rows collected by status."""
+
+        with self.lock:
+            return pd.read_sql("SELECT status, COUNT(*) AS tasks, SUM(rows) AS rows, MAX(attempts) AS max_attempts FROM tasks GROUP BY status", self.connection)
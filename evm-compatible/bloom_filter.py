@@ -0,0 +1,177 @@
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from eth_utils import keccak
+from hexbytes import HexBytes
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(dir_path, os.pardir)))
+
+from common.columnar import response_json
+from common.metrics import metrics
+from data_collection import ContractEventLogs
+
+logger = logging.getLogger()
+
+# The logsBloom of a block header is a 2048 bits bloom filter, in which each address and topic sets 3 bits
+BLOOM_BYTES = 256
+
+
+def bloom_positions(value) -> tuple:
+    """Get the (byte, mask) positions of the 3 bits set by a value (address or topic) in a logs bloom.
+
+    The bits are given by the first 3 pairs of bytes of the keccak hash of the value, modulo 2048, the bloom
+    being a big-endian 2048 bits integer.
+    """
+
+    digest = keccak(HexBytes(value))
+    bits = [((digest[i] << 8) | digest[i + 1]) & 2047 for i in (0, 2, 4)]
+    return [BLOOM_BYTES - 1 - bit // 8 for bit in bits], [1 << (bit % 8) for bit in bits]
+
+
+def parse_blooms(blooms: list) -> np.ndarray:
+    """Pack the hex encoded logs blooms of a list of headers into a (blocks, 256) uint8 array."""
+
+    return np.frombuffer(bytes.fromhex("".join(bloom[2:] for bloom in blooms)), dtype=np.uint8).reshape(-1, BLOOM_BYTES)
+
+
+def match_blooms(blooms: np.ndarray, values: list) -> np.ndarray:
+    """Check which blooms may contain each value, returning a (blocks, values) boolean array."""
+
+    positions = [bloom_positions(value) for value in values]
+    indices = np.array([p[0] for p in positions], dtype=np.intp).reshape(len(values), 3)
+    masks = np.array([p[1] for p in positions], dtype=np.uint8).reshape(len(values), 3)
+    return ((blooms[:, indices] & masks) != 0).all(axis=2)
+
+
+def candidate_ranges(blocks: np.ndarray, merge_gap: int = 0) -> list:
+    """Merge sorted candidate block numbers into ranges, the ranges closer than merge_gap blocks being merged."""
+
+    if not len(blocks):
+        return list()
+    breaks = np.flatnonzero(np.diff(blocks) > merge_gap + 1)
+    starts = np.concatenate([[blocks[0]], blocks[breaks + 1]])
+    ends = np.concatenate([blocks[breaks], [blocks[-1]]])
+    return [(int(start), int(end)) for start, end in zip(starts, ends)]
+
+
+class BloomPrefilter:
+    """Prefilter the blocks in which a set of contracts may have emitted logs, from the logs blooms of the headers.
+
+    The headers are fetched by batches of JSON-RPC requests, their blooms being checked at once against the bloom
+    bits of all the contracts (and optionally of the event topics), so that the logs are only requested over the
+    candidate block ranges. Blooms having false positives but no false negatives, no log is missed.
+
+    Args:
+        client (ContractEventLogs): The logs collector of the network, whose node pool serves the headers.
+        addresses (list): The addresses of the contracts.
+        topics (list): The topic0 of the events of interest, None for all the events.
+        batch_size (int): The number of headers requested per batch.
+        max_workers (int): The number of batches requested concurrently.
+    """
+
+    def __init__(self, client: ContractEventLogs, addresses: list, topics: list = None, batch_size: int = 500, max_workers: int = 4):
+
+        self.client = client
+        self.addresses = [address.lower() for address in addresses]
+        self.topics = topics
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.scanned_blocks = 0
+        self.blocks = np.array(list(), dtype=np.int64)
+        self.candidates = np.zeros((0, len(self.addresses)), dtype=bool)
+        self.blocks_with_logs = dict()
+
+    def request_blooms(self, start_block: int, end_block: int) -> list:
+        """Request the logs blooms of a span of blocks in a batch, through the response cache for final blocks.
+
+        The timestamps of the final blocks are added to the block time index of the network on the way.
+        """
+
+        def request():
+            batch = [{"jsonrpc": "2.0", "id": n, "method": "eth_getBlockByNumber", "params": [hex(n), False]} for n in range(start_block, end_block + 1)]
+            responses = sorted(response_json(self.client.node_pool.post(json=batch)), key=lambda r: r["id"])
+            errors = [r["error"] for r in responses if "error" in r]
+            if errors:
+                raise ConnectionError(f"The node failed answering {len(errors)} header requests. ERROR: {errors[0]}")
+            # a node behind the head served by another node of the pool answers null for the blocks it doesn't have yet
+            missing = [r["id"] for r in responses if r.get("result") is None]
+            if missing:
+                raise ConnectionError(f"The node doesn't have the blocks {missing[:5]} yet.")
+            # the headers carry the block times as well, which are indexed for the final blocks
+            final = [r["result"] for r in responses if int(r["result"]["number"], 16) <= self.client.finalized_block]
+            self.client.block_times.write([int(h["number"], 16) for h in final], [int(h["timestamp"], 16) for h in final])
+            return [r["result"]["logsBloom"] for r in responses]
+
+        endpoint = f"{self.client.network}-node"
+        return self.client.response_cache.fetch(endpoint, "logsBloom", [start_block, end_block], request, end_block <= self.client.finalized_block)
+
+    def scan_batch(self, start_block: int, end_block: int) -> tuple:
+        """Check the blooms of a batch of blocks, returning the blocks having candidates and their candidates."""
+
+        blooms = parse_blooms(self.request_blooms(start_block, end_block))
+        candidates = match_blooms(blooms, self.addresses)
+        if self.topics:
+            candidates &= match_blooms(blooms, self.topics).any(axis=1, keepdims=True)
+        rows = candidates.any(axis=1)
+        return np.arange(start_block, end_block + 1, dtype=np.int64)[rows], candidates[rows]
+
+    def scan(self, start_block: int, end_block: int) -> np.ndarray:
+        """Check the blooms of a span of blocks, and return the (candidate blocks, addresses) candidates array.
+
+        Only the blocks which are candidates for at least one contract are kept, so that long spans can be scanned.
+        """
+
+        batches = [(start, min(start + self.batch_size - 1, end_block)) for start in range(start_block, end_block + 1, self.batch_size)]
+        with metrics.span("prefilter", network=self.client.network, dataset="logs"):
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = list(executor.map(lambda batch: self.scan_batch(*batch), batches))
+
+        self.scanned_blocks = end_block - start_block + 1
+        self.blocks = np.concatenate([blocks for blocks, _ in results])
+        self.candidates = np.concatenate([candidates for _, candidates in results])
+        metrics.inc("prefilter_blocks_total", self.scanned_blocks, network=self.client.network)
+        metrics.inc("prefilter_candidate_blocks_total", len(self.blocks), network=self.client.network)
+        return self.candidates
+
+    def ranges(self, address: str, merge_gap: int = 0) -> list:
+        """The candidate block ranges of a contract, from the last scan."""
+
+        return candidate_ranges(self.blocks[self.candidates[:, self.addresses.index(address.lower())]], merge_gap)
+
+    def request_contract_logs(self, address: str, merge_gap: int = 0) -> list:
+        """Request the logs of a contract over its candidate block ranges only."""
+
+        logs = list()
+        for start, end in self.ranges(address, merge_gap):
+            logs += self.client.request_contract_logs(address, start, end) or list()
+        blocks_with_logs = self.blocks_with_logs.setdefault(address.lower(), set())
+        blocks_with_logs |= {int(log["blockNumber"], 16) for log in logs}
+        return logs
+
+    def report(self) -> pd.DataFrame:
+        """Report, per contract, the candidate blocks and ranges and the false positive rate of the blooms.
+
+        The false positive rate is the share of the candidate blocks in which the contract didn't emit any log,
+        for the contracts whose logs have been requested.
+        """
+
+        rows = list()
+        for i, address in enumerate(self.addresses):
+            candidates = int(self.candidates[:, i].sum())
+            with_logs = len(self.blocks_with_logs[address]) if address in self.blocks_with_logs else None
+            rows.append(
+                dict(
+                    address=address,
+                    blocks=self.scanned_blocks,
+                    candidate_blocks=candidates,
+                    candidate_ranges=len(self.ranges(address)),
+                    blocks_with_logs=with_logs,
+                    false_positive_rate=(candidates - with_logs) / candidates if candidates and with_logs is not None else None,
+                )
+            )
+        return pd.DataFrame(rows)
@@ -1,9 +1,10 @@
-import ast
 import json
 import logging
 import os
+import sys
 import time
 
+import numpy as np
 import pandas as pd
 import requests
 import web3
@@ -14,11 +15,64 @@ from tqdm import tqdm
 from web3 import Web3
 from web3._utils.events import get_event_data
 from web3.middleware.geth_poa import geth_poa_middleware
+from web3.providers.base import JSONBaseProvider
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(dir_path, os.pardir)))
+
+from common.address_dictionary import AddressDictionary, is_address_serie
+from common.block_times import BlockTimeIndex
+from common.columnar import loads, page_to_frame, parse_integers, response_json
+from common.endpoint_pool import EndpointPool, is_retryable_rpc_response
+from common.key_pool import ApiKeyPool
+from common.metrics import metrics
+from common.pagination import BlockPaginator
+from common.profiling import profiled
+from common.response_cache import ResponseCache
+from multicall import Multicall, find_function_abi
+from proxy_history import ImplementationHistory
+from standard_events import STANDARD_EVENTS, decode_standard_events, is_standard_log
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG, format="%(message)s")
 logger.setLevel(logging.INFO)
 
+# Bounds of the decoded event arguments stored in integer columns, larger values (uint256) being kept as objects
+INT64_MIN, INT64_MAX = -(2**63), 2**63 - 1
+
+# The string columns having at most this ratio of distinct values are stored as categoricals
+CATEGORY_RATIO = 0.5
+
+
+def is_topic(value: str) -> bool:
+    """Whether a value is a 0x prefixed 32 bytes topic, rather than an event name."""
+
+    return isinstance(value, str) and len(value) == 66 and value[:2] == "0x"
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """A web3 HTTP provider sending the JSON-RPC requests through an endpoint pool.
+
+    Requests fail over to the other nodes of the pool, and reads can be hedged, except for the methods sending
+    transactions, which are never sent twice.
+    """
+
+    non_idempotent_methods = {"eth_sendTransaction", "eth_sendRawTransaction"}
+
+    def __init__(self, pool: EndpointPool):
+
+        super().__init__()
+        self.pool = pool
+
+    def make_request(self, method: str, params: list) -> dict:
+        request_data = self.encode_rpc_request(method, params)
+        response = self.pool.post(
+            idempotent=method not in self.non_idempotent_methods,
+            data=request_data,
+            headers={"Content-Type": "application/json"},
+        )
+        return response_json(response)
+
 
 class Web3ToolKit:
     """Set of utils to collect data via web3.
@@ -29,34 +83,61 @@ class Web3ToolKit:
     connect via web3.
     """
 
-    def __init__(self, network: str) -> None:
+    def __init__(self, network: str, config_path: str = None, profile: str = None) -> None:
 
         self.network = network
+        if profile:
+            profiled.enable(profile)
 
-        config_path = os.path.join(os.path.dirname(__file__), "config.yaml")
+        config_path = config_path or os.path.join(os.path.dirname(__file__), "config.yaml")
         self.config = yaml.safe_load(open(config_path))
 
         self.api_url = self.config.get(self.network)["API_URL"]
         self.node_url = self.config.get(self.network)["NODE_URL"]
-        self.api_key, self.node_key = self.parse_credentials(self.network)
+        self.api_keys, self.node_key = self.parse_credentials(self.network)
+        self.api_key = self.api_keys[0]
 
         self.w3 = self.connect_web3()
         self.start_block, self.end_block = 1, self.w3.eth.blockNumber
 
+        # Blocks deeper than the finality depth can't be reorganized anymore, hence their data can be cached
+        self.finalized_block = self.end_block - self.config.get(self.network).get("FINALITY_DEPTH", 64)
+        self.response_cache = ResponseCache()
+
+        # The explorer API keys, each with its own requests budget, shared by all the clients of the network
+        rate_limit = self.config.get(self.network).get("RATE_LIMIT")
+        self.key_pool = ApiKeyPool.shared(f"{self.network}-explorer", self.api_keys, rate_limit)
+
+        # The block spans of the explorer datasets are split into shards paginated concurrently
+        self.pagination_shards = self.config.get(self.network).get("PAGINATION_SHARDS", 1)
+
+        # The timestamps of the final blocks, and the ids of the addresses, shared by all the pipelines of the network
+        self.block_times = BlockTimeIndex(self.network)
+        self.address_dictionary = AddressDictionary.shared(self.network)
+
+        # The implementations of the proxies over time, and the events of the ABIs requested so far
+        self.implementation_history = ImplementationHistory(self)
+        self.implementation_histories, self.contract_abis, self.contract_abi_events = dict(), dict(), dict()
+
+        # The view calls of the state snapshots are aggregated into Multicall3 calls
+        self.multicall = Multicall(self, **{k.lower(): v for k, v in self.config.get(self.network).get("MULTICALL", dict()).items()})
+
     def parse_credentials(self, network: str):
         """Parse the authentication keys required to connect to an explorer API and network node.
 
         Args:
             network (str): The network of interest.
 
+        Several explorer API keys can be given, separated by commas, their requests budgets adding up.
+
         Raises:
             AssertionError: The required environment variables haven't been correctly defined.
 
         Returns:
-            tuple(str): A tuple of the explorer API key and network node key.
+            tuple: A tuple of the explorer API keys (list) and network node key.
         """
         try:
-            api_key = os.environ[f"{self.network.upper()}_API_KEY"]
+            api_keys = [key.strip() for key in os.environ[f"{self.network.upper()}_API_KEY"].split(",") if key.strip()]
             node_key = os.environ[f"ALCHEMY_{self.network.upper()}_NODE_KEY"]
 
         except KeyError:
@@ -67,7 +148,7 @@ class Web3ToolKit:
                 "environment variables.",
             )
 
-        return api_key, node_key
+        return api_keys, node_key
 
     def connect_web3(self) -> Web3:
         """Connect to the network with w3 and returns the client and latest block.
@@ -75,9 +156,16 @@ class Web3ToolKit:
         Returns:
             Web3: The Web3 instance used to interact with the network.
         """
-        # Create connection
-        url = f"{self.node_url}{self.node_key}/"
-        w3 = Web3(Web3.HTTPProvider(url))
+        # Create connection, through the configured node and its fallbacks
+        network_config = self.config.get(self.network)
+        urls = [f"{self.node_url}{self.node_key}/"] + network_config.get("FALLBACK_NODE_URLS", list())
+        self.node_pool = EndpointPool(
+            urls,
+            name=f"{self.network}-node",
+            hedge_after=network_config.get("HEDGE_AFTER"),
+            is_retryable=is_retryable_rpc_response,
+        )
+        w3 = Web3(PooledHTTPProvider(self.node_pool))
         if self.network == "polygon":
             w3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
@@ -94,6 +182,109 @@ class Web3ToolKit:
 
         return w3
 
+    def request_explorer(self, params: dict, immutable=False) -> dict:
+        """Send a request to the explorer API, through the local response cache.
+
+        Args:
+            params (dict): The request parameters, the API key being taken from the key pool.
+            immutable (bool | callable): Whether the response can be cached, or a function deciding it from the payload.
+
+        Returns:
+            dict: The JSON payload of the response.
+        """
+
+        public_params = {k: v for k, v in params.items() if k != "apikey"}
+        method = f"{params.get('module')}.{params.get('action')}"
+
+        def request():
+            # A key throttled or rejected by the explorer is benched, and the request sent again with another key
+            for _ in range(len(self.key_pool.keys)):
+                key = self.key_pool.acquire()
+                start = time.perf_counter()
+                response = requests.post(self.api_url, params=dict(public_params, apikey=key.value))
+                metrics.observe("http_request_duration_seconds", time.perf_counter() - start, pool="explorer", endpoint=self.network)
+                metrics.inc("http_response_bytes_total", len(response.content), pool="explorer", endpoint=self.network)
+                payload = loads(response.content)
+                # only the requests sent to the explorer are counted, not the responses served by the cache
+                metrics.inc("explorer_requests_total", network=self.network, method=method, status=payload.get("status"))
+                if payload.get("status") == "0" and "rate limit" in str(payload.get("result")).lower():
+                    metrics.inc("explorer_rate_limited_total", network=self.network, method=method)
+                if self.key_pool.record(key, payload):
+                    break
+            return payload
+
+        return self.response_cache.fetch(self.api_url, method, public_params, request, immutable)
+
+    def is_finalized_page(self, end_block: int, page_size: int, block_field: str = "blockNumber", base: int = 10):
+        """Build a function telling whether an explorer page response only depends on finalized blocks.
+
+        A page is immutable when the requested block span is finalized, or when it is a full page whose last
+        block is finalized, since the explorer returns the results by ascending block number.
+        """
+
+        def is_finalized(payload: dict) -> bool:
+            result = payload.get("result")
+            if payload.get("status") != "1" or not isinstance(result, list):
+                return False
+            if end_block <= self.finalized_block:
+                return True
+            return len(result) >= page_size and max(int(x.get(block_field), base) for x in result) <= self.finalized_block
+
+        return is_finalized
+
+    def paginate_explorer(self, params: dict, start_block: int, end_block: int, page_size: int, block_fields=("startblock", "endblock"), base: int = 10):
+        """Stream the pages of an explorer dataset over a block span, see BlockPaginator.
+
+        Args:
+            params (dict): The request parameters of the dataset (module, action, address).
+            start_block (int): The starting block of the extraction.
+            end_block (int): The upper limit block of the extraction.
+            page_size (int): The number of rows of a full page.
+            block_fields (tuple(str)): The names of the start and end block parameters of the dataset.
+            base (int): The base of the block numbers of the rows (16 for the logs).
+
+        Returns:
+            generator(list(dict)): The rows of the pages, without duplicates.
+        """
+
+        start_field, end_field = block_fields
+        method = f"{params.get('module')}.{params.get('action')}"
+
+        def request_page(start: int, end: int, page: int) -> dict:
+            logger.info(f"Extracting {params.get('action')} from {start} to {end} (page {page}) for contract {params.get('address')}")
+            request_params = dict(params, **{start_field: start, end_field: end}, page=page, offset=page_size)
+            return self.request_explorer(request_params, immutable=self.is_finalized_page(end, page_size, base=base))
+
+        paginator = BlockPaginator(
+            request_page,
+            page_size,
+            lambda row: int(row["blockNumber"], base),
+            shards=self.pagination_shards,
+            labels=dict(network=self.network, method=method),
+        )
+        return paginator.pages(start_block, end_block)
+
+    def request_block_timestamps(self, blocks: pd.Series) -> pd.Series:
+        """Get the timestamps of a column of block numbers, from the block time index.
+
+        The blocks which aren't indexed yet are requested by batches of headers, the final ones being indexed.
+
+        Args:
+            blocks (pd.Series): The block numbers.
+
+        Returns:
+            pd.Series: The timestamps of the blocks, as datetimes.
+        """
+
+        timestamps = self.block_times.lookup(blocks)
+        missing = np.unique(np.asarray(blocks, dtype=np.int64)[timestamps == 0])
+        if len(missing):
+            requested, requested_timestamps = self.block_times.fill(self.node_pool, missing, self.finalized_block)
+            unknown = timestamps == 0
+            timestamps[unknown] = requested_timestamps[np.searchsorted(requested, np.asarray(blocks, dtype=np.int64)[unknown])]
+
+        return pd.Series(pd.to_datetime(timestamps, unit="s"), index=blocks.index if isinstance(blocks, pd.Series) else None)
+
     def search_contract_implementation_address(self, address: str) -> str:
         """Retrieve the implementation address of a conrtract.
 
@@ -134,13 +325,8 @@ class Web3ToolKit:
         """
 
         try:
-            request_params = dict(
-                address=address,
-                module="contract",
-                action="getabi",
-                apikey=self.api_key,
-            )
-            response = requests.post(self.api_url, params=request_params).json()
+            request_params = dict(address=address, module="contract", action="getabi")
+            response = self.request_explorer(request_params, immutable=lambda payload: payload.get("status") == "1")
 
             if response.get("status") == "1":
                 abi = json.loads(response.get("result"))
@@ -159,6 +345,108 @@ class Web3ToolKit:
             raise ConnectionError(f"The call to the ABI didn't work. ERROR: {e}")
         return abi
 
+    def request_implementation_history(self, address: str, start_block: int, end_block: int) -> list:
+        """Resolve the implementations of a contract over a block span, whatever its proxy standard.
+
+        The resolved histories are kept, so that the sub-spans of a resolved span are not resolved again. When
+        the node can't serve the historical state (not an archive node), the latest implementation is assumed
+        for the whole span.
+
+        Args:
+            address (str): The contract address.
+            start_block (int): The starting block of the span.
+            end_block (int): The upper limit block of the span.
+
+        Returns:
+            list(tuple): The (start block, end block, implementation) ranges covering the span, the implementation
+                being None when the contract isn't behind a proxy.
+        """
+
+        resolved = self.implementation_histories.get(address.lower())
+        if resolved and resolved[0][0] <= start_block and end_block <= resolved[-1][1]:
+            return [(max(start, start_block), min(end, end_block), impl) for start, end, impl in resolved if end >= start_block and start <= end_block]
+
+        try:
+            history = self.implementation_history.resolve(Web3.toChecksumAddress(address), start_block, end_block)
+        except ConnectionError as e:
+            logger.warning(f"Failed resolving the implementation history of {address}, assuming the latest one. ERROR: {e}")
+            implementation = self.search_contract_implementation_address(address)
+            implementation = implementation if implementation and implementation != "0x0000000000000000" else None
+            return [(start_block, end_block, implementation)]
+
+        self.implementation_histories[address.lower()] = history
+        return history
+
+    def request_contract_abi_events(self, address: str) -> dict:
+        """Get the events of the ABI of a contract, which are requested once per contract.
+
+        Args:
+            address (str): The contract address.
+
+        Returns:
+            dict: A dictionary having the event hash as keys the corresponding ABI event as values, empty when the
+                contract ABI isn't available.
+        """
+
+        address = address.lower()
+        if address not in self.contract_abi_events:
+            abi = self.request_cached_contract_abi(address)
+            self.contract_abi_events[address] = self.create_contract_abi_events(abi) if abi else dict()
+        return self.contract_abi_events[address]
+
+    def request_cached_contract_abi(self, address: str) -> list:
+        """Get the ABI of a contract, which is requested once per contract. Returns None when it isn't available."""
+
+        address = address.lower()
+        if address not in self.contract_abis:
+            self.contract_abis[address] = self.request_contract_abi(address)
+        return self.contract_abis[address]
+
+    def request_state_snapshot(self, calls: list, block="latest", abi: list = None) -> pd.DataFrame:
+        """Read the state of contracts at a given block, with view calls aggregated into Multicall3 calls.
+
+        Thousands of calls (token balances, reserves data, stream rates) are sent in a few aggregate3 calls,
+        each call being allowed to fail. The outputs are decoded per function, into one column per output.
+
+        Args:
+            calls (list): The (address, function name, arguments tuple) calls.
+            block (int | str): The block number, or a block tag. Defaults to the latest block.
+            abi (list): The ABI of the called functions (an ERC-20 ABI for balances, for instance), defaults to
+                the ABI of each called contract.
+
+        Returns:
+            pd.DataFrame: The block, address, function, arguments and success of each call, and its outputs in
+                result.<output> columns, the outputs fitting in 64 bits integers being stored as integers.
+        """
+
+        block = self.w3.eth.blockNumber if block == "latest" else block
+        function_abis = dict()
+        resolved = list()
+        for address, name, args in calls:
+            key = (None if abi else address.lower(), name, len(args))
+            if key not in function_abis:
+                function_abis[key] = find_function_abi(abi or self.request_cached_contract_abi(address) or list(), name, args)
+            resolved.append((address, function_abis[key], tuple(args)))
+
+        labels = dict(network=self.network, dataset="state_snapshot")
+        with metrics.span("fetch", **labels):
+            results = self.multicall.call(resolved, block)
+        with metrics.span("decode", **labels):
+            outputs = self.multicall.decode(resolved, results)
+        metrics.inc("rows_total", len(calls), stage="decode", **labels)
+
+        df = pd.DataFrame(
+            {
+                "block": block,
+                "address": [address for address, _, _ in calls],
+                "function": [name for _, name, _ in calls],
+                "args": [json.dumps(list(args), default=str) for _, _, args in calls],
+                "success": [success for success, _ in results],
+            }
+        )
+        return df.join(self.flatten_decoded_data(pd.Series(outputs, name="result")))
+
+    @profiled
     def create_contract_abi_events(self, abi: dict) -> dict:
         """Get the keccak hash of the events of a smart contract ABI.
 
@@ -211,52 +499,104 @@ class Web3ToolKit:
 
         return contract_instance
 
-    def decode_hex_fields(self, serie: pd.Series) -> pd.Series:
+    @profiled
+    def decode_hex_fields(self, serie: pd.Series, base: int = 16) -> pd.Series:
         """Decode hexadecimal bytes to bytes strings or byteto hexadecimal strings.
 
         Args:
-            serie (pd.Series): A pandas Serie containing HexBytes or hex strings.
+            serie (pd.Series): A pandas Serie containing HexBytes, hex strings or integers (see parse_integers).
+            base (int): The base of the strings, 10 for the decimal strings of the account datasets.
 
         Returns:
             pd.Series: The pandas Serie with converted hex values.
         """
-        try:
-            serie = serie.map(lambda x: [y.hex() for y in x])
-        except AttributeError:
-            serie = serie.map(lambda x: int(x, base=16) if x != "0x" else None)
-            serie = serie if max(serie) < 2147483647 else serie.astype("float64")
-        return serie
+        if serie.dtype == object and len(serie) and isinstance(serie.iloc[0], list):
+            return serie.map(lambda x: [y.hex() for y in x])
+
+        values = serie.to_numpy() if serie.dtype != object else parse_integers(serie, base)
+        serie = pd.Series(values, index=serie.index, name=serie.name)
+        if serie.dtype == object:
+            serie = serie.astype("float64")
+        return serie if not len(serie) or serie.max() < 2147483647 else serie.astype("float64")
 
-    def normalize_nested_fields(self, serie: pd.Series) -> pd.Series:
-        """Normalize nested fields and clean potential empty or null values.
+    @profiled
+    def dictionary_encode(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Store the repetitive string columns of a formatted frame as categoricals, which Parquet stores as dictionaries.
+
+        The address columns are interned in the address dictionary of the network, their categories being ordered
+        by id, and the other string columns (function and event names, token symbols) are stored as categoricals
+        when they have few distinct values.
 
         Args:
-            serie (pd.Series): A pandas Serie containing raw nested fields.
+            df (pd.DataFrame): The formatted frame, whose object columns are strings.
 
         Returns:
-            pd.Series: The normalized and cleaned pandas Serie.
+            pd.DataFrame: The frame, with its address and label columns as categoricals.
         """
-        serie = pd.json_normalize(serie).astype("str")
-        serie = serie.apply(lambda x: x.replace({"[]": None, "None": None}))
-        serie = serie.dropna(axis=1, how="all").squeeze()
-        serie = serie if not serie.empty else pd.Series([None for x in serie.index])
-        return serie
 
-    def decode_json_payloads(self, serie: pd.Series) -> pd.Series:
-        """Transform to string the bytes values potentially present in a list of dict.
+        for column in df.select_dtypes("object").columns:
+            serie = df[column]
+            if is_address_serie(serie):
+                df[column] = self.address_dictionary.categorical(serie)
+            elif serie.nunique() <= CATEGORY_RATIO * len(serie):
+                df[column] = serie.astype("category")
+        return df
+
+    def address_ids(self, serie: pd.Series) -> pd.Series:
+        """Get the int32 ids of a column of addresses in the address dictionary of the network, for joining and grouping them."""
+
+        return pd.Series(self.address_dictionary.encode(serie), index=serie.index, name=serie.name)
+
+    @profiled
+    def join_decoded_data(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Join the decoded arguments of a logs dataset as columns, and serialize them as a JSON payload.
+
+        The arguments decoded with the ABIs are flattened, and the standard ERC-20 and ERC-721 events (left
+        undecoded by decode_contract_logs_data) are decoded by whole columns from their hex topics and data.
 
         Args:
-            serie (pd.Series): A series containing dictionaries.
+            df (pd.DataFrame): The logs, with their topics as lists of hex strings and their decoded_data.
 
         Returns:
-            pd.Series: The decoded series.
+            pd.DataFrame: The logs with their decoded arguments columns, and decoded_data as a JSON payload.
         """
-        if serie.sum():
-            serie = serie.map(lambda x: ast.literal_eval(x))
-            serie = serie.map(lambda d: {k: (v.hex() if type(v) is bytes else v) for k, v in d.items()})
-        else:
-            pass  # The serie only contains null values
-        return serie
+
+        standard = df["decoded_data"].isna() & pd.Series([is_standard_log(t, d) for t, d in zip(df["topics"], df["data"])], index=df.index)
+        decoded = df.loc[~standard, "decoded_data"]
+        standard_decoded = decode_standard_events(df[standard])
+
+        flattened = pd.concat([self.flatten_decoded_data(decoded), standard_decoded.drop(columns="decoded_data")])
+        payloads = pd.concat([pd.Series([json.dumps(d, default=str) if d is not None else None for d in decoded], index=decoded.index, dtype=object), standard_decoded["decoded_data"]])
+        df["decoded_data"] = payloads.reindex(df.index)
+        return df.join(flattened.reindex(df.index))
+
+    @profiled
+    def flatten_decoded_data(self, serie: pd.Series) -> pd.DataFrame:
+        """Flatten the decoded event arguments into one column per argument, in a single pass.
+
+        The arguments fitting in 64 bits integers are stored in nullable integer columns, the other ones
+        (large uint256, addresses, arrays) being kept as objects.
+
+        Args:
+            serie (pd.Series): A pandas Serie containing the decoded arguments dictionaries, or None.
+
+        Returns:
+            pd.DataFrame: The decoded arguments, with columns named after the serie and the arguments.
+        """
+
+        records = [d or dict() for d in serie]
+        keys = list(dict.fromkeys(k for d in records for k in d))
+
+        columns = dict()
+        for key in keys:
+            values = [d.get(key) for d in records]
+            present = [v for v in values if v is not None]
+            if present and all(type(v) is int and INT64_MIN <= v <= INT64_MAX for v in present):
+                columns[f"{serie.name}.{key}"] = pd.array(values, dtype="Int64")
+            else:
+                columns[f"{serie.name}.{key}"] = pd.array(values, dtype=object)
+
+        return pd.DataFrame(columns, index=serie.index)
 
 
 class ContractTransactions(Web3ToolKit):
@@ -266,9 +606,9 @@ class ContractTransactions(Web3ToolKit):
     transactions initiated by users to a given smart contract.
     """
 
-    def __init__(self, network):
+    def __init__(self, network: str, config_path: str = None, profile: str = None):
 
-        super().__init__(network)
+        super().__init__(network, config_path, profile)
         self.pagination_offset = 10_000
 
     def request_contract_transactions(self, address: str, start_block: int, end_block: int) -> dict:
@@ -283,49 +623,15 @@ class ContractTransactions(Web3ToolKit):
             dict(any): All the base currencies transactions of the wallet between 2 blocks.
         """
 
-        data = list()
-        request_params = dict()
-        request_params["startblock"] = start_block
-        request_params["endblock"] = end_block
-        request_params["address"] = address
-        request_params["apikey"] = self.api_key
-        request_params["module"] = "account"
-        request_params["action"] = "txlist"
-
-        while True:
-
-            # Collect the data
-            _s, _e = request_params.get("startblock"), request_params.get("endblock")
-            logger.info(f"Extracting transactions from {_s} to {_e} for contract {address}")
-
-            response = requests.post(self.api_url, params=request_params)
-            response = response.json().get("result")
-            data.append(response)
-
-            if not response:
-                logger.info("No data to return for the specified block span.")
-                break
-
-            else:
-                try:
-                    # Handle the exit of the while loop
-                    resp_block = max(int(x.get("blockNumber")) for x in response)
-                    resp_count = len(response)
-                    if resp_block < request_params.get("endblock") and resp_count == self.pagination_offset:
-                        request_params["startblock"] = resp_block
-                        continue
-                    else:
-                        logger.info("Finished downloading all the requested transactions.")
-                        break
-
-                except Exception as e:
-                    logger.error(f"Failed request with ERROR: {e}. Trying again.")
-                    time.sleep(5)
-                    pass
-
-        data = [tx for batch in data for tx in batch] if len(data) > 1 else data[0]
+        params = dict(address=address, module="account", action="txlist")
+        data = [tx for page in self.paginate_explorer(params, start_block, end_block, self.pagination_offset) for tx in page]
+        if self.pagination_shards > 1:
+            # the pages of the shards are received interleaved
+            data.sort(key=lambda tx: (int(tx["blockNumber"]), int(tx.get("transactionIndex") or 0)))
+        logger.info(f"Finished downloading {len(data)} transactions.")
         return data
 
+    @profiled
     def decode_contract_transactions_input(self, contract_transactions: list[dict], contract_instance):
         """Decode the input of transactions executed by a contract.
 
@@ -348,6 +654,7 @@ class ContractTransactions(Web3ToolKit):
 
         return contract_transactions
 
+    @profiled
     def format_contract_transactions_input(self, contract_transactions: list[dict]) -> pd.DataFrame:
         """Format the resulting dataset by replacing hexadecimal values by human readable format.
 
@@ -358,9 +665,7 @@ class ContractTransactions(Web3ToolKit):
         Returns:
             pd.DataFrame: The processed contract transactions data points.
         """
-        df = pd.DataFrame(contract_transactions)
-
-        # Decode hexadecimal numeric values
+        # Decode the decimal numeric values
         integers = [
             "blockNumber",
             "nonce",
@@ -374,7 +679,8 @@ class ContractTransactions(Web3ToolKit):
             "txreceipt_status",
             "isError",
         ]
-        df[integers] = df[integers].apply(lambda x: self.decode_hex_fields(x))
+        df = page_to_frame(contract_transactions, integers)
+        df[integers] = df[integers].apply(self.decode_hex_fields)
 
         # Cast UNIX timestamps to datetime
         df["timeStamp"] = pd.to_datetime(df["timeStamp"], unit="s")
@@ -383,6 +689,9 @@ class ContractTransactions(Web3ToolKit):
         object_fields = df.select_dtypes("object").columns
         df[object_fields] = df[object_fields].astype("str")
 
+        # Dictionary encode the addresses and labels
+        df = self.dictionary_encode(df)
+
         return df
 
     def fetch_contract_transactions(self, address: str, start_block: int, end_block: int) -> list[dict]:
@@ -404,19 +713,27 @@ class ContractTransactions(Web3ToolKit):
         contract_impl_address = self.search_contract_implementation_address(address)
 
         try:
-            if not contract_impl_address or contract_impl_address == "0x0000000000000000":
-                # The contract is not behind any proxy address
-                contract_transactions = self.request_contract_transactions(address, start_block, end_block)
-                contract_instance = self.create_contract_instance(address)
+            labels = dict(network=self.network, dataset="transactions")
+            with metrics.span("fetch", **labels):
+                if not contract_impl_address or contract_impl_address == "0x0000000000000000":
+                    # The contract is not behind any proxy address
+                    contract_transactions = self.request_contract_transactions(address, start_block, end_block)
+                    contract_instance = self.create_contract_instance(address)
 
-            else:
-                # The contract implementation is behind a proxy address
-                contract_proxy_address = Web3.toChecksumAddress(address)
-                contract_transactions = self.request_contract_transactions(contract_proxy_address, start_block, end_block)
-                contract_instance = self.create_contract_instance(address=contract_impl_address)
-
-            contract_transactions = self.decode_contract_transactions_input(contract_transactions, contract_instance)
-            contract_transactions = self.format_contract_transactions_input(contract_transactions)
+                else:
+                    # The contract implementation is behind a proxy address
+                    contract_proxy_address = Web3.toChecksumAddress(address)
+                    contract_transactions = self.request_contract_transactions(contract_proxy_address, start_block, end_block)
+                    contract_instance = self.create_contract_instance(address=contract_impl_address)
+            metrics.inc("rows_total", len(contract_transactions or []), stage="fetch", **labels)
+            if not contract_transactions:
+                return pd.DataFrame()
+
+            with metrics.span("decode", **labels):
+                contract_transactions = self.decode_contract_transactions_input(contract_transactions, contract_instance)
+            with metrics.span("format", **labels):
+                contract_transactions = self.format_contract_transactions_input(contract_transactions)
+            metrics.inc("rows_total", len(contract_transactions), stage="format", **labels)
 
         except Exception as error:
             logger.info(f"Failed retrieving contracts logs because of ERROR: {error}")
@@ -431,66 +748,67 @@ class ContractEventLogs(Web3ToolKit):
     the events logs that have been triggered for a given contract.
     """
 
-    def __init__(self, network: str):
+    def __init__(self, network: str, config_path: str = None, profile: str = None):
 
-        super().__init__(network)
+        super().__init__(network, config_path, profile)
         self.pagination_offset = 1_000
 
-    def request_contract_logs(self, address: str, start_block: int, end_block: int) -> list:
-        """Extract all the logs between 2 blocks for a given contract.
+    def resolve_event_topics(self, address: str, events: list, implementations: list = ()) -> list:
+        """Resolve event names to the topic0 of the matching events of a contract.
+
+        The names are looked up in the standard token events, then in the ABIs of the contract and of its
+        implementations, an overloaded event resolving to the topic0 of all its signatures. The ABIs are only
+        requested for the names which aren't standard events, and topic0 hashes can be given instead of names.
+
+        Args:
+            address (str): The contract address.
+            events (list(str)): The event names (Distribution, LiquidationCall), or topic0 hashes.
+            implementations (list(str)): The implementations of the contract, when it is a proxy.
+
+        Returns:
+            list(str): The 0x prefixed topic0 of the events, empty when none of them is an event of the contract.
+        """
+
+        names = dict(STANDARD_EVENTS)
+        if any(event not in names.values() and not is_topic(event) for event in events):
+            for contract in [address] + [implementation for implementation in implementations if implementation]:
+                names.update({"0x" + bytes(topic).hex(): abi_event["name"] for topic, abi_event in self.request_contract_abi_events(contract).items()})
+
+        topics = [event.lower() for event in events if is_topic(event)] + [topic for topic, name in names.items() if name in events]
+        missing = [event for event in events if not is_topic(event) and event not in names.values()]
+        if missing:
+            logger.warning(f"The events {missing} aren't events of the ABIs of {address}.")
+        return list(dict.fromkeys(topics))
+
+    def request_contract_logs(self, address: str, start_block: int, end_block: int, topics: list = None) -> list:
+        """Extract all the logs between 2 blocks for a given contract, or only the logs of some events.
+
+        The explorers filter the logs on a single topic0 per request, hence the logs of each event are paginated
+        on their own, and merged back in the order of the chain, like the pages of the shards of the span.
 
         Args:
             address (str): The contract address.
             start_block (int): The starting block of the extraction.
             end_block (int): The upper limit block of the extraction.
+            topics (list(str)): The topic0 of the events to extract, None for all the events.
 
         Returns:
             list(dict): All the logs generated by the smart contract between 2 blocks.
         """
 
+        params = dict(address=address, module="logs", action="getLogs")
+        streams = [params] if topics is None else [dict(params, topic0=topic) for topic in topics]
         data = list()
-        request_params = dict()
-        request_params["fromBlock"] = start_block
-        request_params["toBlock"] = end_block
-        request_params["address"] = address
-        request_params["apikey"] = self.api_key
-        request_params["module"] = "logs"
-        request_params["action"] = "getLogs"
-        request_params["offset"] = self.pagination_offset
-
-        while True:
-
-            # Collect the data
-            _s, _e = request_params.get("fromBlock"), request_params.get("toBlock")
-            logger.info(f"Extracting logs from {_s} to {_e} for contract {address}")
-
-            response = requests.post(self.api_url, params=request_params)
-            response = response.json().get("result")
-            data.append(response)
-
-            if not response:
-                logger.info("No data to return for the specified block span.")
-                break
-            else:
-                try:
-                    # Handle the exit of the while loop
-                    resp_block = max(int(x.get("blockNumber"), 16) for x in response)
-                    resp_count = len(response)
-                    if resp_block < request_params.get("toBlock") and resp_count == self.pagination_offset:
-                        request_params["fromBlock"] = resp_block
-                        continue
-                    else:
-                        logger.info("Finished downloading all the requested event logs.")
-                        break
-
-                except Exception as e:
-                    logger.error(f"Failed request with ERROR: {e}. Trying again.")
-                    time.sleep(3)
-                    pass
-
-        data = [tx for batch in data for tx in batch] if len(data) > 1 else data[0]
+        for stream in streams:
+            pages = self.paginate_explorer(stream, start_block, end_block, self.pagination_offset, block_fields=("fromBlock", "toBlock"), base=16)
+            data += [log for page in pages for log in page]
+        if len(streams) > 1 or self.pagination_shards > 1:
+            # the explorers return "0x" for the first log index of a block
+            data.sort(key=lambda log: (int(log["blockNumber"], 16), int(log["logIndex"][2:] or "0", 16)))
+        logger.info(f"Finished downloading {len(data)} event logs.")
         return data
 
+    @profiled
     def decode_contract_logs_data(self, contract_logs: list[dict], contract_abi_events: dict):
         """Decode a list of contract logs by using the events ABI extracted from contract ABI.
 
@@ -505,29 +823,59 @@ class ContractEventLogs(Web3ToolKit):
 
             event["topics"] = [HexBytes(topic) for topic in event["topics"]]
             event["blockHash"] = event.get("blockHash")  # mandatory because accessed in web3 utils
-            decoded_data = list()
 
-            for topic in event["topics"]:
+            # the first topic is the keccak hash of the event signature, the next ones its indexed arguments
+            event_abi = contract_abi_events.get(event["topics"][0]) if event["topics"] else None
 
-                # we match event keccak hash and topics to find the events
-                event_abi = contract_abi_events.get(topic)
+            if is_standard_log(event["topics"], event.get("data", "")):
+                # the standard token events are decoded by whole columns when formatted, see join_decoded_data
+                event["event_name"] = STANDARD_EVENTS[event["topics"][0].hex()]
+                event["decoded_data"] = None
 
-                if event_abi:
-                    # if there's a correspondance between event
-                    event_data = get_event_data(self.w3.codec, event_abi, event)
-                    event_data = dict(event_data.get("args"))
-                    event_data["name"] = event_abi.get("name")
-                    decoded_data.append(event_data)
+            elif event_abi:
+                event_data = get_event_data(self.w3.codec, event_abi, event)
+                event["event_name"] = event_abi.get("name")
+                event["decoded_data"] = {k: (v.hex() if type(v) is bytes else v) for k, v in event_data.get("args").items()}
 
-                else:
-                    # if there's no match, we have to assume there's no logs to decode
-                    event_data = list(dict())
-                    decoded_data.append(event_data)
+            else:
+                # if there's no match, we have to assume there's no logs to decode
+                event["event_name"] = None
+                event["decoded_data"] = None
+
+        return contract_logs
+
+    def decode_contract_logs_history(self, contract_logs: list[dict], address: str, history: list):
+        """Decode the logs of a proxy with the ABI of the implementation it had at the block of each log.
 
-            event["decoded_data"] = decoded_data
+        The events of the proxy's own ABI (upgrades, admin changes) are decoded as well, and the standard token
+        events are decoded without any ABI, the contracts emitting only those not needing a verified ABI.
 
+        Args:
+            contract_logs (list[dict]): The contract logs, which are decoded in place.
+            address (str): The contract address.
+            history (list): The (start block, end block, implementation) ranges of the contract.
+        """
+
+        starts = np.array([start for start, _, _ in history])
+        ranges = np.searchsorted(starts, [int(log["blockNumber"], 16) for log in contract_logs], side="right") - 1
+
+        for i, (_, _, implementation) in enumerate(history):
+            logs = [log for log, r in zip(contract_logs, ranges) if r == i]
+            # the ABIs are only requested for the ranges having other logs than the standard token events
+            if any(not is_standard_log(log["topics"], log.get("data", "")) for log in logs):
+                events = self.request_contract_abi_events(address)
+                events = {**events, **self.request_contract_abi_events(implementation)} if implementation else events
+                self.decode_contract_logs_data(logs, events)
+            elif logs:
+                self.decode_contract_logs_data(logs, dict())
+
+        undecoded = sum(log["event_name"] is None for log in contract_logs)
+        if undecoded:
+            metrics.inc("undecoded_logs_total", undecoded, network=self.network)
+            logger.warning(f"{undecoded} logs of {address} don't match the events of its ABIs.")
         return contract_logs
 
+    @profiled
     def format_contract_logs_data(self, contract_logs: list[dict]) -> pd.DataFrame:
         """Format the resulting dataset by replacing hexadecimal values by human readable format.
 
@@ -538,8 +886,6 @@ class ContractEventLogs(Web3ToolKit):
             pd.DataFrame: The processed contract events logs data points.
         """
 
-        df = pd.DataFrame(contract_logs)
-
         # Decode hexadecimal numeric values
         integers = [
             "blockNumber",
@@ -549,7 +895,8 @@ class ContractEventLogs(Web3ToolKit):
             "logIndex",
             "transactionIndex",
         ]
-        df[integers] = df[integers].apply(lambda x: self.decode_hex_fields(x))
+        df = page_to_frame(contract_logs, integers, base=16)
+        df[integers] = df[integers].apply(self.decode_hex_fields)
 
         # Convert UNIX timestamps to datetime
         df["timeStamp"] = pd.to_datetime(df["timeStamp"], unit="s")
@@ -557,46 +904,51 @@ class ContractEventLogs(Web3ToolKit):
         # Decode the topics binary hexadecimal values
         df["topics"] = self.decode_hex_fields(df["topics"])
 
-        # Normalize nested objects
-        df["decoded_data"] = self.normalize_nested_fields(df["decoded_data"])
-        df["decoded_data"] = self.decode_json_payloads(df["decoded_data"])
+        # Flatten the decoded arguments, keeping them as a JSON payload as well
+        df = self.join_decoded_data(df)
 
         # Convert object to string for parquet storage
         object_fields = df.select_dtypes("object").columns
         df[object_fields] = df[object_fields].astype("str")
 
+        # Dictionary encode the addresses and labels
+        df = self.dictionary_encode(df)
+
         return df
 
-    def fetch_contract_logs(self, address, start_block: int, end_block: int) -> pd.DataFrame:
+    def fetch_contract_logs(self, address, start_block: int, end_block: int, events: list = None) -> pd.DataFrame:
         """Extract and decode the logs of a given smart contract over a specified block span.
 
-        The process is to first obtain the contract ABI, extract the events from the contract ABI,
-        then retrieve all the contract logs from the block explorer API, and finally create a web3
-        contract instance that we can then use to decode the input of the retrieved transactions.
+        The process is to first resolve the implementations the contract had over the block span, then
+        retrieve all the contract logs from the block explorer API, and finally decode each log with the
+        events of the ABI of the implementation at its block. When events are given, only their logs are
+        requested from the explorer, and decoded.
 
         Args:
             address (str): The contract address to query.
             start_block (int): The starting block of the extraction.
             end_block (int): The upper limit block of the extraction.
+            events (list(str)): The names (or topic0) of the events to extract, None for all the events.
 
         Returns:
             dict: The contract logs between 2 blocks, with their decoded data.
         """
-        contract_impl_address = self.search_contract_implementation_address(address)
 
         try:
-            if not contract_impl_address or contract_impl_address == "0x0000000000000000":
-                contract_abi = self.request_contract_abi(address)
-                contract_abi_events = self.create_contract_abi_events(contract_abi)
-                contract_logs = self.request_contract_logs(address, start_block, end_block)
-
-            else:
-                contract_abi = self.request_contract_abi(contract_impl_address)
-                contract_abi_events = self.create_contract_abi_events(contract_abi)
-                contract_logs = self.request_contract_logs(address, start_block, end_block)
-
-            contract_logs = self.decode_contract_logs_data(contract_logs, contract_abi_events)
-            contract_logs = self.format_contract_logs_data(contract_logs)
+            labels = dict(network=self.network, dataset="logs")
+            with metrics.span("fetch", **labels):
+                history = self.request_implementation_history(address, start_block, end_block)
+                topics = self.resolve_event_topics(address, events, [implementation for _, _, implementation in history]) if events else None
+                contract_logs = self.request_contract_logs(address, start_block, end_block, topics) if topics != [] else list()
+            metrics.inc("rows_total", len(contract_logs or []), stage="fetch", **labels)
+            if not contract_logs:
+                return pd.DataFrame()
+
+            with metrics.span("decode", **labels):
+                contract_logs = self.decode_contract_logs_history(contract_logs, address, history)
+            with metrics.span("format", **labels):
+                contract_logs = self.format_contract_logs_data(contract_logs)
+            metrics.inc("rows_total", len(contract_logs), stage="format", **labels)
 
         except Exception as error:
             logger.info(f"Failed retrieving contracts logs because of ERROR: {error}")
@@ -604,6 +956,163 @@ class ContractEventLogs(Web3ToolKit):
         return contract_logs
 
 
+class ExplorerAccountDataset(Web3ToolKit):
+    """Fetch and decode an account dataset of the block explorer for a given smart contract.
+
+    This class inherits from all the Web3ToolKit methods and variables, and is the base of the collectors of the
+    account datasets which the explorer serves already decoded (internal transactions, token transfers), whose
+    pages are decoded and formatted as they are received.
+    """
+
+    # The explorer action of the dataset, and its fields holding integers
+    action, dataset = None, None
+    integers = ["blockNumber", "value", "gas", "gasUsed", "isError"]
+
+    def __init__(self, network: str, config_path: str = None, profile: str = None):
+
+        super().__init__(network, config_path, profile)
+        self.pagination_offset = 10_000
+
+    def iter_account_data(self, address: str, start_block: int, end_block: int):
+        """Stream the pages of the dataset between 2 blocks for a given contract.
+
+        Args:
+            address (str): The contract address.
+            start_block (int): The starting block of the extraction.
+            end_block (int): The upper limit block of the extraction.
+
+        Returns:
+            generator(list(dict)): The rows of the pages of the dataset.
+        """
+
+        params = dict(address=address, module="account", action=self.action)
+        return self.paginate_explorer(params, start_block, end_block, self.pagination_offset)
+
+    def request_account_data(self, address: str, start_block: int, end_block: int) -> list:
+        """Extract all the rows of the dataset between 2 blocks for a given contract.
+
+        Returns:
+            list(dict): The rows of the dataset.
+        """
+
+        return [row for page in self.iter_account_data(address, start_block, end_block) for row in page]
+
+    def decode_decimal_fields(self, serie: pd.Series) -> pd.Series:
+        """Store parsed integers (see parse_integers) as nullable integers, unless they overflow 64 bits integers."""
+
+        if serie.dtype == object and not serie.dropna().map(lambda x: INT64_MIN <= x <= INT64_MAX).all():
+            return serie
+        return serie.astype("Int64")
+
+    @profiled
+    def decode_account_data(self, rows: list[dict]) -> pd.DataFrame:
+        """Decode the integer fields of a page of the dataset.
+
+        Args:
+            rows (list(dict)): The rows of the page.
+
+        Returns:
+            pd.DataFrame: The rows of the page, with their integers decoded.
+        """
+
+        df = page_to_frame(rows, self.integers)
+        integers = [field for field in self.integers if field in df.columns]
+        df[integers] = df[integers].apply(self.decode_decimal_fields)
+        return df
+
+    @profiled
+    def format_account_data(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Format the decoded rows for their storage.
+
+        Args:
+            df (pd.DataFrame): The decoded rows.
+
+        Returns:
+            pd.DataFrame: The formatted rows.
+        """
+
+        # Cast UNIX timestamps to datetime
+        df["timeStamp"] = pd.to_datetime(df["timeStamp"].astype("int64"), unit="s")
+
+        # Convert object to string for parquet storage
+        object_fields = df.select_dtypes("object").columns
+        df[object_fields] = df[object_fields].astype("str")
+
+        return df
+
+    def fetch_account_data(self, address: str, start_block: int, end_block: int) -> pd.DataFrame:
+        """Extract, decode and format the dataset of a given smart contract over a specified block span.
+
+        The pages are decoded and formatted as they are received, rather than once all of them are.
+
+        Args:
+            address (str): The contract address to query.
+            start_block (int): The starting block of the extraction.
+            end_block (int): The upper limit block of the extraction.
+
+        Returns:
+            pd.DataFrame: The rows of the dataset between 2 blocks, by ascending block number.
+        """
+
+        try:
+            labels = dict(network=self.network, dataset=self.dataset)
+            pages, frames = self.iter_account_data(address, start_block, end_block), list()
+            while True:
+                with metrics.span("fetch", **labels):
+                    page = next(pages, None)
+                if page is None:
+                    break
+                metrics.inc("rows_total", len(page), stage="fetch", **labels)
+                with metrics.span("decode", **labels):
+                    df = self.decode_account_data(page)
+                with metrics.span("format", **labels):
+                    df = self.format_account_data(df)
+                metrics.inc("rows_total", len(df), stage="format", **labels)
+                frames.append(df)
+
+        except Exception as error:
+            logger.info(f"Failed retrieving contracts {self.dataset} because of ERROR: {error}")
+            raise ValueError(f"Couldn't retrieve {self.dataset} for {address} ", f"between block #{start_block} and #{end_block}")
+
+        if not frames:
+            return pd.DataFrame()
+        # the pages of the shards are received interleaved, and their string columns are dictionary encoded once
+        with metrics.span("format", **labels):
+            df = pd.concat(frames, ignore_index=True).sort_values("blockNumber", kind="stable", ignore_index=True)
+            return self.dictionary_encode(df)
+
+
+class ContractInternalTransactions(ExplorerAccountDataset):
+    """Fetch the internal transactions (value transfers and contract creations of the traces) of a contract."""
+
+    action, dataset = "txlistinternal", "internal_transactions"
+    integers = ["blockNumber", "value", "gas", "gasUsed", "isError"]
+
+
+class ContractTokenTransfers(ExplorerAccountDataset):
+    """Fetch the ERC-20 token transfers from and to a contract.
+
+    The decoded transfers get their amount in token units as well, from the value and decimals of the token.
+    """
+
+    action, dataset = "tokentx", "token_transfers"
+    integers = ["blockNumber", "nonce", "value", "tokenDecimal", "transactionIndex", "gas", "gasPrice", "gasUsed", "cumulativeGasUsed", "confirmations"]
+
+    @profiled
+    def decode_account_data(self, rows: list[dict]) -> pd.DataFrame:
+
+        df = super().decode_account_data(rows)
+        df["amount"] = df["value"].astype("float64") / 10.0 ** df["tokenDecimal"].fillna(0).astype("float64")
+        return df
+
+
+class ContractNFTTransfers(ExplorerAccountDataset):
+    """Fetch the ERC-721 token transfers from and to a contract."""
+
+    action, dataset = "tokennfttx", "nft_transfers"
+    integers = ["blockNumber", "nonce", "tokenID", "transactionIndex", "gas", "gasPrice", "gasUsed", "cumulativeGasUsed", "confirmations"]
+
+
 if __name__ == "__main__":
 
     network = "polygon"
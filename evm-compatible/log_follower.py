@@ -0,0 +1,250 @@
+"""Follow the event logs of a contract in near real time, rolling back the rows of reorganized blocks.
+
+The follower polls the node for new blocks, fetches their logs with eth_getLogs, decodes them and appends them to
+a sink. The hashes of the blocks which aren't final yet (the last FINALITY_DEPTH blocks) are tracked, so that
+when the node switches to another branch the rows from the fork block onwards are rolled back and collected again.
+
+Usage:
+    python evm-compatible/log_follower.py polygon 0xA0eC9E1542485700110688b3e6FbebBDf23cd901 --output data/follow
+"""
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(dir_path, os.pardir)))
+
+from common.columnar import parse_integers, response_json
+from common.metrics import metrics
+from data_collection import ContractEventLogs
+
+logger = logging.getLogger()
+
+
+class ParquetLogSink:
+    """A sink storing the followed logs as parquet files, one per appended batch of blocks.
+
+    Any object with the same append and rollback methods can be used as a sink by the follower.
+    """
+
+    def __init__(self, path: str):
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def batch_path(self, first_block: int, last_block: int) -> str:
+        return os.path.join(self.path, f"blocks_{first_block:09d}_{last_block:09d}.parquet")
+
+    def append(self, data: pd.DataFrame):
+        """Store the decoded logs of a batch of blocks."""
+
+        path = self.batch_path(data["blockNumber"].min(), data["blockNumber"].max())
+        data.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+    def rollback(self, from_block: int) -> int:
+        """Delete the logs of the blocks from a given block onwards, returning the number of rows deleted."""
+
+        deleted = 0
+        for path in glob.glob(os.path.join(self.path, "blocks_*.parquet")):
+            first_block, last_block = map(int, os.path.basename(path)[len("blocks_") : -len(".parquet")].split("_"))
+            if last_block < from_block:
+                continue
+            data = pd.read_parquet(path)
+            kept = data[data["blockNumber"] < from_block]
+            deleted += len(data) - len(kept)
+            if kept.empty:
+                os.remove(path)
+            else:
+                kept.to_parquet(path + ".tmp", index=False)
+                os.replace(path + ".tmp", self.batch_path(first_block, kept["blockNumber"].max()))
+                os.remove(path)
+        return deleted
+
+    def read(self) -> pd.DataFrame:
+        paths = sorted(glob.glob(os.path.join(self.path, "blocks_*.parquet")))
+        return pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True) if paths else pd.DataFrame()
+
+
+class LogFollower:
+    """Follow the new logs of a contract, tracking the hashes of the non final blocks to detect reorgs.
+
+    Args:
+        client (ContractEventLogs): The logs collector of the network, whose node pool is polled.
+        address (str): The address of the contract to follow.
+        sink: The sink the decoded logs are appended to, and rolled back from on reorgs.
+        start_block (int): The first block to collect, defaults to the latest block.
+        depth (int): The number of blocks that can be reorganized, defaults to the FINALITY_DEPTH of the network.
+        max_range (int): The maximum number of blocks of an eth_getLogs request.
+        events (list(str)): The names (or topic0) of the events to follow, None for all the events.
+    """
+
+    def __init__(self, client: ContractEventLogs, address: str, sink, start_block: int = None, depth: int = None, max_range: int = 2_000, events: list = None):
+
+        self.client = client
+        self.address = address
+        self.sink = sink
+        self.depth = depth or client.config.get(client.network).get("FINALITY_DEPTH", 64)
+        self.max_range = max_range
+        self.block_hashes = OrderedDict()
+        self.cursor, self.head = start_block, None
+
+        implementation = client.search_contract_implementation_address(address)
+        abi_address = implementation if implementation and implementation != "0x0000000000000000" else address
+        self.abi_events = client.create_contract_abi_events(client.request_contract_abi(abi_address))
+        # the node filters the logs on any of the topic0 of the events
+        self.topics = client.resolve_event_topics(address, events, [abi_address]) if events else None
+        if self.topics == []:
+            raise ValueError(f"None of the events {events} is an event of {address}.")
+
+    def rpc(self, requests: list) -> list:
+        """Send a batch of (method, params) JSON-RPC requests to the node pool, and return their results in order."""
+
+        batch = [{"jsonrpc": "2.0", "id": i, "method": method, "params": params} for i, (method, params) in enumerate(requests)]
+        responses = sorted(response_json(self.client.node_pool.post(json=batch)), key=lambda r: r["id"])
+        errors = [r["error"] for r in responses if "error" in r]
+        if errors:
+            raise ConnectionError(f"The node failed answering {len(errors)} requests. ERROR: {errors[0]}")
+        return [r["result"] for r in responses]
+
+    def headers(self, blocks: list) -> dict:
+        """Get the hash and timestamp of a list of blocks, in a single batched request.
+
+        Raises:
+            ConnectionError: The node answered null for some of the blocks, which it doesn't have yet (another node
+                of the pool having served a later head), the step being then retried.
+        """
+
+        results = self.rpc([("eth_getBlockByNumber", [hex(block), False]) for block in blocks])
+        missing = [block for block, r in zip(blocks, results) if r is None]
+        if missing:
+            raise ConnectionError(f"The node doesn't have the blocks {missing[:5]} yet.")
+        return {int(r["number"], 16): (r["hash"], int(r["timestamp"], 16)) for r in results}
+
+    def find_fork_block(self) -> int:
+        """Find the first tracked block whose hash changed, or None when the tracked blocks are still canonical."""
+
+        if not self.block_hashes:
+            return None
+
+        tip = next(reversed(self.block_hashes))
+        if self.headers([tip])[tip][0] == self.block_hashes[tip]:
+            return None
+
+        canonical = self.headers(list(self.block_hashes))
+        for block, block_hash in self.block_hashes.items():
+            if canonical[block][0] != block_hash:
+                return block
+
+    def rollback(self, fork_block: int):
+        """Roll back the rows and tracked hashes of the blocks from the fork block onwards."""
+
+        oldest = next(iter(self.block_hashes))
+        if fork_block == oldest:
+            logger.warning(f"The reorg may be deeper than the {self.depth} tracked blocks, rolling back from block #{fork_block}.")
+        deleted = self.sink.rollback(fork_block)
+        for block in [b for b in self.block_hashes if b >= fork_block]:
+            del self.block_hashes[block]
+        self.cursor = fork_block
+        metrics.inc("reorgs_total", network=self.client.network)
+        metrics.inc("rows_rolled_back_total", deleted, network=self.client.network)
+        logger.info(f"Reorg detected on {self.client.network} at block #{fork_block}, {deleted} rows rolled back.")
+
+    def format_logs(self, logs: list, timestamps: dict) -> pd.DataFrame:
+        """Format the logs returned by the node, like the explorer logs are by format_contract_logs_data."""
+
+        df = pd.DataFrame(logs).drop(columns="removed", errors="ignore")
+        for column in ["blockNumber", "logIndex", "transactionIndex"]:
+            df[column] = parse_integers(df[column], 16)
+        df["timeStamp"] = pd.to_datetime(df["blockNumber"].map(timestamps), unit="s")
+        df["topics"] = df["topics"].map(lambda x: [y.hex() for y in x])
+
+        df = self.client.join_decoded_data(df)
+
+        object_fields = df.select_dtypes("object").columns
+        df[object_fields] = df[object_fields].astype("str")
+        return self.client.dictionary_encode(df)
+
+    def step(self) -> int:
+        """Roll back the reorganized blocks, then collect the logs of the new blocks. Returns the rows appended."""
+
+        fork_block = self.find_fork_block()
+        if fork_block is not None:
+            self.rollback(fork_block)
+
+        self.head = head = int(self.rpc([("eth_blockNumber", [])])[0], 16)
+        self.cursor = head if self.cursor is None else self.cursor
+        if self.cursor > head:
+            return 0
+
+        end = min(self.cursor + self.max_range - 1, head)
+        with metrics.span("fetch", network=self.client.network, dataset="follow_logs"):
+            query = {"address": self.address, "fromBlock": hex(self.cursor), "toBlock": hex(end)}
+            logs = self.rpc([("eth_getLogs", [dict(query, topics=[self.topics]) if self.topics is not None else query])])[0]
+            # the hashes of the non final blocks are tracked, even when they have no logs
+            blocks = sorted({int(log["blockNumber"], 16) for log in logs} | set(range(max(self.cursor, head - self.depth + 1), end + 1)))
+            headers = self.headers(blocks) if blocks else dict()
+
+        # logs from a branch the node switched away from while we were querying it are collected at the next step
+        if any(headers[int(log["blockNumber"], 16)][0] != log["blockHash"] for log in logs):
+            logger.info(f"The logs of blocks #{self.cursor} to #{end} changed while being collected, collecting them again.")
+            return 0
+
+        if logs:
+            with metrics.span("decode", network=self.client.network, dataset="follow_logs"):
+                logs = self.client.decode_contract_logs_data(logs, self.abi_events)
+            with metrics.span("format", network=self.client.network, dataset="follow_logs"):
+                data = self.format_logs(logs, {block: timestamp for block, (_, timestamp) in headers.items()})
+            with metrics.span("sink", network=self.client.network, dataset="follow_logs"):
+                self.sink.append(data)
+            metrics.observe("block_to_row_seconds", time.time() - data["timeStamp"].max().timestamp(), network=self.client.network)
+            metrics.inc("rows_total", len(data), stage="sink", network=self.client.network, dataset="follow_logs")
+
+        for block, (block_hash, _) in headers.items():
+            if block > head - self.depth:
+                self.block_hashes[block] = block_hash
+        while self.block_hashes and next(iter(self.block_hashes)) <= head - self.depth:
+            self.block_hashes.popitem(last=False)
+
+        self.cursor = end + 1
+        return len(logs)
+
+    def follow(self, poll_interval: float = 2.0, duration: float = None):
+        """Collect the new logs until stopped, or during a given number of seconds."""
+
+        started_at = time.monotonic()
+        while duration is None or time.monotonic() - started_at < duration:
+            try:
+                self.step()
+            except ConnectionError as e:
+                logger.error(f"Failed following the logs of {self.address}. ERROR: {e}")
+            # poll right away while catching up, and wait for the next block once at the head
+            if self.head is None or self.cursor > self.head:
+                time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("network")
+    parser.add_argument("address")
+    parser.add_argument("--output", required=True, help="the directory of the collected logs")
+    parser.add_argument("--start-block", type=int, help="defaults to the latest block")
+    parser.add_argument("--depth", type=int, help="number of blocks tracked for reorgs, defaults to the network FINALITY_DEPTH")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--events", nargs="+", help="only follow the logs of these events (names or topic0)")
+    parser.add_argument("--config", help="the networks config, defaults to evm-compatible/config.yaml")
+    args = parser.parse_args()
+
+    client = ContractEventLogs(args.network, config_path=args.config)
+    follower = LogFollower(client, args.address, ParquetLogSink(args.output), start_block=args.start_block, depth=args.depth, events=args.events)
+    follower.follow(poll_interval=args.poll_interval)
@@ -0,0 +1,231 @@
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from eth_abi import decode_abi, encode_abi
+from eth_abi.exceptions import DecodingError
+from eth_utils import function_abi_to_4byte_selector
+from web3._utils.abi import get_abi_input_types, get_abi_output_types
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(dir_path, os.pardir)))
+
+from common.columnar import response_json
+
+logger = logging.getLogger()
+
+# Multicall3 is deployed at the same address on most EVM networks
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+# aggregate3((address target, bool allowFailure, bytes callData)[]) returns ((bool success, bytes returnData)[])
+AGGREGATE3_SELECTOR = "0x82ad56cb"
+
+# The ABI encoding of a result (success flag, data offset and length) and of a static output value, in bytes
+RESULT_OVERHEAD_BYTES, WORD_BYTES = 96, 32
+
+
+def encode_aggregate3(calls: list) -> str:
+    """Encode the calldata of an aggregate3 call, given its (target, allowFailure, callData) structs.
+
+    The structs being the same for every call, they are encoded directly rather than with eth_abi, which is
+    much slower for arrays of thousands of tuples.
+    """
+
+    offsets, tuples, offset = list(), list(), 32 * len(calls)
+    for target, allow_failure, data in calls:
+        padded = data + b"\x00" * (-len(data) % 32)
+        encoded = b"".join([bytes.fromhex(target[2:].rjust(64, "0")), int(allow_failure).to_bytes(32, "big"), (96).to_bytes(32, "big"), len(data).to_bytes(32, "big"), padded])
+        offsets.append(offset.to_bytes(32, "big"))
+        tuples.append(encoded)
+        offset += len(encoded)
+    return AGGREGATE3_SELECTOR + b"".join([(32).to_bytes(32, "big"), len(calls).to_bytes(32, "big")] + offsets + tuples).hex()
+
+
+def decode_aggregate3(result: str) -> list:
+    """Decode the (success, returnData) results of an aggregate3 call."""
+
+    data = bytes.fromhex(result[2:])
+    start = int.from_bytes(data[:32], "big") + 32
+    count = int.from_bytes(data[start - 32 : start], "big")
+    results = list()
+    for i in range(count):
+        position = start + int.from_bytes(data[start + 32 * i : start + 32 * (i + 1)], "big")
+        success = data[position + 31] == 1
+        data_start = position + int.from_bytes(data[position + 32 : position + 64], "big")
+        length = int.from_bytes(data[data_start : data_start + 32], "big")
+        results.append((success, data[data_start + 32 : data_start + 32 + length]))
+    return results
+
+
+def is_word_type(abi_type: str) -> bool:
+    """Whether an ABI type is encoded in a single word, which encode_word and decode_word support."""
+
+    return abi_type in ("address", "bool") or (abi_type.startswith("uint") or abi_type.startswith("int")) and "[" not in abi_type
+
+
+def encode_word(abi_type: str, value) -> bytes:
+    """Encode an address, integer or boolean argument into a 32 bytes word."""
+
+    if abi_type == "address":
+        return bytes.fromhex(value[2:].rjust(64, "0"))
+    return int(value).to_bytes(32, "big", signed=abi_type.startswith("int"))
+
+
+def decode_word(abi_type: str, word: bytes):
+    """Decode an address, integer or boolean output from a 32 bytes word."""
+
+    if abi_type == "address":
+        return "0x" + word[12:].hex()
+    if abi_type == "bool":
+        return word[31] == 1
+    return int.from_bytes(word, "big", signed=abi_type.startswith("int"))
+
+
+def find_function_abi(abi: list, name: str, args: tuple) -> dict:
+    """Find the function of an ABI called with a given number of arguments."""
+
+    for field in abi:
+        if field.get("type") == "function" and field.get("name") == name and len(field.get("inputs", list())) == len(args):
+            return field
+    raise ValueError(f"The ABI has no function {name} taking {len(args)} arguments.")
+
+
+class Multicall:
+    """Aggregate view calls into Multicall3 aggregate3 calls, sent at a given block.
+
+    The calls are split into chunks fitting the eth_call gas cap of the node, and the size limit of its
+    responses, and the chunks are sent concurrently. A chunk the node still refuses (out of gas, response too
+    large) is split in two and sent again. Each call is allowed to fail, a reverted call being reported as such
+    without failing the others.
+
+    Args:
+        client (Web3ToolKit): The collector of the network, whose node pool serves the calls.
+        address (str): The address of the Multicall3 contract.
+        gas_limit (int): The gas cap of the eth_call requests of the node.
+        gas_per_call (int): The estimated gas of a call.
+        max_response_bytes (int): The maximum size of a response.
+        max_workers (int): The number of chunks sent concurrently.
+    """
+
+    def __init__(
+        self,
+        client,
+        address: str = MULTICALL3_ADDRESS,
+        gas_limit: int = 50_000_000,
+        gas_per_call: int = 100_000,
+        max_response_bytes: int = 4_000_000,
+        max_workers: int = 4,
+    ):
+
+        self.client = client
+        self.address = address
+        self.gas_limit = gas_limit
+        self.gas_per_call = gas_per_call
+        self.max_response_bytes = max_response_bytes
+        self.max_workers = max_workers
+
+    def encode_calls(self, calls: list) -> list:
+        """Encode the (address, function ABI, arguments) calls into (target, allowFailure, callData) structs.
+
+        The selector and input types are computed once per function, and the arguments of static one word types
+        (addresses, integers, booleans) are encoded directly, eth_abi being used for the other ones.
+        """
+
+        functions, structs = dict(), list()
+        for address, fn_abi, args in calls:
+            if id(fn_abi) not in functions:
+                types = get_abi_input_types(fn_abi)
+                functions[id(fn_abi)] = (function_abi_to_4byte_selector(fn_abi), types, all(is_word_type(t) for t in types))
+            selector, types, words = functions[id(fn_abi)]
+            data = b"".join(encode_word(t, arg) for t, arg in zip(types, args)) if words else encode_abi(types, args)
+            structs.append((address, True, selector + data))
+        return structs
+
+    def chunks(self, calls: list) -> list:
+        """Split the calls into chunks fitting the gas cap and the response size limit."""
+
+        chunks, chunk, response_bytes = list(), list(), 0
+        max_calls = max(self.gas_limit // self.gas_per_call, 1)
+        for call in calls:
+            call_bytes = RESULT_OVERHEAD_BYTES + WORD_BYTES * max(len(call[1].get("outputs", list())), 1)
+            if chunk and (len(chunk) >= max_calls or response_bytes + call_bytes > self.max_response_bytes):
+                chunks.append(chunk)
+                chunk, response_bytes = list(), 0
+            chunk.append(call)
+            response_bytes += call_bytes
+        return chunks + [chunk] if chunk else chunks
+
+    def aggregate(self, calls: list, block: int) -> list:
+        """Send a chunk of calls in an aggregate3 call, splitting it when the node refuses it.
+
+        Returns:
+            list(tuple): The (success, return data) of each call.
+        """
+
+        data = encode_aggregate3(self.encode_calls(calls))
+        params = [{"to": self.address, "data": data}, hex(block) if isinstance(block, int) else block]
+
+        def request():
+            response = response_json(self.client.node_pool.post(json={"jsonrpc": "2.0", "id": 0, "method": "eth_call", "params": params}))
+            if "error" in response:
+                raise ConnectionError(f"The aggregate3 call of {len(calls)} calls failed. ERROR: {response['error']}")
+            return response["result"]
+
+        immutable = isinstance(block, int) and block <= self.client.finalized_block
+        try:
+            result = self.client.response_cache.fetch(f"{self.client.network}-node", "aggregate3", params, request, immutable)
+        except ConnectionError as e:
+            if len(calls) == 1:
+                raise
+            logger.warning(f"{e} Splitting the chunk in two.")
+            return self.aggregate(calls[: len(calls) // 2], block) + self.aggregate(calls[len(calls) // 2 :], block)
+
+        return decode_aggregate3(result)
+
+    def call(self, calls: list, block) -> list:
+        """Send view calls at a given block.
+
+        Args:
+            calls (list): The (address, function ABI, arguments) calls.
+            block (int | str): The block number, or a block tag (latest, safe, finalized).
+
+        Returns:
+            list(tuple): The (success, return data) of each call, in order.
+        """
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda chunk: self.aggregate(chunk, block), self.chunks(calls)))
+        return [result for chunk in results for result in chunk]
+
+    def decode(self, calls: list, results: list) -> list:
+        """Decode the return data of the calls, the calls of the same function being decoded with the same types.
+
+        Returns:
+            list(dict): The named outputs of each call, None for the failed calls.
+        """
+
+        outputs = [None] * len(calls)
+        functions = dict()
+        for i, (_, fn_abi, _) in enumerate(calls):
+            functions.setdefault(id(fn_abi), (fn_abi, list()))[1].append(i)
+
+        for fn_abi, indices in functions.values():
+            types = get_abi_output_types(fn_abi)
+            names = [output.get("name") or f"output_{j}" for j, output in enumerate(fn_abi.get("outputs", list()))]
+            words = all(is_word_type(t) for t in types)
+            for i in indices:
+                success, data = results[i]
+                try:
+                    if not success:
+                        values = None
+                    elif words and len(data) == WORD_BYTES * len(types):
+                        values = [decode_word(t, data[WORD_BYTES * j : WORD_BYTES * (j + 1)]) for j, t in enumerate(types)]
+                    else:
+                        values = decode_abi(types, data)
+                except DecodingError:
+                    # calls to accounts without code succeed, with empty return data
+                    values = None
+                if values is not None:
+                    outputs[i] = {name: (value.hex() if type(value) is bytes else value) for name, value in zip(names, values)}
+        return outputs
@@ -0,0 +1,132 @@
+import logging
+import os
+import sys
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(dir_path, os.pardir)))
+
+from common.columnar import response_json
+
+logger = logging.getLogger()
+
+# The storage slots where the proxy standards store the address of their implementation (or of their beacon)
+PROXY_SLOTS = {
+    # bytes32(uint256(keccak256("eip1967.proxy.implementation")) - 1)
+    "eip1967": "0x360894a13ba1a3210667c828492db98dca3e2076cc3735a920a3ca505d382bbc",
+    # keccak256("PROXIABLE")
+    "eip1822": "0xc5f16f0fcc639fa48a6947836d9850f504798523bf8c9a3a87d5876cf622bcf7",
+    # bytes32(uint256(keccak256("eip1967.proxy.beacon")) - 1)
+    "beacon": "0xa3f0ad74e5423aebfd80d3ef4346578335a9a72aeaee59ff6cb3582b35133d50",
+}
+
+# The selector of the implementation() function of the beacons
+BEACON_IMPLEMENTATION_SELECTOR = "0x5c60da1b"
+
+
+def parse_address(word: str) -> str:
+    """Get the address stored in the last 20 bytes of a 32 bytes hex word, None for an empty word."""
+
+    address = "0x" + (word or "0x")[2:].rjust(64, "0")[-40:]
+    return None if int(address, 16) == 0 else address
+
+
+class ImplementationHistory:
+    """Resolve the successive implementations of a proxy contract over a span of blocks.
+
+    The implementation slots of the EIP-1967, EIP-1822 and beacon proxies are read at historical blocks, the
+    upgrade points being located by a batched k-ary search: each round reads the slots at `samples` blocks of
+    every span whose bounds hold different implementations, in a single batched request, until the spans are
+    one block wide. An implementation upgraded then reverted between two sampled blocks isn't seen, hence the
+    samples are dense enough for the upgrades of a proxy, which are seldom and far apart.
+
+    Args:
+        client (Web3ToolKit): The collector of the network, whose node pool must serve the historical state.
+        samples (int): The number of blocks read per span and round.
+        batch_size (int): The maximum number of requests of a batch.
+    """
+
+    def __init__(self, client, samples: int = 16, batch_size: int = 500):
+
+        self.client = client
+        self.samples = samples
+        self.batch_size = batch_size
+
+    def rpc(self, requests: list, immutable: bool = False) -> list:
+        """Send (method, params) JSON-RPC requests by batches, through the response cache for final blocks."""
+
+        def request(batch: list):
+            payload = [{"jsonrpc": "2.0", "id": i, "method": method, "params": params} for i, (method, params) in enumerate(batch)]
+            responses = sorted(response_json(self.client.node_pool.post(json=payload)), key=lambda r: r["id"])
+            errors = [r["error"] for r in responses if "error" in r]
+            if errors:
+                raise ConnectionError(f"The node failed answering {len(errors)} historical state requests. ERROR: {errors[0]}")
+            return [r["result"] for r in responses]
+
+        results, endpoint = list(), f"{self.client.network}-node"
+        for i in range(0, len(requests), self.batch_size):
+            batch = requests[i : i + self.batch_size]
+            results += self.client.response_cache.fetch(endpoint, "proxyState", batch, lambda: request(batch), immutable)
+        return results
+
+    def read(self, address: str, blocks: list) -> dict:
+        """Read the implementation of a proxy at a list of blocks, whatever its proxy standard.
+
+        Returns:
+            dict: The implementation address (None when there's none) at each block.
+        """
+
+        standards = list(PROXY_SLOTS)
+        requests = [("eth_getStorageAt", [address, PROXY_SLOTS[standard], hex(block)]) for block in blocks for standard in standards]
+        words = self.rpc(requests, immutable=max(blocks) <= self.client.finalized_block)
+        values = {block: [parse_address(word) for word in words[i * len(standards) : (i + 1) * len(standards)]] for i, block in enumerate(blocks)}
+
+        # the beacon proxies get their implementation from the beacon, which is upgraded instead of the proxy
+        position = standards.index("beacon")
+        beacons = [(block, value[position]) for block, value in values.items() if value[position]]
+        if beacons:
+            calls = [("eth_call", [{"to": beacon, "data": BEACON_IMPLEMENTATION_SELECTOR}, hex(block)]) for block, beacon in beacons]
+            for (block, _), word in zip(beacons, self.rpc(calls, immutable=max(blocks) <= self.client.finalized_block)):
+                values[block][position] = parse_address(word)
+
+        return {block: next((v for v in value if v), None) for block, value in values.items()}
+
+    def sample(self, start_block: int, end_block: int) -> list:
+        """Spread samples blocks over a span, bounds included."""
+
+        step = max((end_block - start_block) / self.samples, 1)
+        return sorted({start_block + round(i * step) for i in range(self.samples + 1) if start_block + round(i * step) <= end_block} | {end_block})
+
+    def resolve(self, address: str, start_block: int, end_block: int) -> list:
+        """Resolve the implementations of a proxy over a span of blocks.
+
+        Args:
+            address (str): The address of the proxy.
+            start_block (int): The first block of the span.
+            end_block (int): The last block of the span.
+
+        Returns:
+            list(tuple): The (start block, end block, implementation) ranges covering the span, the implementation
+                being None over the blocks at which the contract isn't a proxy.
+        """
+
+        known = self.read(address, self.sample(start_block, end_block))
+        if not any(known.values()):
+            return [(start_block, end_block, None)]
+
+        while True:
+            points = sorted(known)
+            spans = [(a, b) for a, b in zip(points, points[1:]) if known[a] != known[b] and b - a > 1]
+            if not spans:
+                break
+            probes = sorted({block for a, b in spans for block in self.sample(a, b)} - set(known))
+            known.update(self.read(address, probes))
+
+        ranges, points = list(), sorted(known)
+        for block in points:
+            if ranges and ranges[-1][2] == known[block]:
+                continue
+            if ranges:
+                ranges[-1][1] = block - 1
+            ranges.append([block, end_block, known[block]])
+        logger.info(f"Resolved {len(ranges)} implementation ranges for {address} between blocks #{start_block} and #{end_block}.")
+        return [tuple(r) for r in ranges]
@@ -10,6 +10,7 @@ parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
 sys.path.insert(0, parent_dir_path)
 
 from data_collection import ContractEventLogs, ContractTransactions
+from stream_state import STREAM_EVENTS, StreamStateEngine, distribution_events, flow_updates
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -87,6 +88,36 @@ class Ricochet:
 
         return data
 
+    def get_stream_states(self, address: str, start_block: int = None, end_block: int = None, checkpoint_path: str = None):
+        """Rebuild the stream rates and balances of the users of an exchange, from its stream and distribution events.
+
+        Only the UpdatedStream and Distribution events are collected, and applied to the checkpoint saved in
+        checkpoint_path (if any), from the block of the last event it applied, the checkpoint being saved again.
+
+        Args:
+            address (str): The exchange address.
+            start_block (int): The starting block of the extraction, defaults to the checkpoint block.
+            end_block (int): The upper limit block of the extraction, defaults to the latest block.
+            checkpoint_path (str): The directory of the checkpoint of the streams states.
+
+        Returns:
+            tuple(pd.DataFrame): The states of the users after each of their updates, and the states of the
+                exchange stream after each distribution (see StreamStateEngine.apply).
+        """
+
+        client = ContractEventLogs(self.network)
+        engine = StreamStateEngine.load(checkpoint_path) if checkpoint_path else StreamStateEngine()
+
+        start_block = start_block if start_block else engine.resume_block(address)
+        end_block = end_block if end_block else client.end_block
+
+        logs = client.fetch_contract_logs(address, start_block, end_block, events=STREAM_EVENTS)
+        updates, distributions = engine.apply(flow_updates(logs), distribution_events(logs))
+        if checkpoint_path:
+            engine.save(checkpoint_path)
+
+        return updates, distributions
+
     def aggregate_contracts_data(self, start_block: int, end_block: int, category: str = "bank") -> pd.DataFrame:
         """Fetch all the transactions of all smart contracts belonging to a given category.
 
@@ -0,0 +1,267 @@
+"""Rebuild the stream rates and balances of the Ricochet users from their decoded flow and distribution events.
+
+The users stream an input token to a Ricochet exchange at a rate (UpdatedStream, or the Superfluid FlowUpdated
+events), and the exchange distributes the output token to them in proportion to their rates (Distribution). The
+state of each (stream, user) pair is replayed from these events by whole columns: the amounts streamed between two
+updates are the rate held times the elapsed time, and the amounts distributed are tracked with a distribution
+index per stream (the amount distributed per unit of rate, accumulated over the distributions), so that a user
+receives its rate times the growth of the index between two updates. The state is checkpointed, so that new events
+are applied on top of it rather than replayed from the first block.
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger()
+
+# The events of the Ricochet exchanges read by the state engine
+STREAM_EVENTS = ["UpdatedStream", "Distribution"]
+
+# Upper bound of the number of logs of a block, for ordering the events by a single integer position
+LOG_INDEX_SPAN = 2**20
+
+USER_DTYPES = {
+    "stream": object,
+    "user": object,
+    "timestamp": "datetime64[ns]",
+    "blockNumber": np.int64,
+    "logIndex": np.int64,
+    "rate": np.float64,
+    "streamed": np.float64,
+    "distributed": np.float64,
+    "index": np.float64,
+}
+STREAM_DTYPES = {
+    "stream": object,
+    "position": np.int64,
+    "timestamp": "datetime64[ns]",
+    "blockNumber": np.int64,
+    "logIndex": np.int64,
+    "total_rate": np.float64,
+    "index": np.float64,
+    "distributed": np.float64,
+}
+POSITION_COLUMNS = ["position", "timestamp", "blockNumber", "logIndex"]
+
+
+def empty_frame(dtypes: dict) -> pd.DataFrame:
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()})
+
+
+def to_floats(serie: pd.Series) -> pd.Series:
+    """Cast the integers of a decoded argument to floats, the uint256 ones being kept as strings by the formatting."""
+
+    if pd.api.types.is_numeric_dtype(serie.dtype):
+        return serie.astype(np.float64).fillna(0.0)
+    return pd.to_numeric(serie.astype(str), errors="coerce").fillna(0.0)
+
+
+def select_events(logs: pd.DataFrame, event: str, value: str, **columns) -> pd.DataFrame:
+    """Select the logs of an event as normalized (stream, [user], position, value) rows.
+
+    Args:
+        logs (pd.DataFrame): Logs formatted by ContractEventLogs.format_contract_logs_data.
+        event (str): The name of the event.
+        value (str): The column of the rate or amount of the event, stored as a float.
+        columns: The stream (and user) columns, by their normalized name.
+
+    Returns:
+        pd.DataFrame: The rows of the event, with their timestamp, block number, log index and position.
+    """
+
+    rows = logs[logs["event_name"].astype(str) == event] if "event_name" in logs else logs.iloc[:0]
+    data = {name: rows[column].astype(str).str.lower() for name, column in columns.items()} if len(rows) else {name: list() for name in columns}
+    data["timestamp"] = rows["timeStamp"] if len(rows) else pd.Series(dtype="datetime64[ns]")
+    data["blockNumber"] = rows["blockNumber"].astype(np.int64) if len(rows) else pd.Series(dtype=np.int64)
+    # the explorers return "0x" for the first log index of a block, which is formatted as a missing value
+    data["logIndex"] = pd.to_numeric(rows["logIndex"], errors="coerce").fillna(0).astype(np.int64) if len(rows) else pd.Series(dtype=np.int64)
+    data["value"] = to_floats(rows[value]) if len(rows) else pd.Series(dtype=np.float64)
+
+    df = pd.DataFrame(data).reset_index(drop=True)
+    df["position"] = df["blockNumber"] * LOG_INDEX_SPAN + df["logIndex"]
+    return df
+
+
+def flow_updates(logs: pd.DataFrame) -> pd.DataFrame:
+    """Extract the (stream, user, rate) updates of the streams from decoded logs.
+
+    The rates are the new rates of the users: UpdatedStream(from, newRate) events are emitted by the exchange they
+    stream to, and the Superfluid FlowUpdated(token, sender, receiver, flowRate) events name it as their receiver.
+    """
+
+    updated = select_events(logs, "UpdatedStream", "decoded_data.newRate", stream="address", user="decoded_data.from")
+    flows = select_events(logs, "FlowUpdated", "decoded_data.flowRate", stream="decoded_data.receiver", user="decoded_data.sender")
+    updates = pd.concat([updated, flows], ignore_index=True) if len(flows) else updated
+    return updates.rename(columns={"value": "rate"}).sort_values("position", kind="stable", ignore_index=True)
+
+
+def distribution_events(logs: pd.DataFrame) -> pd.DataFrame:
+    """Extract the (stream, amount) distributions of the exchanges from decoded logs."""
+
+    distributions = select_events(logs, "Distribution", "decoded_data.totalAmount", stream="address")
+    return distributions.rename(columns={"value": "amount"}).sort_values("position", kind="stable", ignore_index=True)
+
+
+class StreamStateEngine:
+    """Replay the flow updates and distributions of the streams into the states of their users.
+
+    The engine keeps the last state of each (stream, user) pair (its rate, and the amounts streamed and
+    distributed as of its last update) and of each stream (its total rate, distribution index and the position
+    of its last applied event), which is the checkpoint the next events are applied to. The events of a stream at
+    or before its checkpoint are skipped, hence overlapping block spans can be applied, but the events of a
+    stream must be applied in the order of the chain.
+
+    The amounts are floats, in the smallest unit of the tokens: they are meant for analyses, not for accounting.
+
+    Args:
+        users (pd.DataFrame): The checkpointed states of the users, empty by default.
+        streams (pd.DataFrame): The checkpointed states of the streams, empty by default.
+    """
+
+    def __init__(self, users: pd.DataFrame = None, streams: pd.DataFrame = None):
+
+        self.users = users if users is not None else empty_frame(USER_DTYPES)
+        self.streams = streams if streams is not None else empty_frame(STREAM_DTYPES)
+
+    @classmethod
+    def load(cls, path: str) -> "StreamStateEngine":
+        """Load the checkpoint saved in a directory, or start from an empty state when there is none."""
+
+        if not os.path.exists(os.path.join(path, "streams.parquet")):
+            return cls()
+        return cls(pd.read_parquet(os.path.join(path, "users.parquet")), pd.read_parquet(os.path.join(path, "streams.parquet")))
+
+    def save(self, path: str):
+        """Save the checkpoint in a directory, replacing the files atomically."""
+
+        os.makedirs(path, exist_ok=True)
+        for name, df in [("users", self.users), ("streams", self.streams)]:
+            df.to_parquet(os.path.join(path, f"{name}.parquet.tmp"), index=False)
+            os.replace(os.path.join(path, f"{name}.parquet.tmp"), os.path.join(path, f"{name}.parquet"))
+
+    def resume_block(self, stream: str) -> int:
+        """The block from which the events of a stream are to be collected, its checkpoint block included."""
+
+        checkpoint = self.streams.loc[self.streams["stream"] == stream.lower(), "blockNumber"]
+        return int(checkpoint.iloc[0]) if len(checkpoint) else 1
+
+    def new_events(self, events: pd.DataFrame) -> pd.DataFrame:
+        """Drop the events of the streams at or before their checkpoint."""
+
+        checkpoint = events["stream"].map(self.streams.set_index("stream")["position"])
+        return events[checkpoint.isna() | (events["position"] > checkpoint)]
+
+    def apply(self, updates: pd.DataFrame, distributions: pd.DataFrame) -> tuple:
+        """Apply new flow updates and distributions to the checkpointed state.
+
+        Args:
+            updates (pd.DataFrame): The flow updates, see flow_updates.
+            distributions (pd.DataFrame): The distributions, see distribution_events.
+
+        Returns:
+            tuple(pd.DataFrame): The states of the users after each of their updates, and the states of the
+                streams after each distribution (total rate and distribution index), by position.
+        """
+
+        updates = self.new_events(updates).sort_values("position", kind="stable", ignore_index=True)
+        distributions = self.new_events(distributions).sort_values("position", kind="stable", ignore_index=True)
+        streams = self.streams.set_index("stream")
+        checkpoint = self.users.drop(columns=["blockNumber", "logIndex"]).rename(columns=lambda c: c if c in ("stream", "user") else f"checkpoint_{c}")
+        checkpoint["checkpoint_row"] = self.users.index
+        updates = updates.merge(checkpoint, on=["stream", "user"], how="left")
+
+        # the (stream, user) pairs and streams are grouped by their integer codes, the strings being hashed once
+        updates["pair"] = pairs = updates.groupby(["stream", "user"], sort=False).ngroup()
+        codes = pd.factorize(pd.concat([updates["stream"], distributions["stream"]], ignore_index=True))[0]
+        updates["stream_code"], distributions["stream_code"] = codes[: len(updates)], codes[len(updates) :]
+
+        # the total rate of each stream after each update, from the changes of the rates of its users
+        updates["previous_rate"] = updates["rate"].groupby(pairs).shift().fillna(updates["checkpoint_rate"]).fillna(0.0)
+        changes = (updates["rate"] - updates["previous_rate"]).groupby(updates["stream_code"]).cumsum()
+        updates["total_rate"] = updates["stream"].map(streams["total_rate"]).fillna(0.0) + changes
+
+        # each distribution is shared by the users in proportion to their rates at its position, hence adds its amount
+        # per unit of total rate to the distribution index of the stream
+        distributions = pd.merge_asof(distributions, updates[["position", "stream_code", "total_rate"]], on="position", by="stream_code")
+        distributions["total_rate"] = distributions["total_rate"].fillna(distributions["stream"].map(streams["total_rate"])).fillna(0.0)
+        shares = (distributions["amount"] / distributions["total_rate"]).where(distributions["total_rate"] > 0, 0.0)
+        distributions["index"] = distributions["stream"].map(streams["index"]).fillna(0.0) + shares.groupby(distributions["stream_code"]).cumsum()
+        undistributed = distributions["total_rate"] <= 0
+        if undistributed.any():
+            logger.warning(f"{undistributed.sum()} distributions happened while their stream had no inflow, and are attributed to no user.")
+
+        # the amounts streamed and distributed to the users since their previous update, at the rate they held
+        updates = pd.merge_asof(updates, distributions[["position", "stream_code", "index"]], on="position", by="stream_code")
+        updates["index"] = updates["index"].fillna(updates["stream"].map(streams["index"])).fillna(0.0)
+        previous = updates[["timestamp", "index"]].groupby(pairs).shift()
+        elapsed = (updates["timestamp"] - previous["timestamp"].fillna(updates["checkpoint_timestamp"])).dt.total_seconds().fillna(0.0)
+        growth = (updates["index"] - previous["index"].fillna(updates["checkpoint_index"])).fillna(0.0)
+        updates["streamed"] = updates["checkpoint_streamed"].fillna(0.0) + (updates["previous_rate"] * elapsed).groupby(pairs).cumsum()
+        updates["distributed"] = updates["checkpoint_distributed"].fillna(0.0) + (updates["previous_rate"] * growth).groupby(pairs).cumsum()
+
+        self.checkpoint(updates, distributions)
+        return updates[list(USER_DTYPES) + ["position", "total_rate"]], distributions[["stream", *POSITION_COLUMNS, "amount", "total_rate", "index"]]
+
+    def checkpoint(self, updates: pd.DataFrame, distributions: pd.DataFrame):
+        """Move the checkpoint to the last states of the users and streams, from the new states computed by apply."""
+
+        # the last state of each updated user replaces its checkpointed one
+        last = updates[~updates["pair"].duplicated(keep="last")]
+        replaced = last["checkpoint_row"].dropna().astype(np.int64)
+        self.users = pd.concat([self.users.drop(index=replaced), last[list(USER_DTYPES)]], ignore_index=True).astype(USER_DTYPES)
+
+        streams = self.streams.set_index("stream")
+        last_updates = updates[~updates["stream_code"].duplicated(keep="last")].set_index("stream")
+        last_distributions = distributions[~distributions["stream_code"].duplicated(keep="last")].set_index("stream")
+        names = streams.index.union(last_updates.index).union(last_distributions.index)
+        streams = streams.reindex(names)
+        streams["total_rate"] = last_updates["total_rate"].reindex(names).fillna(streams["total_rate"]).fillna(0.0)
+        streams["index"] = last_distributions["index"].reindex(names).fillna(streams["index"]).fillna(0.0)
+        streams["distributed"] = streams["distributed"].fillna(0.0) + distributions.groupby("stream")["amount"].sum().reindex(names).fillna(0.0)
+        positions = pd.concat([last_updates[POSITION_COLUMNS], last_distributions[POSITION_COLUMNS]]).sort_values("position", kind="stable")
+        positions = positions[~positions.index.duplicated(keep="last")]
+        streams.loc[positions.index, POSITION_COLUMNS] = positions
+        self.streams = streams.rename_axis("stream").reset_index().astype(STREAM_DTYPES)
+
+    def snapshot(self, timestamp: pd.Timestamp = None) -> pd.DataFrame:
+        """The states of the users at a time after the checkpoint, defaults to the time of its last event.
+
+        The amounts are brought forward from the last update of each user: the amount streamed since then at
+        its rate, and the amount distributed to it by the distributions applied since then.
+        """
+
+        timestamp = timestamp if timestamp is not None else self.streams["timestamp"].max()
+        users = self.users.copy()
+        elapsed = (timestamp - users["timestamp"]).dt.total_seconds().clip(lower=0)
+        users["streamed"] += users["rate"] * elapsed
+        users["distributed"] += users["rate"] * (users["stream"].map(self.streams.set_index("stream")["index"]) - users["index"])
+        users["timestamp"] = timestamp
+        return users.drop(columns="index")
+
+
+def sample_states(updates: pd.DataFrame, distributions: pd.DataFrame, times) -> pd.DataFrame:
+    """Sample the states of the users at regular times, from the outputs of StreamStateEngine.apply.
+
+    The last update of each user before each time, and the last distribution index of its stream, are found with
+    as-of joins, the amounts being brought forward from the update to the time like in StreamStateEngine.snapshot.
+
+    Args:
+        updates (pd.DataFrame): The states of the users after each of their updates.
+        distributions (pd.DataFrame): The states of the streams after each distribution.
+        times (list | pd.DatetimeIndex): The times of the samples.
+
+    Returns:
+        pd.DataFrame: The (stream, user, time) states of the users having started streaming by then.
+    """
+
+    grid = updates[["stream", "user"]].drop_duplicates().merge(pd.DataFrame({"time": pd.to_datetime(times)}), how="cross").sort_values("time", kind="stable")
+    states = pd.merge_asof(grid, updates.sort_values("timestamp", kind="stable"), left_on="time", right_on="timestamp", by=["stream", "user"])
+    indexes = distributions[["timestamp", "stream", "index"]].rename(columns={"timestamp": "distributed_at", "index": "time_index"})
+    states = pd.merge_asof(states, indexes.sort_values("distributed_at", kind="stable"), left_on="time", right_on="distributed_at", by="stream")
+    states = states[states["timestamp"].notna()].copy()
+
+    states["streamed"] += states["rate"] * (states["time"] - states["timestamp"]).dt.total_seconds()
+    states["distributed"] += states["rate"] * (states["time_index"].fillna(states["index"]) - states["index"]).clip(lower=0)
+    return states[["stream", "user", "time", "rate", "streamed", "distributed"]].reset_index(drop=True)
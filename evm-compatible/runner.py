@@ -0,0 +1,421 @@
+"""Collect the transactions and event logs of all the contracts listed in a protocol config.
+
+The runner plans (network, contract, dataset, block range) work units from the networks and contracts of a
+protocol config, runs them concurrently and writes each of them to a parquet file partitioned by dataset, network
+and contract. The explorer requests of a network share the RATE_LIMIT budgets (one per API key) set in evm-compatible/config.yaml.
+The plan is saved along with the outputs, so that an interrupted or timed out run is resumed where it stopped.
+
+For large backfills, the units can instead be enqueued in a durable SQLite work queue, from which any number of
+worker processes of the host storing the queue lease them. The workers share the explorer rate budgets of the API
+keys stored in the queue database, and the outputs being written atomically to deterministic paths, a unit ran
+twice after a lease expiry is simply overwritten.
+
+Usage:
+    python evm-compatible/runner.py evm-compatible/ricochet/config.yaml --output data/ricochet
+    python evm-compatible/runner.py evm-compatible/stake_dao/config.yaml --output data/stake_dao --datasets logs --deadline 3600
+    python evm-compatible/runner.py evm-compatible/stake_dao/config.yaml --output data/stake_dao --queue data/queue.sqlite --enqueue
+    python evm-compatible/runner.py evm-compatible/stake_dao/config.yaml --output data/stake_dao --queue data/queue.sqlite --work
+"""
+
+import argparse
+import functools
+import itertools
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import yaml
+from web3 import Web3
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(dir_path, os.pardir)))
+
+from common.metrics import metrics
+from common.rate_limit import SQLiteTokenBucket
+from common.work_queue import WorkQueue
+from bloom_filter import BloomPrefilter
+from data_collection import ContractEventLogs, ContractInternalTransactions, ContractNFTTransfers, ContractTokenTransfers, ContractTransactions
+
+logger = logging.getLogger()
+
+# The collector class and method of each dataset
+DATASETS = {
+    "transactions": (ContractTransactions, "fetch_contract_transactions"),
+    "logs": (ContractEventLogs, "fetch_contract_logs"),
+    "internal_transactions": (ContractInternalTransactions, "fetch_account_data"),
+    "token_transfers": (ContractTokenTransfers, "fetch_account_data"),
+    "nft_transfers": (ContractNFTTransfers, "fetch_account_data"),
+}
+
+# The datasets collected unless others are requested
+DEFAULT_DATASETS = ["transactions", "logs"]
+
+
+def parse_contracts(protocol_config: dict) -> list:
+    """List the (network, contract) pairs of a protocol config.
+
+    The contracts are either listed directly, or grouped by network (stake_dao) or by category (ricochet), the
+    contracts which aren't grouped by network being collected on all the networks of the config.
+    """
+
+    networks = [key for key, value in protocol_config.items() if isinstance(value, dict) and "API_URL" in value]
+    contracts = protocol_config.get("contracts") or list()
+    groups = contracts.items() if isinstance(contracts, dict) else [(None, contracts)]
+
+    pairs = list()
+    for group, addresses in groups:
+        for network in [group] if group in networks else networks:
+            pairs += [(network, Web3.toChecksumAddress(address)) for address in addresses]
+    return list(dict.fromkeys(pairs))
+
+
+class CollectionRunner:
+    """Plan and run the collection of the datasets of the contracts of a protocol config."""
+
+    def __init__(
+        self,
+        protocol_config_path: str,
+        output_dir: str,
+        datasets: list = None,
+        networks: list = None,
+        start_block: int = 1,
+        end_block: int = None,
+        chunk_size: int = 5_000_000,
+        max_workers: int = 8,
+        config_path: str = None,
+        rate_budget_path: str = None,
+        bloom_prefilter: bool = False,
+        merge_gap: int = 10_000,
+        events: list = None,
+    ):
+
+        self.protocol_config = yaml.safe_load(open(protocol_config_path))
+        self.output_dir = output_dir
+        self.plan_path = os.path.join(output_dir, "plan.json")
+        self.datasets = datasets or DEFAULT_DATASETS
+        self.networks = networks
+        self.start_block, self.end_block = start_block, end_block
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.config_path = config_path
+        self.rate_budget_path = rate_budget_path
+        self.bloom_prefilter, self.merge_gap = bloom_prefilter, merge_gap
+        self.events = events
+
+        self.clients = dict()
+        self.prefilters, self.prefilter_locks = dict(), defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+        self.units = list()
+
+    def client(self, network: str, dataset: str):
+        """The collector of a dataset on a network, created on first use and shared by the work units.
+
+        When a rate budget path is set, the explorer requests draw from a budget shared by all the processes.
+        """
+
+        with self.lock:
+            if (network, dataset) not in self.clients:
+                client = DATASETS[dataset][0](network, config_path=self.config_path)
+                if self.rate_budget_path:
+                    client.key_pool.use_buckets(lambda name, rate: SQLiteTokenBucket(self.rate_budget_path, name, rate))
+                self.clients[(network, dataset)] = client
+            return self.clients[(network, dataset)]
+
+    def prefilter(self, network: str, start_block: int, end_block: int) -> BloomPrefilter:
+        """The bloom prefilter of all the contracts of a network over a block range, scanned once for all of them."""
+
+        client = self.client(network, "logs")
+        key = (network, start_block, end_block)
+        with self.lock:
+            lock = self.prefilter_locks[key]
+        with lock:
+            if key not in self.prefilters:
+                addresses = [contract for n, contract in parse_contracts(self.protocol_config) if n == network]
+                topics = None
+                if self.events:
+                    # the blocks are only candidates when their bloom may contain one of the events of the contracts
+                    topics = list()
+                    for address in addresses:
+                        history = client.request_implementation_history(address, start_block, end_block)
+                        topics += client.resolve_event_topics(address, self.events, [implementation for _, _, implementation in history])
+                    topics = list(dict.fromkeys(topics))
+                prefilter = BloomPrefilter(client, addresses, topics=topics)
+                prefilter.scan(start_block, end_block)
+                self.prefilters[key] = prefilter
+        return self.prefilters[key]
+
+    def index_block_times(self) -> int:
+        """Fill the block time index of the networks over the final blocks of the collected span.
+
+        Returns:
+            int: The number of blocks added to the indexes.
+        """
+
+        indexed = 0
+        for network in dict.fromkeys(n for n, _ in parse_contracts(self.protocol_config) if not self.networks or n in self.networks):
+            client = self.client(network, "logs")
+            end_block = min(self.end_block or client.finalized_block, client.finalized_block)
+            missing = client.block_times.missing(self.start_block, end_block)
+            client.block_times.fill(client.node_pool, missing, client.finalized_block)
+            logger.info(f"Indexed the timestamps of {len(missing)} blocks of {network}.")
+            indexed += len(missing)
+        return indexed
+
+    def plan(self, replan: bool = False) -> list:
+        """Plan the work units, or load the plan of a previous run so that it is resumed.
+
+        The units of the different networks are interleaved, so that they progress concurrently.
+        """
+
+        if os.path.exists(self.plan_path) and not replan:
+            self.units = json.load(open(self.plan_path))
+            done = sum(unit["status"] == "done" for unit in self.units)
+            logger.info(f"Resuming the plan of {self.plan_path}: {done}/{len(self.units)} units already done.")
+            return self.units
+
+        units_by_network = dict()
+        for network, contract in parse_contracts(self.protocol_config):
+            if self.networks and network not in self.networks:
+                continue
+            end_block = self.end_block or self.client(network, self.datasets[0]).end_block
+            for dataset in self.datasets:
+                for start in range(self.start_block, end_block + 1, self.chunk_size):
+                    end = min(start + self.chunk_size - 1, end_block)
+                    units_by_network.setdefault(network, list()).append(
+                        dict(
+                            id=f"{dataset}/{network}/{contract}/{start}-{end}",
+                            network=network,
+                            contract=contract,
+                            dataset=dataset,
+                            start_block=start,
+                            end_block=end,
+                            status="pending",
+                            rows=None,
+                            attempts=0,
+                            error=None,
+                        )
+                    )
+
+        interleaved = itertools.zip_longest(*units_by_network.values())
+        self.units = [unit for units in interleaved for unit in units if unit is not None]
+        self.save_plan()
+        logger.info(f"Planned {len(self.units)} units over {len(units_by_network)} networks.")
+        return self.units
+
+    def save_plan(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self.lock:
+            json.dump(self.units, open(self.plan_path + ".tmp", "w"), indent=1)
+            os.replace(self.plan_path + ".tmp", self.plan_path)
+
+    def output_path(self, unit: dict) -> str:
+        """The path of the output of a unit, partitioned by dataset, network and contract."""
+
+        return os.path.join(
+            self.output_dir,
+            unit["dataset"],
+            f"network={unit['network']}",
+            f"contract={unit['contract']}",
+            f"blocks_{unit['start_block']:09d}_{unit['end_block']:09d}.parquet",
+        )
+
+    def run_unit(self, unit: dict) -> int:
+        """Collect the dataset of a unit and write it, returning the number of rows collected."""
+
+        client = self.client(unit["network"], unit["dataset"])
+        fetch = getattr(client, DATASETS[unit["dataset"]][1])
+        if self.events and unit["dataset"] == "logs":
+            fetch = functools.partial(fetch, events=self.events)
+
+        if self.bloom_prefilter and unit["dataset"] == "logs":
+            # the logs are only requested over the blocks whose bloom may contain the contract address
+            prefilter = self.prefilter(unit["network"], unit["start_block"], unit["end_block"])
+            ranges = prefilter.ranges(unit["contract"], self.merge_gap)
+            if ranges:
+                # the implementations of the contract are resolved once for the unit, rather than for each range
+                client.request_implementation_history(unit["contract"], unit["start_block"], unit["end_block"])
+            data = pd.concat([fetch(unit["contract"], start, end) for start, end in ranges] + [pd.DataFrame()], ignore_index=True)
+            # the categories of the ranges differ, hence their concatenation is dictionary encoded again
+            data = client.dictionary_encode(data)
+        else:
+            data = fetch(unit["contract"], unit["start_block"], unit["end_block"])
+
+        if data.empty:
+            return 0
+
+        path = self.output_path(unit)
+        with metrics.span("sink", network=unit["network"], dataset=unit["dataset"]):
+            # the temporary file is unique, since a unit may be ran concurrently by two workers after a lease expiry
+            tmp_path = f"{path}.{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}.tmp"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        metrics.inc("rows_total", len(data), stage="sink", network=unit["network"], dataset=unit["dataset"])
+        return len(data)
+
+    def run(self, deadline: float = None) -> pd.DataFrame:
+        """Run the pending and failed units of the plan, and summarize their status per network and dataset.
+
+        Args:
+            deadline (float): The number of seconds after which no new unit is started, the remaining ones
+                being left pending for the next run.
+        """
+
+        started_at = time.monotonic()
+        pending = [unit for unit in self.units if unit["status"] != "done"]
+
+        def run_unit(unit: dict):
+            if deadline is not None and time.monotonic() - started_at > deadline:
+                return None
+            return self.run_unit(unit)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(run_unit, unit): unit for unit in pending}
+            for future in as_completed(futures):
+                unit = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    logger.error(f"Unit {unit['id']} failed. ERROR: {e}")
+                    unit.update(status="failed", attempts=unit["attempts"] + 1, error=str(e))
+                else:
+                    if rows is None:
+                        continue
+                    unit.update(status="done", rows=rows, attempts=unit["attempts"] + 1, error=None)
+                self.save_plan()
+
+        summary = pd.DataFrame(self.units).groupby(["network", "dataset", "status"]).agg(units=("id", "size"), rows=("rows", "sum"))
+        return summary.reset_index()
+
+    def enqueue(self, queue: WorkQueue) -> int:
+        """Enqueue the units of the plan which aren't done yet, returning the number of units enqueued."""
+
+        return queue.put([unit for unit in self.units if unit["status"] != "done"])
+
+    def work(self, queue: WorkQueue, worker: str = None, lease_seconds: float = 300, deadline: float = None) -> pd.DataFrame:
+        """Run the units leased from a work queue until it is drained, and return the queue statistics.
+
+        Each of the max_workers threads leases its own units, their leases being extended by heartbeats while
+        they run.
+
+        Args:
+            queue (WorkQueue): The queue of the units to run.
+            worker (str): The name of the worker, defaults to the host name and process id.
+            lease_seconds (float): The duration of the leases, after which a unit is given to another worker.
+            deadline (float): The number of seconds after which no new unit is leased.
+        """
+
+        worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+        started_at = time.monotonic()
+        leased = dict()
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(lease_seconds / 3):
+                for task_id, name in list(leased.items()):
+                    if not queue.heartbeat(task_id, name, lease_seconds):
+                        logger.warning(f"{name} lost the lease of unit {task_id}.")
+
+        def work_loop(slot: int):
+            name = f"{worker}-{slot}"
+            while deadline is None or time.monotonic() - started_at < deadline:
+                unit = queue.lease(name, lease_seconds)
+                if unit is None:
+                    break
+                leased[unit["id"]] = name
+                try:
+                    rows = self.run_unit(unit)
+                except Exception as e:
+                    logger.error(f"Unit {unit['id']} failed (attempt #{unit['attempts']}). ERROR: {e}")
+                    queue.fail(unit["id"], name, str(e))
+                else:
+                    queue.complete(unit["id"], name, rows)
+                finally:
+                    leased.pop(unit["id"], None)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(work_loop, range(self.max_workers)))
+        finally:
+            stopped.set()
+
+        return queue.stats()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("protocol_config", help="the protocol config listing the networks and contracts to collect")
+    parser.add_argument("--output", required=True, help="the directory of the partitioned outputs and of the plan")
+    parser.add_argument("--datasets", nargs="+", default=DEFAULT_DATASETS, choices=list(DATASETS))
+    parser.add_argument("--networks", nargs="+", help="only collect the contracts of these networks")
+    parser.add_argument("--start-block", type=int, default=1)
+    parser.add_argument("--end-block", type=int, help="defaults to the latest block of each network")
+    parser.add_argument("--chunk-size", type=int, default=5_000_000, help="number of blocks of a work unit")
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--deadline", type=float, help="number of seconds after which no new unit is started")
+    parser.add_argument("--replan", action="store_true", help="discard the plan of a previous run")
+    parser.add_argument("--config", help="the networks config, defaults to evm-compatible/config.yaml")
+    parser.add_argument("--metrics", help="path where to write the collected metrics, in the Prometheus text format")
+    parser.add_argument("--queue", help="the SQLite work queue, for running the units with several worker processes")
+    parser.add_argument("--enqueue", action="store_true", help="plan the units and enqueue them in the work queue")
+    parser.add_argument("--work", action="store_true", help="run the units leased from the work queue")
+    parser.add_argument("--worker-id", help="the name of the worker, defaults to the host name and process id")
+    parser.add_argument("--lease-seconds", type=float, default=300)
+    parser.add_argument("--bloom-prefilter", action="store_true", help="only request the logs of the blocks whose bloom may contain the contract")
+    parser.add_argument("--merge-gap", type=int, default=10_000, help="candidate block ranges closer than this are requested at once")
+    parser.add_argument("--events", nargs="+", help="only collect the logs of these events (names or topic0), rather than all the logs")
+    parser.add_argument("--index-block-times", action="store_true", help="fill the block time index of the networks before collecting")
+    args = parser.parse_args()
+
+    runner = CollectionRunner(
+        args.protocol_config,
+        args.output,
+        datasets=args.datasets,
+        networks=args.networks,
+        start_block=args.start_block,
+        end_block=args.end_block,
+        chunk_size=args.chunk_size,
+        max_workers=args.max_workers,
+        config_path=args.config,
+        rate_budget_path=args.queue,
+        bloom_prefilter=args.bloom_prefilter,
+        merge_gap=args.merge_gap,
+        events=args.events,
+    )
+
+    if args.index_block_times:
+        runner.index_block_times()
+
+    if args.queue and (args.enqueue or args.work):
+        queue = WorkQueue(args.queue)
+        if args.enqueue:
+            runner.plan(replan=args.replan)
+            logger.info(f"Enqueued {runner.enqueue(queue)} new units in {args.queue}.")
+        if args.work:
+            runner.work(queue, worker=args.worker_id, lease_seconds=args.lease_seconds, deadline=args.deadline)
+        summary = queue.stats()
+        # the units leased by other workers or pending are not failures of this worker
+        failed = summary["status"] == "failed"
+    else:
+        runner.plan(replan=args.replan)
+        summary = runner.run(deadline=args.deadline)
+        failed = summary["status"] != "done"
+    print(summary.to_string(index=False))
+
+    if args.metrics:
+        metrics.write_prometheus(args.metrics)
+
+    if failed.any():
+        sys.exit(1)
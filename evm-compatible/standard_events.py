@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+from eth_utils import to_checksum_address
+
+# The topic0 of the standard ERC-20 and ERC-721 events, which share their signatures
+STANDARD_EVENTS = {
+    "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef": "Transfer",
+    "0x8c5be1e5ebec7d5bd14f71427d1e84f3dd0314c0f7b2291e5b200ac8c7c3b925": "Approval",
+}
+
+# The arguments of the events, by (event, is ERC-721): the ERC-20 events have 2 indexed addresses and their
+# amount in the data, the ERC-721 ones having their token id indexed as a third topic
+STANDARD_ARGUMENTS = {
+    ("Transfer", False): ("from", "to", "value"),
+    ("Transfer", True): ("from", "to", "tokenId"),
+    ("Approval", False): ("owner", "spender", "value"),
+    ("Approval", True): ("owner", "approved", "tokenId"),
+}
+
+
+def is_standard_log(topics: list, data: str) -> bool:
+    """Whether a log is a standard ERC-20 (3 topics and a 32 bytes amount) or ERC-721 (4 topics, no data) event."""
+
+    topic0 = topics[0] if topics else None
+    if (topic0.hex() if isinstance(topic0, bytes) else topic0) not in STANDARD_EVENTS:
+        return False
+    return (len(topics) == 3 and len(data) == 66) or (len(topics) == 4 and data in ("0x", ""))
+
+
+def decode_uint256(words: pd.Series) -> pd.Series:
+    """Decode a column of hex encoded 32 bytes unsigned integers at once, from their 64 bits limbs.
+
+    The column is stored as nullable integers when all the values fit in 64 bits signed integers, the larger
+    values (uint256 amounts) being recombined from their limbs into Python integers otherwise.
+    """
+
+    limbs = np.frombuffer(bytes.fromhex("".join(word[-64:] for word in words)), dtype=">u8").reshape(-1, 4)
+    if (limbs[:, :3] == 0).all() and (limbs[:, 3] < 2**63).all():
+        return pd.Series(pd.array(limbs[:, 3].astype(np.int64), dtype="Int64"), index=words.index)
+    limbs = limbs.astype(object)
+    return pd.Series((limbs[:, 0] << 192) | (limbs[:, 1] << 128) | (limbs[:, 2] << 64) | limbs[:, 3], index=words.index, dtype=object)
+
+
+def decode_addresses(topics: pd.Series) -> pd.Series:
+    """Decode a column of topics holding addresses, checksummed like web3 does, once per distinct address."""
+
+    addresses = "0x" + topics.str[26:]
+    return addresses.map({address: to_checksum_address(address) for address in addresses.unique()})
+
+
+def decode_standard_events(df: pd.DataFrame, prefix: str = "decoded_data") -> pd.DataFrame:
+    """Decode standard ERC-20 and ERC-721 logs by whole columns, from their hex topics and data, without any ABI.
+
+    Args:
+        df (pd.DataFrame): Standard logs (see is_standard_log), with their topics as lists of hex strings.
+        prefix (str): The name of the decoded arguments payload column, and prefix of the arguments columns.
+
+    Returns:
+        pd.DataFrame: The decoded arguments columns of the logs, and their arguments as a JSON payload (formatted
+            like json.dumps does) in the prefix column.
+    """
+
+    topics = df["topics"]
+    events = topics.str[0].map(STANDARD_EVENTS)
+    erc721 = topics.str.len() == 4
+
+    columns, payloads = dict(), list()
+    for (event, is_erc721), (first, second, amount) in STANDARD_ARGUMENTS.items():
+        rows = (events == event) & (erc721 == is_erc721)
+        if not rows.any():
+            continue
+        group = topics[rows]
+        values = {first: decode_addresses(group.str[1]), second: decode_addresses(group.str[2])}
+        values[amount] = decode_uint256(group.str[3] if is_erc721 else df.loc[rows, "data"])
+        for argument, serie in values.items():
+            columns.setdefault(argument, list()).append(serie)
+        payloads.append(
+            f'{{"{first}": "' + values[first] + f'", "{second}": "' + values[second] + f'", "{amount}": ' + values[amount].astype(str) + "}"
+        )
+
+    decoded = pd.DataFrame({f"{prefix}.{argument}": pd.concat(parts) for argument, parts in columns.items()}, index=df.index)
+    decoded[prefix] = pd.concat(payloads) if payloads else None
+    return decoded
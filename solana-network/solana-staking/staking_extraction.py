@@ -1,13 +1,185 @@
+import base64
 import datetime
+import json
+import logging
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import requests
+import yaml
+from base58 import b58encode
+from requests.adapters import HTTPAdapter
 from solana.publickey import PublicKey
-from solana.rpc.api import Client
 from solana.rpc.types import MemcmpOpts
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+from vote_credits import VoteCreditsStore
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(dir_path, os.pardir, os.pardir)))
+
+from common.columnar import response_json
+from common.endpoint_pool import EndpointPool, is_retryable_rpc_response
+from common.metrics import metrics
+from common.response_cache import ResponseCache
+
+logger = logging.getLogger()
+
+STAKE_PROGRAM_ID: PublicKey = PublicKey("Stake11111111111111111111111111111111111111")
+
+# Stake accounts have a fixed size layout (see StakeState in the solana stake program), the delegation voter
+# pubkey being at offset 124. Pubkeys are kept as raw 32 bytes and base58 encoded once per distinct value.
+STAKE_ACCOUNT_SIZE = 200
+STAKE_VOTER_OFFSET = 124
+STAKE_ACCOUNT_DTYPE = np.dtype(
+    {
+        "names": [
+            "state",
+            "rentExemptReserve",
+            "staker",
+            "withdrawer",
+            "lockupUnixTimestamp",
+            "lockupEpoch",
+            "custodian",
+            "voter",
+            "stake",
+            "activationEpoch",
+            "deactivationEpoch",
+            "warmupCooldownRate",
+            "creditsObserved",
+        ],
+        "formats": ["<u4", "<u8", "V32", "V32", "<i8", "<u8", "V32", "V32", "<u8", "<u8", "<u8", "<f8", "<u8"],
+        "offsets": [0, 4, 12, 44, 76, 84, 92, STAKE_VOTER_OFFSET, 156, 164, 172, 180, 188],
+        "itemsize": STAKE_ACCOUNT_SIZE,
+    }
+)
+STAKE_STATE_DELEGATED = 2
+U64_MAX = np.iinfo(np.uint64).max
+
+BASE58_ALPHABET = np.frombuffer(b"123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz", dtype=np.uint8)
+BASE58_DIGITS = 45  # 58**45 > 2**256, i.e. enough digits for a 32 bytes pubkey, and a multiple of 5
+BASE58_CHUNK = np.uint64(58**5)
+
+
+def has_result(payload: dict) -> bool:
+    """Whether a JSON-RPC response has a result, i.e. can be cached when it targets a closed epoch or a finalized block."""
+    return payload.get("result") is not None
+
+
+def encode_pubkeys(values: np.ndarray) -> np.ndarray:
+    """Base58 encode an array of raw 32 bytes pubkeys.
+
+    The pubkeys are handled as 256 bits integers split in 8 big endian uint32 limbs, which are divided by 58**5
+    at once so that the whole column is encoded with a few dozens of vectorized operations.
+    """
+
+    raw = np.ascontiguousarray(values).view(np.uint8).reshape(-1, 32)
+    limbs = np.ascontiguousarray(raw.view(">u4").astype(np.uint64).T)
+    digits = np.zeros((BASE58_DIGITS, raw.shape[0]), dtype=np.uint8)
+
+    for chunk in range(BASE58_DIGITS // 5):
+        remainder = np.zeros(raw.shape[0], dtype=np.uint64)
+        # the most significant limbs progressively become null for all the pubkeys and can be skipped
+        for i in range(limbs.any(axis=1).argmax(), limbs.shape[0]):
+            limbs[i], remainder = np.divmod((remainder << np.uint64(32)) | limbs[i], BASE58_CHUNK)
+        for j in range(5):
+            remainder, digits[BASE58_DIGITS - 1 - chunk * 5 - j] = np.divmod(remainder, np.uint64(58))
+
+    # Leading zero bytes are encoded as '1' (the zero digit), the other leading zero digits are dropped. There
+    # are only a handful of distinct numbers of digits to drop, so the rows are shifted by groups.
+    digits = digits.T
+    leading_bytes = np.where(raw.any(axis=1), (raw != 0).argmax(axis=1), raw.shape[1])
+    leading_digits = np.where(digits.any(axis=1), (digits != 0).argmax(axis=1), BASE58_DIGITS)
+    drop = leading_digits - leading_bytes
+
+    chars = BASE58_ALPHABET[digits]
+    encoded = np.zeros(chars.shape, dtype=np.uint8)
+    for d in np.unique(drop):
+        rows = drop == d
+        encoded[rows, : BASE58_DIGITS - d] = chars[rows, d:]
+
+    return encoded.view(f"S{BASE58_DIGITS}").ravel().astype(str).astype(object)
+
+
+def mask_unset_epochs(values: np.ndarray) -> pd.arrays.IntegerArray:
+    """Cast u64 epochs to nullable integers, the u64::MAX "not set" value being masked."""
+
+    unset = values == U64_MAX
+    return pd.arrays.IntegerArray(np.where(unset, 0, values).astype(np.int64), unset)
+
+
+def decode_stake_accounts(accounts: list) -> pd.DataFrame:
+    """Decode base64 encoded stake accounts into a typed columnar dataframe.
+
+    The accounts data is concatenated into a single buffer and mapped onto the stake account layout with
+    np.frombuffer, so that no per account parsing happens in python. Only delegated stake accounts are kept,
+    and the u64::MAX epochs used by the stake program as "not set" values are returned as nulls.
+    """
+
+    if not accounts:
+        return pd.DataFrame()
+
+    buffer = b"".join(base64.b64decode(d["account"]["data"][0]) for d in accounts)
+    records = np.frombuffer(buffer, dtype=STAKE_ACCOUNT_DTYPE)
+    delegated = records["state"] == STAKE_STATE_DELEGATED
+    records = records[delegated]
+
+    data = pd.DataFrame(
+        {
+            "pubkey": np.array([d["pubkey"] for d in accounts], dtype=object)[delegated],
+            "program": "stake",
+            "lamports": np.fromiter((d["account"]["lamports"] for d in accounts), dtype=np.int64, count=len(accounts))[delegated],
+            "rentEpoch": np.fromiter((d["account"]["rentEpoch"] for d in accounts), dtype=np.int64, count=len(accounts))[delegated],
+            "staker": encode_pubkeys(records["staker"]),
+            "withdrawer": encode_pubkeys(records["withdrawer"]),
+            "custodian": encode_pubkeys(records["custodian"]),
+            "rentExemptReserve": records["rentExemptReserve"].astype(np.int64),
+            "voter": encode_pubkeys(records["voter"]),
+            "stake": records["stake"].astype(np.int64),
+            "activationEpoch": mask_unset_epochs(records["activationEpoch"]),
+            "deactivationEpoch": mask_unset_epochs(records["deactivationEpoch"]),
+            "warmupCooldownRate": records["warmupCooldownRate"],
+            "creditsObserved": records["creditsObserved"].astype(np.int64),
+        }
+    )
+    return data
+
+
+def parse_stake_accounts(accounts: list) -> pd.DataFrame:
+    """Parse jsonParsed encoded stake accounts into a dataframe, numeric values being returned as strings."""
+
+    data = list()
+    for d in accounts:
+        try:
+            info = dict()
+            info["program"] = d["account"]["data"]["program"]
+            info["lamports"] = d["account"]["lamports"]
+            info["rentEpoch"] = d["account"]["rentEpoch"]
+
+            meta_info = dict()
+            meta_info["staker"] = d["account"]["data"]["parsed"]["info"]["meta"]["authorized"]["staker"]
+            meta_info["withdrawer"] = d["account"]["data"]["parsed"]["info"]["meta"]["authorized"]["withdrawer"]
+            meta_info["custodian"] = d["account"]["data"]["parsed"]["info"]["meta"]["lockup"]["custodian"]
+            meta_info["rentExemptReserve"] = d["account"]["data"]["parsed"]["info"]["meta"]["rentExemptReserve"]
+
+            delegation_info = d["account"]["data"]["parsed"]["info"]["stake"]["delegation"]
+            delegation_info["creditsObserved"] = d["account"]["data"]["parsed"]["info"]["stake"]["creditsObserved"]
+
+            info.update(meta_info)
+            info.update(delegation_info)
+            data.append(info)
+
+        except Exception as e:
+            print(e)
+            continue
+
+    data = pd.DataFrame(data).reset_index(drop=True)
+    data = data.replace({str(np.iinfo(np.uintp).max): None})
+    return data
 
 
 class SolanaAPI:
@@ -17,36 +189,102 @@ class SolanaAPI:
     solanascan API where some data is already indexed.
     """
 
-    def __init__(self):
+    def __init__(self, config_path: str = None):
 
-        self.figment_api_key = os.environ["FIGMENT_DATAHUB_API_KEY"]
-        self.figment_api_url = "https://solana--mainnet.datahub.figment.io/"
-        self.api = Client(self.figment_api_url + f"apikey/{self.figment_api_key}/")
-        self.headers = {
-            "Authorization": self.figment_api_key,
-            "Content-Type": "application/json",
-        }
+        config_path = config_path or os.path.join(os.path.dirname(__file__), "config.yaml")
+        self.config = yaml.safe_load(open(config_path))
+        self._rpc_pool = None
+        self.response_cache = ResponseCache()
+        self.headers = {"Content-Type": "application/json"}
 
-        self.solscan_url = "https://public-api.solscan.io/"
+        self.solscan_url = self.config.get("solscan_url")
         self.solscan_headers = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"}
+        self.solscan_session = requests.Session()
+        self.solscan_session.mount(
+            self.solscan_url,
+            HTTPAdapter(max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])),
+        )
+        self.token_list_pages = dict()
 
         self.execution_timestamp = datetime.datetime.now(datetime.timezone.utc)
         self.start_date = datetime.datetime(2020, 1, 1)
         self.end_date = self.execution_timestamp
 
         self.start_epoch = 0
-        current_epoch_info = self.api.get_epoch_info().get("result")
-        self.current_epoch = current_epoch_info.get("epoch")
-        self.slot = current_epoch_info.get("absoluteSlot")
+        self.cache_dir = os.environ.get("SOLANA_CACHE_DIR", os.path.expanduser("~/.cache/solana-staking"))
+        self.epoch_info_ttl = self.config.get("epoch_info_ttl", 60)
+        self._epoch_info, self._epoch_info_time = None, 0
 
         self.wallet_address = "LDwVxy6FopzHHSDLvgKaDEV7gtk6VaoNWEn461hzAbi"
         self.validator_node_key = "q9XWcZ7T1wP4bW9SB4XgNNwjnFEJ982nE8aVbbNuwot"
         self.validator_vote_key = "26pV97Ce83ZQ6Kz9XT4td8tdoUFPTng8Fb8gPyc53dJx"
 
+    @property
+    def endpoints(self) -> list:
+        """List the configured RPC endpoints whose environment variables are defined, by order of preference."""
+
+        endpoints = [os.path.expandvars(url) for url in self.config.get("rpc_endpoints")]
+        endpoints = [url for url in endpoints if "$" not in url]
+        if not endpoints:
+            raise AssertionError("None of the configured solana RPC endpoints is usable, check their environment variables.")
+        return endpoints
+
+    @property
+    def rpc_pool(self) -> EndpointPool:
+        """The pool of the configured RPC endpoints, created on first use."""
+
+        if self._rpc_pool is None:
+            self._rpc_pool = EndpointPool(
+                self.endpoints,
+                name="solana-rpc",
+                hedge_after=self.config.get("hedge_after"),
+                is_retryable=is_retryable_rpc_response,
+            )
+        return self._rpc_pool
+
+    def rpc_request(self, method: str, params: list = None, immutable=False) -> dict:
+        """Send a JSON-RPC request to the healthiest endpoint of the pool, failing over to the other ones.
+
+        The request goes through the local response cache, in which it is stored if its response is immutable,
+        such as the rewards of a closed epoch or a finalized transaction.
+
+        Args:
+            method (str): The JSON-RPC method.
+            params (list): The parameters of the method.
+            immutable (bool | callable): Whether the response can be cached, or a function deciding it from the payload.
+
+        Returns:
+            dict: The JSON-RPC response, with its result or error.
+        """
+
+        payload = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or list()}
+
+        def request():
+            return response_json(self.rpc_pool.post(headers=self.headers, json=payload))
+
+        return self.response_cache.fetch("solana-rpc", method, payload["params"], request, immutable)
+
+    @property
+    def epoch_info(self) -> dict:
+        """The current epoch info, fetched on first access and then cached for epoch_info_ttl seconds."""
+
+        if self._epoch_info is None or time.time() - self._epoch_info_time > self.epoch_info_ttl:
+            self._epoch_info = self.rpc_request("getEpochInfo").get("result")
+            self._epoch_info_time = time.time()
+        return self._epoch_info
+
+    @property
+    def current_epoch(self) -> int:
+        return self.epoch_info.get("epoch")
+
+    @property
+    def slot(self) -> int:
+        return self.epoch_info.get("absoluteSlot")
+
     def get_current_epoch_info(self):
         """Extract information about the current epoch."""
-        info = self.api.get_epoch_info().get("result")
-        inflation = self.api.get_inflation_rate().get("result")
+        info = self.rpc_request("getEpochInfo").get("result")
+        inflation = self.rpc_request("getInflationRate").get("result")
         data = pd.merge(
             pd.DataFrame.from_dict(info, orient="index").T,
             pd.DataFrame.from_dict(inflation, orient="index").T,
@@ -54,49 +292,108 @@ class SolanaAPI:
         )
         return data
 
-    def get_token_list(self) -> pd.DataFrame:
-        """Extract the list of all tokens existing on Solana through solanascan API."""
+    def request_token_list_page(self, offset: int, limit: int) -> tuple:
+        """Extract a page of the solanascan token list, re-using the cached page if it hasn't been modified.
 
-        token_list = list()
-        url = self.solscan_url + "token/list?"
-        headers = self.solscan_headers
+        The page is requested with the ETag / Last-Modified validators of its cached version when there is one,
+        and is persisted once downloaded so that an interrupted download can be resumed.
+
+        Returns:
+            tuple(pd.DataFrame, int, dict): The tokens of the page, the total number of tokens and the page validators.
+        """
+
+        pages_dir = os.path.join(self.cache_dir, "token_list_pages")
+        page_path = os.path.join(pages_dir, f"{offset}.parquet")
+        validators = self.token_list_pages.get(str(offset), dict())
+
+        headers = dict(self.solscan_headers)
+        if os.path.exists(page_path) and validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if os.path.exists(page_path) and validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        response = self.solscan_session.get(
+            self.solscan_url + "token/list?",
+            headers=headers,
+            params=dict(limit=limit, sortBy="market_cap", direction="desc", offset=offset),
+            timeout=60,
+        )
+        if response.status_code == 304:
+            return pd.read_parquet(page_path), validators.get("total"), validators
+        response.raise_for_status()
+
+        payload = response_json(response)
+        data = pd.DataFrame(payload.get("data"))
+        nested = [c for c in data.select_dtypes("object").columns if data[c].map(lambda x: isinstance(x, (dict, list))).any()]
+        data[nested] = data[nested].applymap(lambda x: json.dumps(x) if isinstance(x, (dict, list)) else x)
+
+        os.makedirs(pages_dir, exist_ok=True)
+        data.to_parquet(page_path, index=False)
+        validators = dict(
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            total=payload.get("total"),
+            fetched_at=time.time(),
+        )
+        return data, payload.get("total"), validators
+
+    def get_token_list(self, ttl: int = 86_400, refresh: bool = False, max_workers: int = 8) -> pd.DataFrame:
+        """Extract the list of all tokens existing on Solana through solanascan API.
+
+        The token list is served from a local parquet cache as long as it is fresher than the ttl (in seconds).
+        Otherwise, the first page gives the total number of tokens and the remaining pages are then fetched
+        concurrently, pages downloaded less than ttl seconds ago by an interrupted download being re-used unless
+        a refresh is forced, and the pages which didn't change are answered with a 304 by solscan. The refreshed
+        list then replaces the cached one.
+        """
+
+        path = os.path.join(self.cache_dir, "token_list.parquet")
+        cached = pd.read_parquet(path) if os.path.exists(path) else None
+        if cached is not None and not refresh and time.time() - os.path.getmtime(path) < ttl:
+            return cached
+
+        index_path = os.path.join(self.cache_dir, "token_list_pages.json")
+        self.token_list_pages = dict()
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                self.token_list_pages = json.load(file)
         limit = 5000
-        offset = 1
+        first_offset = 1
 
-        while True:
-            response = requests.get(
-                url,
-                headers=headers,
-                params=dict(
-                    limit=limit,
-                    sortBy="market_cap",
-                    direction="desc",
-                    offset=offset,
-                ),
-            ).json()
-            data = pd.DataFrame(response.get("data"))
-            token_list.append(data)
-            offset = offset + limit
-            if data.shape[0] < limit:
-                break
+        def fetch_page(offset: int) -> pd.DataFrame:
+            validators = self.token_list_pages.get(str(offset), dict())
+            page_path = os.path.join(self.cache_dir, "token_list_pages", f"{offset}.parquet")
+            if not refresh and os.path.exists(page_path) and time.time() - validators.get("fetched_at", 0) < ttl:
+                return pd.read_parquet(page_path)
+            data, _, self.token_list_pages[str(offset)] = self.request_token_list_page(offset, limit)
+            return data
 
-        token_list = pd.concat(token_list).reset_index(drop=True)
+        try:
+            first_page, total, self.token_list_pages[str(first_offset)] = self.request_token_list_page(first_offset, limit)
+            offsets = range(first_offset + limit, (total or 0) + first_offset, limit)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                pages = list(executor.map(fetch_page, offsets))
+        finally:
+            # the index is replaced atomically, so that an interrupted write doesn't lose the validators of the pages
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(index_path + ".tmp", "w") as file:
+                json.dump(self.token_list_pages, file)
+            os.replace(index_path + ".tmp", index_path)
+
+        token_list = pd.concat([first_page] + pages).drop_duplicates("tokenAddress").reset_index(drop=True)
+
+        if cached is not None:
+            added = ~token_list["tokenAddress"].isin(cached["tokenAddress"])
+            logger.info(f"Token list refreshed: {len(token_list)} tokens, {added.sum()} of them new.")
+
+        token_list.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
         return token_list
 
     def get_transaction_information(self, transaction_hash: str):
         """Extract detailed information about a specific transaction from Solana RPC API."""
 
-        payload = {
-            "jsonrpc": "2.0",
-            "id": 1,
-            "method": "getTransaction",
-            "params": [transaction_hash, "json"],
-        }
-        response = requests.post(
-            url="https://api.mainnet-beta.solana.com",
-            headers=self.headers,
-            json=payload,
-        ).json()
+        response = self.rpc_request("getTransaction", [transaction_hash, "json"], immutable=has_result)
 
         data = pd.DataFrame.from_dict(response.get("result"), orient="index").T
         return data
@@ -112,11 +409,13 @@ class SolanaAPI:
         headers = self.solscan_headers
 
         while True:
-            response = requests.get(
-                url,
-                headers=headers,
-                params=dict(limit=limit, account=address, beforeHash=before_hash),
-            ).json()
+            response = response_json(
+                requests.get(
+                    url,
+                    headers=headers,
+                    params=dict(limit=limit, account=address, beforeHash=before_hash),
+                )
+            )
             txs_list.append(pd.DataFrame(response))
 
             if len(response) == 0:
@@ -188,14 +487,14 @@ class SolanaAPI:
     def get_cluster_nodes(self):
         """Extract the list of all cluster nodes at the execution date."""
 
-        data = pd.DataFrame(self.api.get_cluster_nodes().get("result"))
+        data = pd.DataFrame(self.rpc_request("getClusterNodes").get("result"))
         data["inserted_at"] = datetime.datetime.now()
         return data
 
     def get_validators_snapshot(self):
         """Extract the current and delinquent validators list."""
 
-        validators = self.api.get_vote_accounts().get("result")
+        validators = self.rpc_request("getVoteAccounts").get("result")
 
         delinquent = pd.DataFrame(validators.get("delinquent"))
         delinquent["status"] = "delinquent"
@@ -222,27 +521,22 @@ class SolanaAPI:
 
         for epoch in tqdm(range(start_epoch, self.current_epoch)):
             # pull data for the next epoch of what's in the db, until the previous epoch from current
-            for chunk in vote_keys_chunks:
-
-                url = self.figment_api_url
-                payload = {
-                    "jsonrpc": "2.0",
-                    "id": 1,
-                    "method": "getInflationReward",
-                    "params": [chunk, {"epoch": epoch}],
-                }
-                response = requests.post(url, headers=self.headers, json=payload).json().get("result")
-
-                if not response:
-                    df = pd.DataFrame()
-                else:
-                    response = [x if x is not None else dict() for x in response]
-                    df = pd.DataFrame(response)
-                    df["votePubkey"] = chunk
-                    df["epoch"] = epoch
-                    df["inserted_at"] = self.execution_timestamp
-
-                data.append(df)
+            with metrics.span("fetch", network="solana", dataset="validators_rewards"):
+                for chunk in vote_keys_chunks:
+
+                    response = self.rpc_request("getInflationReward", [chunk, {"epoch": epoch}], immutable=has_result).get("result")
+
+                    if not response:
+                        df = pd.DataFrame()
+                    else:
+                        response = [x if x is not None else dict() for x in response]
+                        df = pd.DataFrame(response)
+                        df["votePubkey"] = chunk
+                        df["epoch"] = epoch
+                        df["inserted_at"] = self.execution_timestamp
+
+                    metrics.inc("rows_total", len(df), stage="fetch", network="solana", dataset="validators_rewards")
+                    data.append(df)
 
         try:
             data = pd.concat(data).reset_index(drop=True)
@@ -257,63 +551,148 @@ class SolanaAPI:
         """Extract all the validators and their balance per epoch. NB: This method only work since epoch 275."""
 
         validators = self.get_validators_snapshot()
-        data = validators.explode("epochCredits")
+        data = validators.explode("epochCredits").reset_index(drop=True)
 
-        data["epoch"] = [x[0] if type(x) == list else None for x in data["epochCredits"]]
-        data["prev_vote_credits"] = [x[2] if type(x) == list else None for x in data["epochCredits"]]
-        data["post_vote_credits"] = [x[1] if type(x) == list else None for x in data["epochCredits"]]
+        # epochCredits entries are [epoch, credits, previousCredits] triples, decoded at once as a (n, 3) array
+        credits = data["epochCredits"].dropna()
+        triples = np.array(credits.tolist(), dtype=np.int64).reshape(-1, 3)
+        for column, position in [("epoch", 0), ("prev_vote_credits", 2), ("post_vote_credits", 1)]:
+            values = np.zeros(len(data), dtype=np.int64)
+            values[credits.index] = triples[:, position]
+            data[column] = pd.arrays.IntegerArray(values, data["epochCredits"].isna().values)
 
-        data = data.drop("epochCredits", axis=1).reset_index(drop=True)
+        data = data.drop("epochCredits", axis=1)
 
         return data
 
-    def get_delegators_snapshot(self, vote_key: str = None):
+    def update_vote_credits_store(self) -> VoteCreditsStore:
+        """Merge the current vote credits snapshot into the local vote credits time series store.
+
+        getVoteAccounts only returns the last few epochs of credits of each validator, so the history is built by
+        upserting every new snapshot into the store, which can then be queried for the validators credit rates.
+        """
+
+        store = VoteCreditsStore(os.path.join(self.cache_dir, "vote_credits"))
+        store.merge(self.get_validators_vote_credits())
+        return store
+
+    def request_stake_accounts(self, memcmp_opts: list = None, encoding: str = "base64") -> list:
+        """Extract the raw stake accounts owned by the stake program, optionally filtered with memcmp options."""
+
+        filters = [{"dataSize": STAKE_ACCOUNT_SIZE}]
+        filters += [{"memcmp": {"offset": opts.offset, "bytes": opts.bytes}} for opts in memcmp_opts or list()]
+        response = self.rpc_request("getProgramAccounts", [str(STAKE_PROGRAM_ID), {"encoding": encoding, "filters": filters}])
+        return response.get("result")
+
+    def get_delegators_snapshot(self, vote_key: str = None, encoding: str = "jsonParsed"):
         """Extract all the delegator of a specific validator program.
 
-        The address to be used is one of the validators' votePubkey values.
+        The address to be used is one of the validators' votePubkey values. With the base64 encoding, the
+        raw stake accounts are decoded in bulk into typed columns instead of being parsed account per account.
         """
 
         if not vote_key:
             vote_key = self.validator_vote_key
 
-        STAKE_PROGRAM_ID: PublicKey = PublicKey("Stake11111111111111111111111111111111111111")
+        memcmp_opts = [MemcmpOpts(offset=STAKE_VOTER_OFFSET, bytes=vote_key)]
+        accounts = self.request_stake_accounts(memcmp_opts, encoding=encoding)
+
+        if encoding == "base64":
+            data = decode_stake_accounts(accounts)
+        else:
+            data = parse_stake_accounts(accounts)
+
+        data["inserted_at"] = datetime.datetime.now()
+        return data
+
+    def read_epoch_cache(self, name: str, epoch: int) -> pd.DataFrame:
+        """Read a dataset cached for a given epoch, returning None if it hasn't been cached yet."""
+
+        path = os.path.join(self.cache_dir, f"{name}_{epoch}.parquet")
+        return pd.read_parquet(path) if os.path.exists(path) else None
+
+    def write_epoch_cache(self, data: pd.DataFrame, name: str, epoch: int):
+        """Cache a dataset for a given epoch, the file being written atomically."""
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, f"{name}_{epoch}.parquet")
+        data.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+    def get_stake_accounts_snapshot(self, sharded: bool = False, max_workers: int = 8):
+        """Extract all the delegated stake accounts of the network, whatever the validator they delegate to.
+
+        The stake accounts are fetched in a single getProgramAccounts call, or sharded over the first byte of the
+        voter pubkey (256 calls ran concurrently) for nodes that time out on the full response. As stake only
+        changes at epoch boundaries, the decoded snapshot is cached for the current epoch.
+        """
+
+        epoch = self.current_epoch
+        data = self.read_epoch_cache("stake_accounts", epoch)
+        if data is not None:
+            return data
+
+        if sharded:
+            shards = [[MemcmpOpts(offset=STAKE_VOTER_OFFSET, bytes=b58encode(bytes([i])).decode())] for i in range(256)]
+        else:
+            shards = [None]
+
+        labels = dict(network="solana", dataset="stake_accounts")
+        with metrics.span("fetch", **labels), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            accounts = [account for shard in executor.map(self.request_stake_accounts, shards) for account in shard]
+        metrics.inc("rows_total", len(accounts), stage="fetch", **labels)
 
-        memcmp_opts = [MemcmpOpts(offset=124, bytes=vote_key)]
-        response = self.api.get_program_accounts(
-            STAKE_PROGRAM_ID,
-            encoding="jsonParsed",
-            data_size=200,
-            memcmp_opts=memcmp_opts,
+        with metrics.span("decode", **labels):
+            data = decode_stake_accounts(accounts)
+        data["epoch"] = epoch
+        data["inserted_at"] = datetime.datetime.now()
+        with metrics.span("sink", **labels):
+            self.write_epoch_cache(data, "stake_accounts", epoch)
+        metrics.inc("rows_total", len(data), stage="sink", **labels)
+
+        return data
+
+    def get_validators_stakes(self, sharded: bool = False):
+        """Aggregate the network-wide stake accounts snapshot per validator.
+
+        For every validator of the vote accounts snapshot, we compute the active, activating and deactivating
+        stake at the current epoch, the number of stake accounts and distinct delegators, as well as the range
+        of activation and deactivation epochs of its delegations. The aggregates are cached per epoch.
+        """
+
+        epoch = self.current_epoch
+        data = self.read_epoch_cache("validators_stakes", epoch)
+        if data is not None:
+            return data
+
+        stakes = self.get_stake_accounts_snapshot(sharded=sharded)
+        activation = stakes["activationEpoch"].fillna(-1)
+        deactivation = stakes["deactivationEpoch"].fillna(np.iinfo(np.int64).max)
+
+        stakes = stakes.assign(
+            active_stake=stakes["stake"].where((activation < epoch) & (deactivation > epoch), 0),
+            activating_stake=stakes["stake"].where(activation == epoch, 0),
+            deactivating_stake=stakes["stake"].where(deactivation == epoch, 0),
+        )
+        aggregates = stakes.groupby("voter", sort=False).agg(
+            active_stake=("active_stake", "sum"),
+            activating_stake=("activating_stake", "sum"),
+            deactivating_stake=("deactivating_stake", "sum"),
+            stake_accounts=("pubkey", "size"),
+            delegators=("staker", "nunique"),
+            first_activation_epoch=("activationEpoch", "min"),
+            last_activation_epoch=("activationEpoch", "max"),
+            last_deactivation_epoch=("deactivationEpoch", "max"),
         )
 
-        data = list()
-        for d in response.get("result"):
-            try:
-                info = dict()
-                info["program"] = d["account"]["data"]["program"]
-                info["lamports"] = d["account"]["lamports"]
-                info["rentEpoch"] = d["account"]["rentEpoch"]
-
-                meta_info = dict()
-                meta_info["staker"] = d["account"]["data"]["parsed"]["info"]["meta"]["authorized"]["staker"]
-                meta_info["withdrawer"] = d["account"]["data"]["parsed"]["info"]["meta"]["authorized"]["withdrawer"]
-                meta_info["custodian"] = d["account"]["data"]["parsed"]["info"]["meta"]["lockup"]["custodian"]
-                meta_info["rentExemptReserve"] = d["account"]["data"]["parsed"]["info"]["meta"]["rentExemptReserve"]
-
-                delegation_info = d["account"]["data"]["parsed"]["info"]["stake"]["delegation"]
-                delegation_info["creditsObserved"] = d["account"]["data"]["parsed"]["info"]["stake"]["creditsObserved"]
-
-                info.update(meta_info)
-                info.update(delegation_info)
-                data.append(info)
-
-            except Exception as e:
-                print(e)
-                continue
-
-        data = pd.DataFrame(data).reset_index(drop=True)
-        data = data.replace({str(np.iinfo(np.uintp).max): None})
+        validators = self.get_validators_snapshot()[["votePubkey", "nodePubkey", "commission", "activatedStake", "status"]]
+        data = validators.merge(aggregates, left_on="votePubkey", right_index=True, how="left")
+        counts = ["active_stake", "activating_stake", "deactivating_stake", "stake_accounts", "delegators"]
+        data[counts] = data[counts].fillna(0).astype(np.int64)
+        data["epoch"] = epoch
         data["inserted_at"] = datetime.datetime.now()
+        self.write_epoch_cache(data, "validators_stakes", epoch)
+
         return data
 
     def get_delegators_stakes(self, vote_key: str = None):
@@ -321,14 +700,14 @@ class SolanaAPI:
 
         vote_key = vote_key if vote_key else self.validator_vote_key
         delegators = self.get_delegators_snapshot(vote_key)
-        url = "https://public-api.solscan.io/account/stakeAccounts?"
+        url = self.solscan_url + "account/stakeAccounts?"
         headers = self.solscan_headers
         data = list()
 
         for delegator_address in tqdm(delegators["staker"]):
-            response = requests.get(url, headers=headers, params=dict(account=delegator_address)).json()
+            response = response_json(requests.get(url, headers=headers, params=dict(account=delegator_address)))
             stake_accounts = pd.DataFrame(response.values())
-            stake_activations = [self.api.get_stake_activation(stake_account).get("result") for stake_account in stake_accounts["stakeAccount"]]
+            stake_activations = [self.rpc_request("getStakeActivation", [stake_account]).get("result") for stake_account in stake_accounts["stakeAccount"]]
             df = pd.concat([stake_accounts, pd.DataFrame(stake_activations)], axis=1)
             data.append(df)
 
@@ -350,27 +729,22 @@ class SolanaAPI:
 
         for epoch in tqdm(range(start_epoch, self.current_epoch)):
             # pull data for the next epoch of what's in the db, until the previous epoch from current
-            for chunk in addresses_chunks:
-
-                url = self.figment_api_url
-                payload = {
-                    "jsonrpc": "2.0",
-                    "id": 1,
-                    "method": "getInflationReward",
-                    "params": [chunk, {"epoch": epoch}],
-                }
-                response = requests.post(url, headers=self.headers, json=payload).json().get("result")
-
-                if not response:
-                    df = pd.DataFrame()
-                else:
-                    response = [x if x is not None else dict() for x in response]
-                    df = pd.DataFrame(response)
-                    df["stake_account"] = chunk
-                    df["epoch"] = epoch
-                    df["inserted_at"] = self.execution_timestamp
-
-                data.append(df)
+            with metrics.span("fetch", network="solana", dataset="delegators_rewards"):
+                for chunk in addresses_chunks:
+
+                    response = self.rpc_request("getInflationReward", [chunk, {"epoch": epoch}], immutable=has_result).get("result")
+
+                    if not response:
+                        df = pd.DataFrame()
+                    else:
+                        response = [x if x is not None else dict() for x in response]
+                        df = pd.DataFrame(response)
+                        df["stake_account"] = chunk
+                        df["epoch"] = epoch
+                        df["inserted_at"] = self.execution_timestamp
+
+                    metrics.inc("rows_total", len(df), stage="fetch", network="solana", dataset="delegators_rewards")
+                    data.append(df)
 
         try:
             data = pd.concat(data).reset_index(drop=True)
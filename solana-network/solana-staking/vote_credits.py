@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class VoteCreditsStore:
+    """This class stores the validators vote credits history as a columnar time series.
+
+    The store is a parquet file keyed by (votePubkey, epoch), into which the vote credits snapshots extracted with
+    SolanaAPI.get_validators_vote_credits are upserted. The credits of the current epoch keep on changing until
+    the epoch ends, hence the latest snapshot always wins for a given key.
+    """
+
+    key = ["votePubkey", "epoch"]
+    columns = ["votePubkey", "nodePubkey", "epoch", "prev_vote_credits", "post_vote_credits", "inserted_at"]
+
+    def __init__(self, path: str):
+
+        self.path = path
+        self.file_path = os.path.join(path, "vote_credits.parquet")
+
+    def read(self, vote_keys: list = None, start_epoch: int = None, end_epoch: int = None) -> pd.DataFrame:
+        """Read the stored vote credits, the filters being pushed down to the parquet reader."""
+
+        if not os.path.exists(self.file_path):
+            return pd.DataFrame(columns=self.columns)
+
+        filters = list()
+        if vote_keys is not None:
+            filters.append(("votePubkey", "in", list(vote_keys)))
+        if start_epoch is not None:
+            filters.append(("epoch", ">=", start_epoch))
+        if end_epoch is not None:
+            filters.append(("epoch", "<=", end_epoch))
+
+        return pd.read_parquet(self.file_path, filters=filters or None)
+
+    def merge(self, snapshot: pd.DataFrame) -> int:
+        """Upsert a vote credits snapshot into the store.
+
+        Args:
+            snapshot (pd.DataFrame): The vote credits snapshot, as returned by get_validators_vote_credits.
+
+        Returns:
+            int: The number of inserted or updated (votePubkey, epoch) rows.
+        """
+
+        snapshot = snapshot.dropna(subset=["epoch"])[self.columns]
+        snapshot = snapshot.astype({"epoch": np.int64, "prev_vote_credits": np.int64, "post_vote_credits": np.int64})
+        stored = self.read()
+
+        # Only keep the snapshot rows that are new or whose credits changed since the last merge
+        merged = snapshot.merge(stored[self.key + ["post_vote_credits"]], on=self.key, how="left", suffixes=("", "_stored"))
+        changed = (merged["post_vote_credits"] != merged["post_vote_credits_stored"]).values
+        snapshot = snapshot.loc[changed]
+
+        if not snapshot.empty:
+            data = pd.concat([stored, snapshot]).drop_duplicates(self.key, keep="last")
+            data = data.sort_values(self.key).reset_index(drop=True)
+
+            os.makedirs(self.path, exist_ok=True)
+            data.to_parquet(self.file_path + ".tmp", index=False)
+            os.replace(self.file_path + ".tmp", self.file_path)
+
+        return len(snapshot)
+
+    def credit_rates(self, vote_keys: list = None, start_epoch: int = None, end_epoch: int = None) -> pd.DataFrame:
+        """Compute the vote credits earned by the validators per epoch and their credit rate.
+
+        The credit rate is the share of the maximum number of credits earned by a validator over the same epoch,
+        which makes it comparable across epochs of different lengths.
+        """
+
+        data = self.read(start_epoch=start_epoch, end_epoch=end_epoch)
+        data["earned_credits"] = data["post_vote_credits"] - data["prev_vote_credits"]
+        data["max_earned_credits"] = data.groupby("epoch")["earned_credits"].transform("max")
+        data["credit_rate"] = data["earned_credits"] / data["max_earned_credits"].replace(0, np.nan)
+
+        if vote_keys is not None:
+            data = data[data["votePubkey"].isin(vote_keys)]
+
+        return data.reset_index(drop=True)